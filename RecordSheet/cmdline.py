@@ -19,12 +19,23 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
 import getpass
+import glob
+import gzip
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
 import sys
+import time
+import zipfile
 
 import bottle
 import sqlalchemy
-from RecordSheet import dbapi, dbmodel, config, webapp, __version__
+from RecordSheet import (dbapi, dbmodel, config, mport, util, webapp,
+                         __version__)
 
 ###############################################################################
 
@@ -74,6 +85,294 @@ def adduser(args):
 
 ###############################################################################
 
+def balances(args):
+    try:
+        dbapi.init()
+    except Exception:
+        sys.exit("Failed to init database")
+
+    if args.rebuild:
+        dbapi.rebuild_balances()
+        print('Account balances rebuilt')
+        return
+
+    mismatched = dbapi.verify_balances()
+    for account_id, stored, actual in mismatched:
+        print('Account {}: stored {} actual {}'.format(account_id, stored,
+                                                        actual))
+
+    if mismatched:
+        sys.exit('{} account balances are incorrect, use --rebuild to fix '
+                 'them'.format(len(mismatched)))
+
+    print('Account balances are correct')
+
+###############################################################################
+
+def migrate(args):
+    try:
+        dbapi.init()
+    except Exception:
+        sys.exit("Failed to init database")
+
+    changes = dbapi.migrate(dry_run=args.dry_run)
+    for change in changes:
+        print(change)
+
+    if not changes:
+        print('The database is up to date')
+    elif args.dry_run:
+        print('Dry run, no changes were made')
+
+###############################################################################
+
+def export(args):
+    try:
+        dbapi.init()
+    except Exception:
+        sys.exit("Failed to init database")
+
+    try:
+        start = util.parse_datetime(args.start) if args.start else None
+        end = util.parse_datetime(args.end, end_of_day=True) \
+                if args.end else None
+    except ValueError:
+        sys.exit("Invalid date range")
+
+    account_id = None
+    if args.account:
+        try:
+            account_id = dbapi.get_account_by_name(args.account.upper()).id
+        except sqlalchemy.orm.exc.NoResultFound:
+            sys.exit('Account "{}" doesn\'t exist'.format(args.account))
+
+    rows = dbapi.export_posts(account_id=account_id, start=start, end=end)
+    if args.format == 'ndjson':
+        chunks = util.ndjson_stream(rows)
+    else:
+        chunks = util.csv_stream(dbapi.EXPORT_COLUMNS, rows)
+
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, 'w', newline='', encoding='utf8')
+
+    with out:
+        for chunk in chunks:
+            out.write(chunk)
+
+###############################################################################
+
+def _import_sources(patterns, file_format=None):
+    """Expand file names, globs and zip archives into the files to import.
+
+    :param file_format: mport.formats key to use for every file, by default \
+    it is guessed from the file extensions.
+    :returns: generator of (path, member, file_format) tuples. member is the \
+    name of the file inside the zip archive at path, or None.
+    """
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path.lower().endswith('.zip'):
+                with zipfile.ZipFile(path) as archive:
+                    members = [(path, info.filename) for info
+                               in archive.infolist() if not info.is_dir()]
+            else:
+                members = [(path, None)]
+
+            for path, member in members:
+                name = member or path
+                fmt = file_format or mport.guess_format(name)
+                if fmt is None:
+                    print('{}: unknown format, skipped'.format(name),
+                          file=sys.stderr)
+                    continue
+                yield path, member, fmt
+
+
+_batches = None # queue of parsed rows to the parent, in the worker processes
+
+def _init_worker(batches):
+    global _batches
+    _batches = batches
+
+
+def _source_rows(path, member, file_format):
+    """Parse one _import_sources file lazily."""
+    parser = mport.formats[file_format]
+    if member is None:
+        with open(path, 'rb') as fileobj:
+            yield from parser(fileobj)
+    else:
+        with zipfile.ZipFile(path) as archive, \
+                archive.open(member) as fileobj:
+            yield from parser(fileobj)
+
+
+def _parse_source(index, source):
+    """Parse one _import_sources file, this runs in the worker processes.
+    The rows are sent to the parent on the _batches queue as (index, rows)
+    tuples of up to IMPORT_CHUNK rows, so a big file is never held in
+    memory whole.
+
+    :returns: a (rows, seconds, error) tuple, the number of rows sent, the \
+    time spent parsing them, not counting waits for room on the queue, and \
+    why parsing failed or None. The parent waits for every row sent, even \
+    when parsing fails part way.
+    """
+    count = 0
+    waited = 0
+    error = None
+    start = time.perf_counter()
+    try:
+        for batch in util.chunked(_source_rows(*source), dbapi.IMPORT_CHUNK):
+            put_start = time.perf_counter()
+            _batches.put((index, batch))
+            waited += time.perf_counter() - put_start
+            count += len(batch)
+    except Exception as exc:
+        error = str(exc) or type(exc).__name__
+
+    return count, time.perf_counter() - start - waited, error
+
+
+class _ImportFile:
+    """The progress of writing one file's rows as they come from a worker."""
+    def __init__(self, path, member, file_format):
+        self.name = path if member is None else path + ':' + member
+        self.rows = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.insert_time = 0
+        self.error = None
+
+
+    def insert(self, rows, account_id):
+        """Insert a batch of rows, they're dropped once one batch fails."""
+        self.rows += len(rows)
+        if self.error is not None:
+            return
+
+        for row in rows:
+            row['account_id'] = account_id
+        start = time.perf_counter()
+        try:
+            # a transaction per batch rather than one for the whole file
+            inserted, skipped = dbapi.insert_imported_transactions(rows)
+        except Exception as exc:
+            self.error = exc
+            return
+
+        self.inserted += inserted
+        self.duplicates += skipped
+        self.insert_time += time.perf_counter() - start
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds else 0
+
+
+def import_files(args):
+    try:
+        dbapi.init()
+    except Exception:
+        sys.exit("Failed to init database")
+
+    account_id = None
+    if args.account:
+        try:
+            account_id = dbapi.get_account_by_name(args.account.upper()).id
+        except sqlalchemy.orm.exc.NoResultFound:
+            sys.exit('Account "{}" doesn\'t exist'.format(args.account))
+
+    try:
+        sources = enumerate(list(_import_sources(args.files, args.format)))
+    except (OSError, zipfile.BadZipFile) as exc:
+        sys.exit(str(exc))
+
+    # the files are parsed in worker processes and written here, on this
+    # process's connection. Spawned workers don't inherit the connection
+    # like forked ones would. The bounded queue holds the workers back when
+    # they get ahead of the writer.
+    context = multiprocessing.get_context('spawn')
+    jobs = args.jobs or os.cpu_count() or 1
+    batches = context.Queue(2 * jobs)
+    failed = total = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=context,
+                initializer=_init_worker, initargs=(batches,)) as pool:
+        # the files being parsed, or whose rows are still on the queue
+        files = {}
+        pending = {}
+        while True:
+            for index, source in itertools.islice(sources,
+                                            max(2 * jobs - len(pending), 0)):
+                pending[pool.submit(_parse_source, index, source)] = index
+                files[index] = _ImportFile(*source)
+            if not pending:
+                break
+
+            try:
+                index, rows = batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            else:
+                files[index].insert(rows, account_id)
+
+            for future in [f for f in pending if f.done()]:
+                file = files[pending[future]]
+                count, parse_time, error = future.result()
+                if file.rows < count:
+                    continue # rows still on the queue
+
+                del files[pending.pop(future)]
+                file.error = file.error or error
+                if file.error is not None:
+                    print('{}: {}'.format(file.name, file.error),
+                          file=sys.stderr)
+                    failed += 1
+                    continue
+
+                total += count
+                print('{}: {} rows, {} inserted, {} duplicates, parsed at '
+                      '{:.0f} rows/s, inserted at {:.0f} rows/s'.format(
+                        file.name, count, file.inserted, file.duplicates,
+                        _rate(count, parse_time),
+                        _rate(count, file.insert_time)))
+
+    elapsed = time.perf_counter() - start
+    print('{} rows in {:.1f}s, {:.0f} rows/s'.format(total, elapsed,
+                                                    _rate(total, elapsed)))
+    if failed:
+        sys.exit('{} files failed to import'.format(failed))
+
+###############################################################################
+
+PRECOMPRESS_EXTS = ('.css', '.html', '.js', '.json', '.svg', '.txt')
+
+def precompress(args):
+    """Write a .gz copy of each static text file for send_static to serve,
+    skipping ones that are already up to date.
+    """
+    for dirpath, dirnames, filenames in os.walk(webapp.STATIC_ROOT):
+        for filename in filenames:
+            if not filename.endswith(PRECOMPRESS_EXTS):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            gzpath = path + '.gz'
+            if os.path.exists(gzpath) and \
+                    os.path.getmtime(gzpath) >= os.path.getmtime(path):
+                continue
+
+            with open(path, 'rb') as src, \
+                    gzip.open(gzpath, 'wb', compresslevel=9) as dst:
+                shutil.copyfileobj(src, dst)
+
+            print('{} {} -> {} bytes'.format(path, os.path.getsize(path),
+                                             os.path.getsize(gzpath)))
+
+###############################################################################
+
 def main():
     parser = argparse.ArgumentParser(prog='RecordSheet', description=None)
     parser.set_defaults(func=stats)
@@ -96,6 +395,55 @@ def main():
                     help='user\'s full name')
     adduser_parser.set_defaults(func=adduser)
 
+    #opts for balances
+    balances_parser = subparsers.add_parser('balances',
+                    help='verify the stored account balances')
+    balances_parser.add_argument('--rebuild', '-r', action='store_true',
+                    help='recompute the balances from the posts')
+    balances_parser.set_defaults(func=balances)
+
+    #opts for migrate
+    migrate_parser = subparsers.add_parser('migrate',
+                    help='update the schema of an existing database')
+    migrate_parser.add_argument('--dry-run', '-n', action='store_true',
+                    help='show the changes without making them')
+    migrate_parser.set_defaults(func=migrate)
+
+    #opts for export
+    export_parser = subparsers.add_parser('export',
+                    help='export posts with running balances')
+    export_parser.add_argument('--account', '-a',
+                    help='only export this account\'s ledger')
+    export_parser.add_argument('--from', dest='start',
+                    help='first date or datetime to export')
+    export_parser.add_argument('--to', dest='end',
+                    help='last date or datetime to export')
+    export_parser.add_argument('--format', '-f', choices=['csv', 'ndjson'],
+                    default='csv', help='output format, default csv')
+    export_parser.add_argument('--output', '-o',
+                    help='file to write, default standard output')
+    export_parser.set_defaults(func=export)
+
+    #opts for import
+    import_parser = subparsers.add_parser('import',
+                    help='import transaction files, globs or zip archives')
+    import_parser.add_argument('files', nargs='+',
+                    help='files, globs or zip archives to import')
+    import_parser.add_argument('--format', '-f',
+                    choices=sorted(mport.formats),
+                    help='format of all the files, by default it is '
+                         'guessed from their extensions')
+    import_parser.add_argument('--account', '-a',
+                    help='account the transactions are from')
+    import_parser.add_argument('--jobs', '-j', type=int,
+                    help='parser processes, default the number of CPUs')
+    import_parser.set_defaults(func=import_files)
+
+    #opts for precompress
+    precompress_parser = subparsers.add_parser('precompress',
+                    help='gzip the static files ahead of time')
+    precompress_parser.set_defaults(func=precompress)
+
     args = parser.parse_args()
     args.func(args)
 
@@ -22,4 +22,7 @@ import os
 
 # no need to be fancy when just this will do
 OPTIONS = {'dbconnectstr':'postgresql:///recordsheet',
-           'debug': False}
+           'debug': False,
+           # pbkdf2 rounds for new password hashes, old hashes are redone
+           # at login
+           'pw_rounds': 100000}
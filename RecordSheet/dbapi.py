@@ -22,19 +22,34 @@
 
 """
 
+import collections
 import datetime
 from decimal import Decimal
 import hashlib
+import hmac
+import itertools
 import os
-
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import scoped_session, sessionmaker
+import selectors
+import threading
+import time
+import weakref
+
+from sqlalchemy import (create_engine, and_, asc, case, desc, event, false,
+                        func, inspect, or_, tuple_)
+from sqlalchemy.orm import (joinedload, scoped_session, sessionmaker,
+                            subqueryload, Query)
+from sqlalchemy.orm import Session as OrmSession
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql import select
 
+from RecordSheet import util
 from RecordSheet.config import OPTIONS
-from RecordSheet.dbmodel import (Account, Batch, Journal, Posting,
-                                    ImportedTransaction, User, Base)
+from RecordSheet.dbmodel import (Account, AccountBalance, Batch, Change,
+                                    Journal, Posting, ImportedTransaction,
+                                    ImportJob, TableVersion, User, Base)
 
 ###############################################################################
 
@@ -42,9 +57,26 @@ class DBException(Exception):
     """Base exception class for dbapi."""
     pass
 
+
+class EntryError(DBException):
+    """Raised when journal entries fail validation. The errors attribute is
+    a dict of entry index, error message pairs.
+    """
+    def __init__(self, errors):
+        super().__init__("{} journal entries are invalid".format(len(errors)))
+        self.errors = errors
+
+###############################################################################
+
+# Eager loading options for rendering journal entries with their posts and
+# the posts' accounts in a fixed number of queries.
+JOURNAL_POSTS = (subqueryload(Journal.posts).joinedload('account'),)
+
 ###############################################################################
 
 _session = None
+# every session made by init's factory, for session_stats
+_live_sessions = weakref.WeakSet()
 
 def init():
     """Initiallize the database connection.
@@ -60,8 +92,16 @@ def init():
     engine = create_engine(connect_str, echo=False)
     session_factory = sessionmaker(bind=engine)
     meta = Base.metadata.create_all(engine)
-    # using thread local storage
-    _session = scoped_session(session_factory)
+
+    def new_session():
+        ses = session_factory()
+        _live_sessions.add(ses)
+        return ses
+
+    # using thread local storage, which is greenlet local once gevent has
+    # monkey patched threading. Either way remove_session must be called
+    # when a request is done with it.
+    _session = scoped_session(new_session)
 
     return _session
 
@@ -70,6 +110,535 @@ def Session():
     """Create a new SQLAlchemy session."""
     return _session()
 
+
+def migrate(dry_run=False):
+    """Bring the schema of an existing database up to date with dbmodel.
+    create_all only creates missing tables, this also adds missing columns
+    and indexes to existing tables, and makes columns NOT NULL where dbmodel
+    says so and gives a default to fill in the nulls with. Nothing is
+    dropped. Account balances are rebuilt if any accounts don't have one.
+
+    :param dry_run: Roll back instead of committing.
+    :returns: A list of descriptions of the changes.
+    """
+    ses = _session()
+    try:
+        conn = ses.connection()
+        inspector = inspect(conn)
+        existing = set(inspector.get_table_names())
+        changes = []
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                table.create(conn)
+                changes.append('created table {}'.format(table.name))
+                continue
+
+            preparer = conn.dialect.identifier_preparer
+            columns = dict((c['name'], c['nullable'])
+                           for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in columns:
+                    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                                    preparer.format_table(table), ddl))
+                    changes.append('added column {}.{}'.format(table.name,
+                                                               column.name))
+
+                elif columns[column.name] and not column.nullable:
+                    default = column.default
+                    if default is None or not (default.is_scalar or
+                                               default.is_clause_element):
+                        continue
+
+                    conn.execute(table.update().where(column == None)
+                                 .values({column: default.arg}))
+                    conn.execute('ALTER TABLE {} ALTER COLUMN {} SET NOT NULL'
+                                 .format(preparer.format_table(table),
+                                         preparer.format_column(column)))
+                    changes.append('made column {}.{} not null'.format(
+                                    table.name, column.name))
+
+            indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changes.append('created index {}'.format(index.name))
+
+        unbalanced = ses.query(Account.id).outerjoin(Account.totals) \
+                        .filter(or_(AccountBalance.account_id == None,
+                                    AccountBalance.debits == None)).count()
+        if unbalanced:
+            changes.append('rebuilt account balances')
+
+        if dry_run:
+            ses.rollback()
+        elif unbalanced:
+            # commits the schema changes too
+            rebuild_balances()
+        else:
+            ses.commit()
+
+        return changes
+
+    except Exception:
+        ses.rollback()
+        raise
+
+
+def remove_session():
+    """Close and discard the current thread's session, if it has one. The
+    next call to Session will make a new one.
+    """
+    remove = getattr(_session, 'remove', None)
+    if remove is None:
+        return
+
+    if _session.registry.has():
+        _live_sessions.discard(_session.registry())
+
+    remove()
+
+
+def session_stats():
+    """Counters for the sessions that haven't been removed.
+
+    :returns: A dict with live_sessions, the number of sessions, and \
+    identity_map, the total number of objects held by their identity maps.
+    """
+    sessions = list(_live_sessions)
+    return {'live_sessions': len(sessions),
+            'identity_map': sum(len(ses.identity_map) for ses in sessions)}
+
+###############################################################################
+
+# Change counters for conditional requests, kept in the table_versions
+# table so every process serving the database agrees on them. A table's
+# counter is bumped by the transaction that changes it, so a new version
+# becomes visible exactly when the change does. The bumps are saved up and
+# made in one statement just before the commit, the rows stay locked from
+# then until the commit, so writers only wait on each other that long.
+
+def touch(ses, *tables):
+    """Bump the versions of `tables` when the current transaction of ses
+    commits. The ORM unit of work is tracked automatically, this is for
+    bulk inserts and Core or Query updates, which bypass it.
+
+    :param tables: Table names.
+    """
+    ses.info.setdefault('touched', set()).update(tables)
+
+
+def table_version(*tables):
+    """Get a string that changes whenever any of `tables` does."""
+    versions = TableVersion.__table__
+    rows = _session().execute(select([versions.c.table, versions.c.version])
+                              .where(versions.c.table.in_(tables)))
+    counts = dict(rows.fetchall())
+    return '.'.join(str(counts.get(table, 0)) for table in tables)
+
+
+@event.listens_for(OrmSession, 'before_commit')
+def _bump_versions(ses):
+    # the commit flushes after this hook, its changes have to be seen here
+    ses.flush()
+    tables = sorted(ses.info.get('touched', ()))
+    if not tables:
+        return
+
+    versions = TableVersion.__table__
+    stmt = pg_insert(versions).values([{'table': table, 'version': 1}
+                                       for table in tables])
+    ses.execute(stmt.on_conflict_do_update(
+                    index_elements=[versions.c.table],
+                    set_={'version': versions.c.version + 1}))
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _flushed(ses, flush_context):
+    changed = itertools.chain(ses.new, ses.dirty, ses.deleted)
+    touch(ses, *set(obj.__table__.name for obj in changed))
+
+
+@event.listens_for(OrmSession, 'after_transaction_create')
+def _savepoint(ses, transaction):
+    # what the outer transaction has saved up for its commit, see
+    # _rolled_back
+    if transaction.nested:
+        saved = ses.info.setdefault('savepoints', {})
+        saved[transaction] = (set(ses.info.get('touched', ())),
+                              len(ses.info.get('changes', ())))
+
+
+@event.listens_for(OrmSession, 'after_transaction_end')
+def _savepoint_end(ses, transaction):
+    ses.info.get('savepoints', {}).pop(transaction, None)
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _rolled_back(ses):
+    touched = ses.info.pop('touched', ())
+    ses.info.pop('accounts', None)
+    if ses.transaction.nested:
+        # the outer transaction still has to bump and record what it
+        # changed before the savepoint
+        ses.info['touched'], count = ses.info['savepoints'][ses.transaction]
+        del ses.info.get('changes', [])[count:]
+        pending = ses.info.get('accounts_pending', False)
+    else:
+        ses.info.pop('changes', None)
+        pending = ses.info.pop('accounts_pending', False)
+
+    if pending or Account.__tablename__ in touched:
+        invalidate_accounts()
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _committed(ses):
+    touched = ses.info.pop('touched', ())
+    ses.info.pop('accounts', None)
+    if Account.__tablename__ in touched:
+        invalidate_accounts()
+        # released savepoint, a directory cached before the outer
+        # transaction ends may hold its changes, see account_directory
+        if ses.transaction.nested:
+            ses.info['accounts_pending'] = True
+    elif not ses.transaction.nested:
+        ses.info.pop('accounts_pending', None)
+
+###############################################################################
+
+# Tables followed by the change feed
+CHANGE_TABLES = frozenset(['accounts', 'imported_transactions', 'journal'])
+CHANGES_LOCK = 0x52534346 # advisory lock serializing change feed writers
+CHANGES_LIMIT = 500 # default number of changes returned at once
+CHANGES_WAIT = 30 # longest get_changes waits for a change, in seconds
+CHANGES_CHANNEL = 'recordsheet_changes' # NOTIFY channel of change writers
+
+
+def record_changes(ses, table, ids, op):
+    """Append changes to the feed when the current transaction of ses
+    commits. The ORM unit of work is recorded automatically, this is for
+    bulk inserts and Core or Query updates.
+
+    The changes are written by a before_commit hook, which takes a
+    transaction level lock first and holds it through the commit, so
+    changes commit in seq order while writers only wait on each other for
+    the end of their transactions. A client that has seen seq N never
+    misses a change with a lower seq committed later. Waiters in every
+    process are woken with a NOTIFY, which postgres delivers when the
+    transaction commits.
+
+    :param ids: The changed row ids, or [None] for rows that can't be listed.
+    :param op: "insert", "update" or "delete".
+    """
+    ses.info.setdefault('changes', []).extend(
+        {'table': table, 'row_id': id, 'op': op} for id in ids)
+
+
+@event.listens_for(OrmSession, 'before_commit')
+def _write_changes(ses):
+    # the commit flushes after this hook, its changes have to be seen here
+    ses.flush()
+    changes = ses.info.get('changes')
+    if not changes:
+        return
+
+    ses.execute(select([func.pg_advisory_xact_lock(CHANGES_LOCK)]))
+    ses.execute(Change.__table__.insert(), changes)
+    # repeats in a transaction are sent once
+    ses.execute(select([func.pg_notify(CHANGES_CHANNEL, '')]))
+    del changes[:]
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _flushed_changes(ses, flush_context):
+    modified = [obj for obj in ses.dirty if ses.is_modified(obj)]
+    for op, objs in (('insert', ses.new), ('update', modified),
+                     ('delete', ses.deleted)):
+        ids = collections.defaultdict(list)
+        for obj in objs:
+            if obj.__table__.name in CHANGE_TABLES:
+                ids[obj.__table__.name].append(obj.id)
+
+        for table in sorted(ids):
+            record_changes(ses, table, ids[table], op)
+
+
+def last_change():
+    """Get the seq of the newest change, 0 if there aren't any."""
+    ses = _session()
+    return ses.query(func.coalesce(func.max(Change.seq), 0)).scalar()
+
+
+def get_changes(since, limit=CHANGES_LIMIT, wait=0):
+    """Get the changes after seq `since`, oldest first.
+
+    :param wait: If there aren't any, wait up to this many seconds, at most \
+    CHANGES_WAIT, for one to be committed. The session's transaction is \
+    committed before waiting so it doesn't hold a connection, the process \
+    wide _ChangeListener wakes the waiters.
+    :returns: A list of rows with the Change.json_columns() fields.
+    :raises: DBException if asked to wait inside an enclosing transaction, \
+    which would stay open and keep any locks it holds while waiting.
+    """
+    ses = _session()
+    if wait > 0 and ses.transaction is not None and ses.transaction.nested:
+        raise DBException("Can't wait for changes inside a transaction")
+
+    changes = Change.__table__
+    qry = select(Change.json_columns()).where(changes.c.seq > since) \
+                .order_by(changes.c.seq).limit(limit)
+
+    deadline = time.monotonic() + min(wait, CHANGES_WAIT)
+    rows = ses.execute(qry).fetchall()
+    if rows or deadline <= time.monotonic():
+        return rows
+
+    ses.commit()
+    listener = _get_listener(ses.get_bind().engine)
+    listener.started(deadline - time.monotonic())
+    while True:
+        # counting wakeups before the query, so a change committed since
+        # either shows up in it or ends the wait
+        seen = listener.wakeups
+        rows = ses.execute(qry).fetchall()
+        ses.commit()
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+
+        listener.wait(seen, remaining)
+
+
+class _ChangeListener:
+    """LISTENs on CHANGES_CHANNEL for the whole process. A single thread
+    holds a connection of its own, made outside the engine's pool, and
+    wakes every waiting get_changes call when a notification arrives, so
+    waiters don't hold connections.
+    """
+    RETRY = 1 # seconds between reconnects, and between polls while down
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.listening = False
+        # waiters wait for this to change
+        self.wakeups = 0
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self.run, name='change listener')
+        thread.daemon = True
+        thread.start()
+
+
+    def connect(self):
+        cargs, cparams = self.engine.dialect.create_connect_args(
+                                                    self.engine.url)
+        conn = self.engine.dialect.connect(*cargs, **cparams)
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute('LISTEN ' + CHANGES_CHANNEL)
+            cursor.close()
+        except Exception:
+            conn.close()
+            raise
+
+        return conn
+
+
+    def run(self):
+        while True:
+            try:
+                conn = self.connect()
+            except Exception:
+                time.sleep(self.RETRY)
+                continue
+
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(conn, selectors.EVENT_READ)
+                    # anything committed while reconnecting went unheard
+                    self.wake(listening=True)
+                    while True:
+                        selector.select()
+                        conn.poll()
+                        if conn.notifies:
+                            del conn.notifies[:]
+                            self.wake(listening=True)
+
+            except Exception:
+                pass
+
+            finally:
+                conn.close()
+
+            self.wake(listening=False)
+            time.sleep(self.RETRY)
+
+
+    def wake(self, listening):
+        with self.condition:
+            self.listening = listening
+            self.wakeups += 1
+            self.condition.notify_all()
+
+
+    def started(self, timeout):
+        """Wait up to timeout seconds for the LISTEN to be in place."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.listening, timeout)
+
+
+    def wait(self, seen, timeout):
+        """Wait up to timeout seconds for a wakeup after the first `seen`.
+        Without a LISTEN in place the caller is woken every RETRY seconds
+        to poll.
+        """
+        with self.condition:
+            if not self.listening:
+                timeout = min(timeout, self.RETRY)
+            self.condition.wait_for(lambda: self.wakeups != seen, timeout)
+
+
+_listener = None
+
+def _get_listener(engine):
+    """Start the change listener on first use, after gevent has had a chance
+    to monkey patch threading.
+    """
+    global _listener
+    if _listener is None or _listener.engine is not engine:
+        _listener = _ChangeListener(engine)
+
+    return _listener
+
+###############################################################################
+
+class Page(list):
+    """A list of results with cursor tokens for the previous and next pages.
+    Either token is None when there is no such page.
+    """
+    def __init__(self, rows, prev=None, next=None):
+        super().__init__(rows)
+        self.prev = prev
+        self.next = next
+
+
+def _seek(order, values, reverse=False):
+    """Build the WHERE clause that seeks past the row with `values`.
+
+    Postgres sorts nulls as larger than any value, last when ascending and
+    first when descending, so nullable columns get their own comparisons.
+    """
+    def past(col, descending, value):
+        if descending == reverse:
+            # ascending, the nulls come after every value
+            if value is None:
+                return false()
+            if col.nullable:
+                return or_(col > value, col.is_(None))
+            return col > value
+        if value is None:
+            return col.isnot(None)
+        return col < value
+
+    def equal(col, value):
+        return col.is_(None) if value is None else col == value
+
+    directions = set(descending for col, descending in order)
+    if len(directions) == 1 and not any(col.nullable for col, d in order):
+        # a row value comparison, which can use a multi column index
+        cols = tuple_(*[col for col, descending in order])
+        descending = directions.pop()
+        if descending == reverse:
+            return cols > tuple_(*values)
+        return cols < tuple_(*values)
+
+    clauses = []
+    for idx, (col, descending) in enumerate(order):
+        equals = [equal(c, v) for (c, d), v in zip(order[:idx], values)]
+        clauses.append(and_(*(equals + [past(col, descending, values[idx])])))
+
+    return or_(*clauses)
+
+
+def _filter(qry, clause):
+    # ORM queries have filter, Core selects have where
+    return qry.filter(clause) if isinstance(qry, Query) else qry.where(clause)
+
+
+def _all(qry):
+    if isinstance(qry, Query):
+        return qry.all()
+    return _session().execute(qry).fetchall()
+
+
+def keyset(qry, order, token=None, reverse=False):
+    """Order qry by `order` and seek past the row in the cursor `token`.
+
+    :param order: See paginate.
+    :param token: A cursor token or None to start at the beginning.
+    :param reverse: Seek and order backwards, towards the beginning.
+    :raises: ValueError if the cursor token is invalid.
+    """
+    if token is not None:
+        values = util.decode_cursor(token)
+        if len(values) != len(order):
+            raise ValueError("Invalid cursor")
+        qry = _filter(qry, _seek(order, values, reverse))
+
+    for col, descending in order:
+        qry = qry.order_by(desc(col) if descending != reverse else asc(col))
+
+    return qry
+
+
+def cursor(row, order):
+    """Make the cursor token for row, which must have the order columns."""
+    return util.encode_cursor([getattr(row, col.key) for col, descending
+                                in order])
+
+
+def paginate(qry, order, limit=None, after=None, before=None, offset=0):
+    """Keyset pagination. Rather than an OFFSET, a page starts by seeking
+    past the last row of the previous page, so every page costs the same.
+
+    :param qry: A query, ORM or column based, or a Core select.
+    :param order: A list of (column, descending) pairs that must uniquely \
+    order the rows, so end it with the primary key. Nullable columns \
+    are sorted the way postgres does, nulls last when ascending.
+    :param limit: The page size, None for every row.
+    :param after: A cursor token, get the page following it.
+    :param before: A cursor token, get the page preceding it.
+    :param offset: Rows to skip, only for clients that predate cursors.
+
+    :returns: A Page
+    :raises: ValueError if a cursor token is invalid.
+    """
+    reverse = before is not None
+    token = before if reverse else after
+    qry = keyset(qry, order, token, reverse)
+
+    if limit is not None:
+        # fetch an extra row to find out if there is another page
+        qry = qry.limit(limit + 1)
+
+    if offset:
+        qry = qry.offset(offset)
+
+    rows = _all(qry)
+    more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+
+    if reverse:
+        rows.reverse()
+        prev = cursor(rows[0], order) if rows and more else None
+        next = cursor(rows[-1], order) if rows else None
+    else:
+        prev = cursor(rows[0], order) if rows and token is not None else None
+        next = cursor(rows[-1], order) if rows and more else None
+
+    return Page(rows, prev, next)
+
 ###############################################################################
 
 def get_accounts(limit=None, offset=0):
@@ -79,10 +648,20 @@ def get_accounts(limit=None, offset=0):
             .limit(limit).offset(offset).all()
 
 
-def get_account(account_id):
-    """Get the account with `account_id`."""
+def get_account(account_id, eager=False):
+    """Get the account with `account_id`.
+
+    :param eager: Also load the balance, posts and the posts' journal \
+    entries, for rendering the ledger.
+    """
     ses = _session()
-    return ses.query(Account).get(account_id)
+    qry = ses.query(Account)
+    if eager:
+        qry = qry.options(joinedload(Account.totals),
+                          subqueryload(Account.posts)
+                            .joinedload('journal'))
+
+    return qry.get(account_id)
 
 
 def get_account_by_name(name):
@@ -126,12 +705,91 @@ def new_account(name, desc):
         ses.rollback()
         raise
 
+
+# process wide cache of (version, directory), see account_directory
+_accounts = None
+
+def account_directory(refresh=False):
+    """Get the account directory, a (names, closed) tuple where names is a
+    dict of name, id pairs and closed is a set of closed account ids. The
+    directory is cached for the whole process against the accounts table
+    version, which is checked once per transaction, so accounts changed by
+    other processes are picked up too.
+
+    A transaction that has changed accounts itself gets a directory read
+    just for it, only committed state is cached.
+
+    :param refresh: Check the table version again in this transaction.
+    """
+    global _accounts
+    ses = _session()
+    # pending account changes count as touched once flushed
+    ses.flush()
+    own = Account.__tablename__ in ses.info.get('touched', ())
+    directory = ses.info.get('accounts')
+    if directory is not None and not refresh and not own:
+        return directory
+
+    version = table_version(Account.__tablename__)
+    cached = _accounts
+    if not own and cached is not None and cached[0] == version:
+        directory = cached[1]
+    else:
+        names = {}
+        closed = set()
+        for id, name, is_closed in ses.query(Account.id, Account.name,
+                                                Account.closed):
+            names[name] = id
+            if is_closed:
+                closed.add(id)
+
+        directory = (names, closed)
+        if own:
+            return directory
+
+        # a change committed between the two reads makes this entry stale
+        # under the old version, the next check just reloads it
+        _accounts = (version, directory)
+
+    ses.info['accounts'] = directory
+    return directory
+
+
+def invalidate_accounts():
+    """Drop the cached account directory, it is reloaded on next use."""
+    global _accounts
+    _accounts = None
+
+
+def _account_id(name):
+    """Look up an account id by name. The directory is reloaded once on a
+    miss, the account may have been created by another process.
+
+    :raises: KeyError if there is no account named `name`.
+    """
+    names, closed = account_directory()
+    if name not in names:
+        names, closed = account_directory(refresh=True)
+
+    return names[name]
+
 ###############################################################################
 
-def get_batch(id):
-    """Get batch with id."""
+def get_batch(id, eager=False):
+    """Get batch with id.
+
+    :param eager: Also load the user and the journal entries with their \
+    posts, for rendering.
+    """
     ses = _session()
-    return ses.query(Batch).get(id)
+    qry = ses.query(Batch)
+    if eager:
+        qry = qry.options(joinedload(Batch.user),
+                          subqueryload('journal')
+                            .subqueryload(Journal.posts)
+                            .joinedload('account'))
+
+    return qry.get(id)
 
 
 def new_batch(user_id):
@@ -146,18 +804,36 @@ def new_batch(user_id):
 
 ###############################################################################
 
-def get_journals(limit=None, offset=0):
-    """Get journal entries with limit and offset."""
+def get_journals(limit=None, after=None, before=None, eager=False):
+    """Get a page of journal entries, newest first.
+
+    :param limit: The page size, None for every entry.
+    :param after: A cursor token from a previous page, see paginate.
+    :param before: A cursor token from a previous page, see paginate.
+    :param eager: Also load the posts and their accounts, see JOURNAL_POSTS.
 
+    :returns: A Page of Journal instances.
+    """
     ses = _session()
-    return ses.query(Journal).order_by(desc(Journal.datetime))\
-        .limit(limit).offset(offset).all()
+    qry = ses.query(Journal)
+    if eager:
+        qry = qry.options(*JOURNAL_POSTS)
+
+    order = [(Journal.datetime, True), (Journal.id, True)]
+    return paginate(qry, order, limit, after, before)
+
 
+def get_journal(id, eager=False):
+    """Get journal entry with id.
 
-def get_journal(id):
-    """Get journal entry with id."""
+    :param eager: Also load the posts and their accounts, see JOURNAL_POSTS.
+    """
     ses = _session()
-    return ses.query(Journal).get(id)
+    qry = ses.query(Journal)
+    if eager:
+        qry = qry.options(*JOURNAL_POSTS)
+
+    return qry.get(id)
 
 ###############################################################################
 
@@ -169,22 +845,60 @@ def posts(account_id):
 
 ###############################################################################
 
-def new_transaction(batch, posts=None, datetime=None, memo=None):
-    """Create a new transaction.
+def _lock_imports(ses, posts):
+    """Load and lock the imported transactions referenced by posts with one
+    SELECT ... FOR UPDATE. Anyone else posting them waits for this
+    transaction to finish, then sees them as posted. The rows are locked in
+    id order so two overlapping bulk posts can't deadlock.
+
+    :param posts: An iterable of post dicts, from any number of entries.
+    :returns: A dict of id, ImportedTransaction pairs.
+    """
+    ids = set()
+    for p in posts:
+        if isinstance(p, dict) and p.get('id'):
+            ids.add(p['id'])
+
+    if not ids:
+        return {}
+
+    qry = ses.query(ImportedTransaction) \
+                .filter(ImportedTransaction.id.in_(ids)) \
+                .order_by(ImportedTransaction.id) \
+                .with_for_update().populate_existing()
+    return {imp.id: imp for imp in qry}
+
+
+def _mark_posted(ses, imports, ids):
+    """Mark the imported transactions with `ids` as posted, in one UPDATE."""
+    if not ids:
+        return
+
+    ses.query(ImportedTransaction) \
+        .filter(ImportedTransaction.id.in_(ids)) \
+        .update({ImportedTransaction.posted: True},
+                synchronize_session=False)
+    touch(ses, ImportedTransaction.__tablename__)
+    record_changes(ses, ImportedTransaction.__tablename__, ids, 'update')
+
+    for id in ids:
+        ses.expire(imports[id], ['posted'])
+
+
+def _new_posts(ses, posts, memo, imports, posted):
+    """Validate the posts of a journal entry and create Posting instances
+    for them.
 
-    :param batch: The current batch.
     :param posts: An iterable of dicts with transaction data.
-    :param datetime: A datetime.datetime obj. If None, the current date and \
-    time will be used.
     :param memo: Memo for the journal entry.
+    :param imports: The imported transactions referenced by posts, from \
+    _lock_imports.
+    :param posted: A set of imported transaction ids posted by earlier \
+    entries. The ids this entry posts are added if it is valid.
 
-    :returns: A Journal instance
+    :returns: A list of Posting instances, not yet added to the session.
+    :raises: RecordSheet.dbapi.DBException if the entry is invalid.
     """
-    ses = _session()
-    # dictionary of name, id pairs
-    accounts = dict(ses.query(Account.name, Account.id).all())
-    closed = set(zip(*ses.query(Account.id).filter(Account.closed==True)))
-
     try:
         #length test
         if not posts or len(posts) < 2:
@@ -195,6 +909,7 @@ def new_transaction(batch, posts=None, datetime=None, memo=None):
             raise DBException("Journal memo field must not be empty")
 
         _posts = []
+        _posted = set()
         total = 0
         for p in posts:
             total += Decimal(p['amount'])
@@ -202,15 +917,20 @@ def new_transaction(batch, posts=None, datetime=None, memo=None):
                 raise DBException("Account can not be null or Empty")
 
             if isinstance(p['account_id'], str):
-                p['account_id'] = accounts[p['account_id']]
+                p['account_id'] = _account_id(p['account_id'])
 
-            if p['account_id'] in closed:
-                raise DBException("Account {} is closed")
+            if p['account_id'] in account_directory()[1]:
+                raise DBException("Account {} is closed"
+                                    .format(p['account_id']))
 
             # copy fields from the related imported transaction
             if 'id' in p and p['id']:
-                imp = ses.query(ImportedTransaction).get(p['id'])
-                if imp.posted:
+                imp = imports.get(p['id'])
+                if imp is None:
+                    raise DBException("Imported Tranaction {} doesn't exist"
+                                        .format(p['id']))
+
+                if imp.posted or imp.id in posted or imp.id in _posted:
                     raise DBException("Imported Tranaction {} is already "
                                         "posted".format(imp.id))
                 post = Posting()
@@ -219,7 +939,7 @@ def new_transaction(batch, posts=None, datetime=None, memo=None):
                 post.fitid = p['fitid']
                 post.memo = p['memo'] or imp.memo
                 post.ref = p['ref']
-                imp.posted = True
+                _posted.add(imp.id)
                 _posts.append(post)
 
             else:
@@ -232,6 +952,30 @@ def new_transaction(batch, posts=None, datetime=None, memo=None):
         if total != 0:
             raise DBException("Posts must sum to zero")
 
+        posted.update(_posted)
+        return _posts
+
+    except KeyError:
+        raise DBException("Missing Item")
+
+
+def new_transaction(batch, posts=None, datetime=None, memo=None):
+    """Create a new transaction.
+
+    :param batch: The current batch.
+    :param posts: An iterable of dicts with transaction data.
+    :param datetime: A datetime.datetime obj. If None, the current date and \
+    time will be used.
+    :param memo: Memo for the journal entry.
+
+    :returns: A Journal instance
+    """
+    ses = _session()
+    try:
+        imports = _lock_imports(ses, posts or [])
+        posted = set()
+        _posts = _new_posts(ses, posts, memo, imports, posted)
+
         # create the actual posts and add them to the session
         # this is done seperately because a query after objects have been
         # added to the session will trigger a flush. Not world ending, but
@@ -242,12 +986,127 @@ def new_transaction(batch, posts=None, datetime=None, memo=None):
             post.journal = journal
             ses.add(post)
 
+        _mark_posted(ses, imports, posted)
+        ses.flush()
+        _update_balances(ses, [journal.id])
         ses.commit()
         return journal
 
-    except KeyError:
+    except Exception:
         ses.rollback()
-        raise DBException("Missing Item")
+        raise
+
+
+def new_transactions(batch, entries):
+    """Create many transactions at once. Every entry is validated before
+    anything is inserted, then the journal entries and their posts are bulk
+    inserted in a single database transaction.
+
+    :param batch: The current batch.
+    :param entries: An iterable of dicts with posts, datetime and memo \
+    keys, the same as the arguments to new_transaction.
+
+    :returns: A list of journal entry ids in the same order as entries.
+    :raises: RecordSheet.dbapi.EntryError if any of the entries are invalid, \
+    nothing is inserted.
+    """
+    ses = _session()
+    try:
+        entries = list(entries)
+        wellformed = [isinstance(entry, dict) and
+                      isinstance(entry.get('posts'), list)
+                      for entry in entries]
+        imports = _lock_imports(ses, (p for entry, ok in zip(entries,
+                                                             wellformed)
+                                        if ok for p in entry['posts']))
+        posted = set()
+        checked = []
+        errors = {}
+        for idx, entry in enumerate(entries):
+            if not wellformed[idx]:
+                errors[idx] = 'Entries must be objects with a list of posts'
+                continue
+
+            try:
+                memo = entry.get('memo')
+                posts = _new_posts(ses, entry['posts'], memo, imports,
+                                    posted)
+                checked.append((entry.get('datetime') or None, memo, posts))
+
+            except DBException as exc:
+                errors[idx] = str(exc)
+
+        if errors:
+            raise EntryError(errors)
+
+        if not checked:
+            return []
+
+        _mark_posted(ses, imports, posted)
+        ses.add(batch)
+        ses.flush()
+        # postgres doesn't promise RETURNING rows in VALUES order, so the
+        # ids are taken from the sequence first and inserted explicitly
+        seq = func.pg_get_serial_sequence(Journal.__tablename__, 'id')
+        ids = [row[0] for row in ses.execute(
+                    select([func.nextval(seq)])
+                    .select_from(func.generate_series(1, len(checked))))]
+        journals = [{'id': journal_id,
+                     'datetime': func.now() if datetime is None else datetime,
+                     'memo': memo,
+                     'void': False,
+                     'batch_id': batch.id}
+                    for journal_id, (datetime, memo, posts)
+                    in zip(ids, checked)]
+        ses.execute(Journal.__table__.insert().values(journals))
+
+        rows = []
+        for journal_id, (datetime, memo, posts) in zip(ids, checked):
+            for post in posts:
+                rows.append({'journal_id': journal_id,
+                             'account_id': post.account_id,
+                             'amount': post.amount,
+                             'fitid': post.fitid,
+                             'ref': post.ref,
+                             'memo': post.memo})
+
+        # all the rows have the same keys so this is a single executemany
+        ses.bulk_insert_mappings(Posting, rows)
+        touch(ses, Journal.__tablename__, Posting.__tablename__)
+        record_changes(ses, Journal.__tablename__, ids, 'insert')
+        _update_balances(ses, ids)
+        ses.commit()
+        return ids
+
+    except Exception:
+        ses.rollback()
+        raise
+
+
+def void_transaction(journal_id):
+    """Void the journal entry with `journal_id`. The posts of a void entry
+    are removed from the account balances.
+
+    :returns: The Journal instance
+    :raises: RecordSheet.dbapi.DBException if the entry doesn't exist or is \
+    already void.
+    """
+    ses = _session()
+    try:
+        journal = ses.query(Journal).get(journal_id)
+        if journal is None:
+            raise DBException("Journal entry {} doesn't exist"
+                                .format(journal_id))
+
+        if journal.void:
+            raise DBException("Journal entry {} is already void"
+                                .format(journal_id))
+
+        journal.void = True
+        ses.flush()
+        _update_balances(ses, [journal.id], sign=-1)
+        ses.commit()
+        return journal
 
     except Exception:
         ses.rollback()
@@ -255,36 +1114,295 @@ def new_transaction(batch, posts=None, datetime=None, memo=None):
 
 ###############################################################################
 
-def get_imported_transactions(limit=None, offset=0):
-    """Get imported transactions with limit and offset"""
+def _update_balances(ses, journal_ids, sign=1):
+    """Apply the posts of the journal entries with `journal_ids` to the
+    stored account balances. The entries must already be flushed. This does
+    not commit, so the balances change in the same transaction as the posts.
+
+    :param journal_ids: A list of journal entry ids.
+    :param sign: 1 to add the posts, -1 to remove them. Removing posts \
+    looks up the last_datetime of the affected accounts again.
+    """
+    amount = Posting.amount
+    totals = ses.query(Posting.account_id.label('account_id'),
+                       func.sum(amount).label('amount'),
+                       func.coalesce(func.sum(case([(amount < 0, -amount)])),
+                                     0).label('debits'),
+                       func.coalesce(func.sum(case([(amount > 0, amount)])),
+                                     0).label('credits'),
+                       func.count(Posting.id).label('count'),
+                       func.max(Journal.datetime).label('datetime')) \
+                .join(Journal) \
+                .filter(Journal.id.in_(journal_ids)) \
+                .group_by(Posting.account_id).subquery()
+
+    # accounts created before balances existed won't have a row
+    missing = ses.query(totals.c.account_id) \
+                .outerjoin(AccountBalance,
+                            AccountBalance.account_id==totals.c.account_id) \
+                .filter(AccountBalance.account_id == None)
+    ses.bulk_insert_mappings(AccountBalance,
+            [{'account_id': account_id, 'balance': 0, 'debits': 0,
+              'credits': 0, 'post_count': 0}
+                for account_id, in missing])
+
+    bal = AccountBalance.__table__
+    values = {bal.c.balance: bal.c.balance + sign * totals.c.amount,
+              bal.c.debits: bal.c.debits + sign * totals.c.debits,
+              bal.c.credits: bal.c.credits + sign * totals.c.credits,
+              bal.c.post_count: bal.c.post_count + sign * totals.c.count}
+    last = bal.c.last_datetime
+    if sign > 0:
+        values[last] = case([(or_(last == None, last < totals.c.datetime),
+                                totals.c.datetime)], else_=last)
+    else:
+        # voids are rare, look the newest entry left up with the index on
+        # posts.account_id
+        values[last] = select([func.max(Journal.datetime)]) \
+                        .select_from(Posting.__table__.join(Journal.__table__)) \
+                        .where(Posting.account_id == bal.c.account_id) \
+                        .where(Journal.void.isnot(True)).as_scalar()
+
+    ses.execute(bal.update().values(values)
+                    .where(bal.c.account_id==totals.c.account_id))
+    touch(ses, AccountBalance.__tablename__)
+
+    # the update bypassed the session, don't let it hand out stale balances
+    for obj in list(ses.identity_map.values()):
+        if isinstance(obj, AccountBalance):
+            ses.expire(obj)
+
+
+def _balance_totals(ses):
+    """Query (account_id, balance, debits, credits, post_count, \
+    last_datetime) for every account, computed from the posts of entries \
+    that aren't void.
+    """
+    live = ses.query(Posting.account_id, Posting.amount, Journal.datetime) \
+                .join(Journal).filter(Journal.void.isnot(True)).subquery()
+
+    amount = live.c.amount
+    return ses.query(Account.id,
+                     func.coalesce(func.sum(amount), 0),
+                     func.coalesce(func.sum(case([(amount < 0, -amount)])), 0),
+                     func.coalesce(func.sum(case([(amount > 0, amount)])), 0),
+                     func.count(amount),
+                     func.max(live.c.datetime)) \
+                .outerjoin(live, live.c.account_id==Account.id) \
+                .group_by(Account.id)
+
+
+def account_balances(as_of=None, prefix=None, include_closed=False):
+    """Summarize the activity of accounts. The current balances are read
+    from the stored account balances, balances as of a past datetime are
+    summed from the posts in one aggregate query. Posts of void journal
+    entries aren't counted.
+
+    :param as_of: Only count journal entries up to and including this \
+    datetime, None for all of them.
+    :param prefix: Only include the account with this name and the \
+    accounts under it, eg. "ACME" includes "ACME:ASSETS:BANK".
+    :param include_closed: Include closed accounts.
+
+    :returns: A list of (account_id, name, closed, balance, debits, \
+    credits, post_count, last_datetime) named tuples ordered by name. \
+    debits and credits are the totals of the negative and positive posts, \
+    both as positive numbers.
+    """
+    ses = _session()
+    if as_of is None:
+        bal = AccountBalance
+        qry = ses.query(Account.id.label('account_id'), Account.name,
+                Account.closed,
+                func.coalesce(bal.balance, 0).label('balance'),
+                func.coalesce(bal.debits, 0).label('debits'),
+                func.coalesce(bal.credits, 0).label('credits'),
+                func.coalesce(bal.post_count, 0).label('post_count'),
+                bal.last_datetime.label('last_datetime')) \
+                .outerjoin(bal, bal.account_id==Account.id) \
+                .order_by(Account.name)
+    else:
+        live = ses.query(Posting.account_id, Posting.amount,
+                         Journal.datetime) \
+                    .join(Journal).filter(Journal.void.isnot(True)) \
+                    .filter(Journal.datetime <= as_of).subquery()
+
+        amount = live.c.amount
+        qry = ses.query(Account.id.label('account_id'), Account.name,
+                Account.closed,
+                func.coalesce(func.sum(amount), 0).label('balance'),
+                func.coalesce(func.sum(case([(amount < 0, -amount)])), 0)
+                    .label('debits'),
+                func.coalesce(func.sum(case([(amount > 0, amount)])), 0)
+                    .label('credits'),
+                func.count(amount).label('post_count'),
+                func.max(live.c.datetime).label('last_datetime')) \
+                .outerjoin(live, live.c.account_id==Account.id) \
+                .group_by(Account.id).order_by(Account.name)
+
+    if prefix:
+        prefix = prefix.upper().rstrip(':')
+        subtree = util.escape_like(prefix) + ':%'
+        qry = qry.filter(or_(Account.name == prefix,
+                             Account.name.like(subtree, escape='\\')))
+
+    if not include_closed:
+        qry = qry.filter(Account.closed.isnot(True))
+
+    return qry.all()
+
+
+def verify_balances():
+    """Compare the stored account balances with the posts table.
+
+    :returns: A list of (account_id, stored, actual) tuples, where stored \
+    and actual are (balance, post_count, debits, credits) tuples, for each \
+    account that doesn't match.
+    """
     ses = _session()
-    sortdir = asc
-    if offset < 0:
-        sortdir = desc
-        offset = abs(offset)
+    stored = {b.account_id: (b.balance, b.post_count, b.debits, b.credits)
+                for b in ses.query(AccountBalance)}
 
-    return ses.query(ImportedTransaction) \
-                .filter(ImportedTransaction.posted != True) \
-                .order_by(sortdir(ImportedTransaction.datetime)) \
-                .limit(limit).offset(offset).all()
+    mismatched = []
+    for account_id, balance, debits, credits, count, last \
+            in _balance_totals(ses):
+        actual = (balance, count, debits, credits)
+        if stored.get(account_id) != actual:
+            mismatched.append((account_id, stored.get(account_id), actual))
 
+    return mismatched
+
+
+def rebuild_balances():
+    """Recompute every stored account balance from the posts table."""
+    ses = _session()
+    try:
+        totals = [{'account_id': account_id, 'balance': balance,
+                   'debits': debits, 'credits': credits,
+                   'post_count': count, 'last_datetime': last}
+                    for account_id, balance, debits, credits, count, last
+                    in _balance_totals(ses)]
+
+        ses.query(AccountBalance).delete(synchronize_session='fetch')
+        ses.bulk_insert_mappings(AccountBalance, totals)
+        touch(ses, AccountBalance.__tablename__)
+        ses.commit()
+
+    except Exception:
+        ses.rollback()
+        raise
+
+###############################################################################
+
+EXPORT_CHUNK = 1000 # rows fetched from the server side cursor at a time
+EXPORT_COLUMNS = ('datetime', 'journal_id', 'batch_id', 'journal_memo',
+                  'account', 'memo', 'ref', 'amount', 'balance')
+
+def export_posts(account_id=None, start=None, end=None):
+    """Query posts for exporting, oldest first, with the running balance of
+    each post's account. Void entries are left out. The rows are streamed
+    from a server side cursor EXPORT_CHUNK at a time, so memory use doesn't
+    grow with the number of posts.
+
+    :param account_id: Only export the posts of this account.
+    :param start: Only export journal entries from this datetime on.
+    :param end: Only export journal entries up to and including this \
+    datetime.
+
+    :returns: An iterable of named tuples with the EXPORT_COLUMNS fields.
+    """
+    ses = _session()
+    order = (Journal.datetime, Journal.id, Posting.id)
+    balance = func.sum(Posting.amount).over(partition_by=Posting.account_id,
+                                            order_by=order)
+    posts = ses.query(Journal.datetime,
+                      Journal.id.label('journal_id'),
+                      Journal.batch_id,
+                      Journal.memo.label('journal_memo'),
+                      Account.name.label('account'),
+                      Posting.memo,
+                      Posting.ref,
+                      Posting.amount,
+                      balance.label('balance'),
+                      Posting.id.label('post_id')) \
+                .select_from(Posting) \
+                .join(Journal, Journal.id==Posting.journal_id) \
+                .join(Account, Account.id==Posting.account_id) \
+                .filter(Journal.void.isnot(True))
+
+    if account_id is not None:
+        posts = posts.filter(Posting.account_id==account_id)
+
+    # the date range is applied outside the window, so the balances
+    # include the posts before start
+    posts = posts.subquery()
+    qry = ses.query(*[posts.c[name] for name in EXPORT_COLUMNS]) \
+                .order_by(posts.c.datetime, posts.c.journal_id,
+                          posts.c.post_id)
+    if start is not None:
+        qry = qry.filter(posts.c.datetime >= start)
+    if end is not None:
+        qry = qry.filter(posts.c.datetime <= end)
+
+    return qry.yield_per(EXPORT_CHUNK)
+
+###############################################################################
+
+def get_imported_transactions(limit=None, after=None, before=None):
+    """Get a page of imported transactions that haven't been posted, oldest
+    first.
+
+    :param limit: The page size, None for every transaction.
+    :param after: A cursor token from a previous page, see paginate.
+    :param before: A cursor token from a previous page, see paginate.
+
+    :returns: A Page of ImportedTransaction instances.
+    """
+    ses = _session()
+    qry = ses.query(ImportedTransaction) \
+                .filter(ImportedTransaction.posted.isnot(True))
+    order = [(ImportedTransaction.datetime, False),
+             (ImportedTransaction.id, False)]
+    return paginate(qry, order, limit, after, before)
 
-def insert_imported_transactions(transactions):
+
+IMPORT_CHUNK = 1000 # rows per insert in insert_imported_transactions
+
+def insert_imported_transactions(transactions, chunk_size=IMPORT_CHUNK):
     """Bulk insert of imported transaction data into database.
 
+    Transactions are inserted in chunks of `chunk_size`, each a single
+    INSERT that skips tids already in the database, so the cost doesn't
+    grow with the number of transactions imported in the past and
+    concurrent imports of the same file can't both insert a transaction.
+    Every chunk is committed together, so call this once per chunk for
+    long imports.
+
     :param transactions: iterable of dicts. The keys of each dict represent \
     attributes of an ImportedTransaction object and must contain valid values.
+    :returns: An (inserted, skipped) tuple of counts. Transactions that were \
+    already imported, or are repeated in `transactions`, are skipped.
     """
-
+    inserted = skipped = 0
     try:
         ses = _session()
-        # filter out dups
-        tids = set([r[0] for r in ses.query(ImportedTransaction.tid)])
-        trs = (trs for trs in transactions if trs['tid'] not in tids)
+        table = ImportedTransaction.__table__
+        for chunk in util.chunked(transactions, chunk_size):
+            # repeats in the chunk conflict with the first copy, rows
+            # without a tid never conflict
+            stmt = pg_insert(table).values(chunk) \
+                        .on_conflict_do_nothing(index_elements=['tid']) \
+                        .returning(table.c.id)
+            ids = [id for id, in ses.execute(stmt)]
+            if ids:
+                touch(ses, ImportedTransaction.__tablename__)
+                record_changes(ses, ImportedTransaction.__tablename__, ids,
+                               'insert')
+            inserted += len(ids)
+            skipped += len(chunk) - len(ids)
 
-        # bulk insert
-        ses.bulk_insert_mappings(ImportedTransaction, trs)
         ses.commit()
+        return inserted, skipped
 
     except Exception:
         ses.rollback()
@@ -292,6 +1410,106 @@ def insert_imported_transactions(transactions):
 
 ###############################################################################
 
+IMPORT_WORKERS = 2 # imports running in the background at once
+IMPORT_ERROR_LEN = ImportJob.error.type.length
+IMPORT_FILENAME_LEN = ImportJob.filename.type.length
+
+_import_pool = None
+
+def _get_import_pool():
+    """Create the import pool on first use, after gevent has had a chance to
+    monkey patch threading.
+    """
+    global _import_pool
+    if _import_pool is None:
+        _import_pool = util.native_executor(IMPORT_WORKERS)
+
+    return _import_pool
+
+
+def new_import_job(transactions, filename=None, file_format=None,
+                   fileobj=None):
+    """Import transactions in the background.
+
+    :param transactions: iterable of dicts, as for \
+    insert_imported_transactions. It is consumed on the import pool, so a \
+    generator parsing an upload lazily moves the parsing there too.
+    :param filename: The name of the uploaded file, for display. Long names \
+    are cut to IMPORT_FILENAME_LEN characters.
+    :param file_format: The mport.formats key of the parser, for display.
+    :param fileobj: The file transactions reads from, if any. The job owns \
+    it and closes it when it ends.
+    :returns: The queued ImportJob. Poll it with get_import_job.
+    """
+    ses = _session()
+    try:
+        job = ImportJob(filename=filename and filename[:IMPORT_FILENAME_LEN],
+                        file_format=file_format)
+        ses.add(job)
+        ses.commit()
+        _get_import_pool().submit(run_import_job, job.id, transactions,
+                                  fileobj=fileobj)
+    except Exception:
+        ses.rollback()
+        if fileobj is not None:
+            fileobj.close()
+        raise
+
+    return job
+
+
+def run_import_job(job_id, transactions, chunk_size=IMPORT_CHUNK,
+                   fileobj=None):
+    """Run an import job, committing the inserted transactions and the job's
+    counters after every chunk. new_import_job calls this on the import
+    pool. A failure leaves the chunks committed before it in place, running
+    the import again skips them as duplicates.
+
+    :param fileobj: A file to close when the job ends, see new_import_job.
+    """
+    ses = _session()
+    start = time.monotonic()
+    try:
+        job = ses.query(ImportJob).get(job_id)
+        job.status = 'running'
+        ses.commit()
+        try:
+            for chunk in util.chunked(transactions, chunk_size):
+                inserted, skipped = insert_imported_transactions(chunk,
+                                                                 chunk_size)
+                job.parsed += len(chunk)
+                job.inserted += inserted
+                job.duplicates += skipped
+                job.elapsed = time.monotonic() - start
+                ses.commit()
+            job.status = 'done'
+
+        except Exception as exc:
+            ses.rollback()
+            job.status = 'failed'
+            job.error = (str(exc) or type(exc).__name__)[:IMPORT_ERROR_LEN]
+
+        job.elapsed = time.monotonic() - start
+        job.finished = func.now()
+        ses.commit()
+
+    except Exception:
+        ses.rollback()
+        raise
+
+    finally:
+        if fileobj is not None:
+            fileobj.close()
+        remove_session()
+
+
+def get_import_job(id):
+    """Get the ImportJob with `id`, None if there isn't one."""
+    ses = _session()
+    return ses.query(ImportJob).get(id)
+
+###############################################################################
+
 def get_users():
     """Get a list of all users."""
     ses = _session()
@@ -315,9 +1533,12 @@ def get_user_by_username(username):
 
 
 def login(username, password):
-    """Login the user with username and password.
+    """Login the user with username and password. The password is hashed on
+    the hash pool, see run_hash, and is rehashed if the stored hash uses
+    old parameters.
 
-    :returns: (user or None, success)
+    :returns: (user or None, success) where success is one of 'SUCCESS', \
+    'USERPASS', 'LOCKED' or 'BUSY' if the hash pool is full.
     """
     ses = _session()
     user = get_user_by_username(username)
@@ -332,9 +1553,21 @@ def login(username, password):
 
         return user, 'LOCKED'
 
-    if compare_pw(password, user.password):
+    try:
+        success = run_hash(compare_pw, password, user.password)
+    except BusyError:
+        ses.rollback()
+        return user, 'BUSY'
+
+    if success:
         user.last_login = user.last_attempt
         user.fail_count = 0
+        if needs_rehash(user.password):
+            try:
+                user.password = run_hash(new_pw_hash, password)
+            except BusyError:
+                pass # try again next time
+
         ses.commit()
 
         return user, 'SUCCESS'
@@ -346,14 +1579,18 @@ def authenticate(user_id, password):
     """Authenticate the user with `id`  with `password`.
 
     :returns: True if the password is correct, otherwise False
+    :raises: RecordSheet.dbapi.BusyError if the hash pool is full.
 
     .. note:: This function is for authentication only and is not intended \
     for logins.
     """
     try:
         ses = _session()
-        user = get_user_by_username(username)
-        return compare_pw(password, user.password)
+        user = get_user(user_id)
+        if user is None:
+            return False
+
+        return run_hash(compare_pw, password, user.password)
 
     except SQLAlchemyError:
         ses.rollback()
@@ -367,10 +1604,11 @@ def set_password(user_id, password):
     :type id: int
     :param password: The plaintext of the password
     :type password: str or bytes
+    :raises: RecordSheet.dbapi.BusyError if the hash pool is full.
     """
     ses = _session()
     user = ses.query(User).get(user_id)
-    user.password = new_pw_hash(password)
+    user.password = run_hash(new_pw_hash, password)
 
     ses.commit()
 
@@ -379,37 +1617,109 @@ def set_password(user_id, password):
 PW_MAX = 1024 # MAX password length
 SALT_LEN = 512 # size of salt in bytes
 HASH = 'sha512' # the hash
-HASH_ROUNDS = 100000 # the number of rounds to hash
+HASH_ROUNDS = 100000 # the number of rounds to hash, see OPTIONS['pw_rounds']
+# hashes are stored as PW_PREFIX + b"<hash>$<rounds>$<salt length>$" followed
+# by the salt and the derived key.
+PW_PREFIX = b'$pbkdf2-'
+# parameters of hashes stored before the parameters were
+LEGACY_PARAMS = ('sha512', 100000, 512)
 
-def new_pw_hash(plaintext):
-    """Hash the plaintext using pbkdf2 with a randomly generated salt.
+HASH_WORKERS = 2 # threads hashing passwords
+HASH_QUEUE = 8 # max hashes running or waiting before BusyError
 
-    :returns: bytes(salt + hash)
-    """
+def _encode_plaintext(plaintext):
     # truncate the plaintext to PW_MAX
     plaintext = plaintext[:PW_MAX]
     if not isinstance(plaintext, bytes):
         plaintext = plaintext.encode('utf8')
 
+    return plaintext
+
+
+def _pw_params(hashed):
+    """Split a stored hash into (hash, rounds, salt, derived key)."""
+    if hashed.startswith(PW_PREFIX):
+        empty, scheme, rounds, salt_len, rest = hashed.split(b'$', 4)
+        hash = scheme[len(b'pbkdf2-'):].decode('ascii')
+        salt_len = int(salt_len)
+        return hash, int(rounds), rest[:salt_len], rest[salt_len:]
+
+    hash, rounds, salt_len = LEGACY_PARAMS
+    return hash, rounds, hashed[:salt_len], hashed[salt_len:]
+
+
+def new_pw_hash(plaintext, rounds=None):
+    """Hash the plaintext using pbkdf2 with a randomly generated salt. The
+    hash parameters are stored with it.
+
+    :param rounds: The number of rounds, defaults to OPTIONS['pw_rounds'].
+    :returns: bytes(parameters + salt + hash)
+    """
+    plaintext = _encode_plaintext(plaintext)
+    rounds = rounds or OPTIONS.get('pw_rounds', HASH_ROUNDS)
     salt = os.urandom(SALT_LEN)
-    dk = hashlib.pbkdf2_hmac(HASH, plaintext, salt, HASH_ROUNDS)
-    return salt + dk
+    dk = hashlib.pbkdf2_hmac(HASH, plaintext, salt, rounds)
+    params = '{}${}${}$'.format(HASH, rounds, SALT_LEN).encode('ascii')
+    return PW_PREFIX + params + salt + dk
 
 
 def compare_pw(plaintext, hashed):
-    """Hash plaintext and compare it with hashed. The first SALT_LEN bytes of \
-    hashed are assumed to be the salt.
+    """Hash plaintext with the parameters stored in hashed and compare them.
 
     :returns: True if both hashed values match, False otherwise.
     """
-    plaintext = plaintext[:PW_MAX]
-    if not isinstance(plaintext, bytes):
-            plaintext = plaintext.encode('utf8')
+    plaintext = _encode_plaintext(plaintext)
+    hash, rounds, salt, expected = _pw_params(hashed)
+    dk = hashlib.pbkdf2_hmac(hash, plaintext, salt, rounds)
+
+    return hmac.compare_digest(dk, expected)
 
-    # extract the salt from the first bytes
-    salt = hashed[:SALT_LEN]
-    dk = hashlib.pbkdf2_hmac(HASH, plaintext, salt, HASH_ROUNDS)
 
-    return dk == hashed[SALT_LEN:]
+def needs_rehash(hashed):
+    """True if hashed wasn't made with the current hash parameters."""
+    hash, rounds, salt, dk = _pw_params(hashed)
+    return (not hashed.startswith(PW_PREFIX) or hash != HASH or
+            rounds != OPTIONS.get('pw_rounds', HASH_ROUNDS) or
+            len(salt) != SALT_LEN)
+
+###############################################################################
+
+class BusyError(DBException):
+    """Raised when the password hash pool has no room for more work."""
+    pass
+
+
+_hash_pool = None
+
+def _get_hash_pool():
+    """Create the hash pool on first use, after gevent has had a chance to
+    monkey patch threading.
+
+    :returns: An (executor, semaphore) tuple.
+    """
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = (util.native_executor(HASH_WORKERS),
+                      threading.BoundedSemaphore(HASH_QUEUE))
+
+    return _hash_pool
+
+
+def run_hash(func, *args):
+    """Call func(*args) on a pool of native threads and wait for the result.
+    Password hashing is slow and releases the GIL, so this keeps it from
+    stalling every other greenlet on the gevent server.
+
+    :raises: RecordSheet.dbapi.BusyError if HASH_QUEUE hashes are already \
+    running or waiting.
+    """
+    executor, slots = _get_hash_pool()
+    if not slots.acquire(blocking=False):
+        raise BusyError("Too many password hashes in progress")
+
+    try:
+        return executor.submit(func, *args).result()
+    finally:
+        slots.release()
 
 ###############################################################################
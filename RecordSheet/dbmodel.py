@@ -19,26 +19,96 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import operator
+
+from RecordSheet import util
 
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
-from sqlalchemy import (Boolean, Column, DateTime, Float, Integer, LargeBinary,
-                        Numeric, String, Text, Unicode)
+from sqlalchemy import (BigInteger, Boolean, Column, Date, DateTime, Float,
+                        Integer, LargeBinary, Numeric, String, Text, Time,
+                        Unicode)
 
-from sqlalchemy import create_engine, ForeignKey, func, event, asc, desc, Table
+from sqlalchemy import (create_engine, ForeignKey, func, event, asc, desc,
+                        Index, Table)
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker, validates
 from sqlalchemy.sql import func, select, column, literal_column
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 
 ###############################################################################
 
+def _json_converter(column_type):
+    """Pick the function that makes values of column_type json serializable,
+    or None if the json backend can write them as they are.
+    """
+    if isinstance(column_type, (DateTime, Date, Time)):
+        return util.DATETIME_CONVERTER
+    elif isinstance(column_type, Numeric) and column_type.asdecimal:
+        return util.DECIMAL_CONVERTER
+    return None
+
+
 class JsonMixin:
     """Mix-in that provides a json_obj method to turn sqlalchemy objects
-    into json serializable objects via util.jsonDumps.
+    into json serializable objects via util.jsonDumps. The columns and the
+    conversion each one needs are worked out once per class, so encoding
+    doesn't have to inspect every value in RsJsonEncoder.default.
     """
+    # column names left out of json_obj
+    json_exclude = ()
+
+    @classmethod
+    def json_serializer(cls):
+        """Return a (names, getter, converters) tuple for the serialized
+        columns of this class. getter returns a tuple of those column values
+        from an instance and converters is a sequence of (name, function)
+        pairs for the columns that need converting.
+        """
+        serializer = cls.__dict__.get('_json_serializer')
+        if serializer is None:
+            columns = [c for c in cls.__table__.columns
+                        if c.name not in cls.json_exclude]
+            names = tuple(c.name for c in columns)
+            getter = operator.attrgetter(*names)
+            if len(names) == 1:
+                getter = lambda obj, get=getter: (get(obj),)
+            converters = tuple((c.name, convert) for c, convert in
+                                ((c, _json_converter(c.type)) for c in columns)
+                                if convert is not None)
+            serializer = (names, getter, converters)
+            cls._json_serializer = serializer
+        return serializer
+
+
+    @classmethod
+    def json_columns(cls):
+        """The table columns json_row takes values for, in order. Selecting
+        these with Core gives rows that serialize the same as json_obj,
+        without loading ORM instances.
+        """
+        return [cls.__table__.c[name] for name in cls.json_serializer()[0]]
+
+
+    @classmethod
+    def json_row(cls, values, fields=None):
+        """Turn a sequence of column values, in the order given by
+        json_serializer, into a json serializable dict.
+
+        :param fields: The names of the columns in values, if it's only \
+        some of them. Extra values past the end of fields are ignored.
+        """
+        names, getter, converters = cls.json_serializer()
+        obj = dict(zip(fields or names, values))
+        for name, convert in converters:
+            value = obj.get(name)
+            if value is not None:
+                obj[name] = convert(value)
+        return obj
+
+
     def json_obj(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return self.json_row(self.json_serializer()[1](self))
 
 ###############################################################################
 
@@ -49,8 +119,10 @@ class Posting(Base, JsonMixin):
     #TODO: Add asset type field
     __tablename__ = 'posts'
     id = Column(Integer, primary_key=True)
-    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False)
-    journal_id = Column(Integer, ForeignKey('journal.id'), nullable=False)
+    account_id = Column(Integer, ForeignKey('accounts.id'), nullable=False,
+                        index=True)
+    journal_id = Column(Integer, ForeignKey('journal.id'), nullable=False,
+                        index=True)
     amount = Column(Numeric, default=0)
     fitid = Column(Unicode(length=255))
     ref = Column(Unicode(length=32))
@@ -79,6 +151,11 @@ class ImportedTransaction(Base, JsonMixin):
     # fitid and hashing that would be acceptable. The intention is to prevent
     # the same transactions from being imported more than once.
     tid = Column(String(length=64), unique=True, nullable=True)
+    # the queue of transactions waiting to be posted, oldest first. The
+    # posted predicate has to match get_imported_transactions' exactly.
+    __table_args__ = (Index('ix_imported_transactions_unposted',
+                            'datetime', 'id',
+                            postgresql_where=posted.isnot(True)),)
 
     @property
     def fmt_datetime(self):
@@ -98,11 +175,15 @@ class ImportedTransaction(Base, JsonMixin):
 class Journal(Base, JsonMixin):
     """Represents a single transaction with debits and credits (posts)."""
     __tablename__ = 'journal'
+    # journal entries are listed and paged by (datetime, id)
+    __table_args__ = (Index('ix_journal_datetime_id', 'datetime', 'id'),)
     id = Column(Integer, primary_key=True)
-    datetime = Column(DateTime(timezone=True), default=func.now())
+    datetime = Column(DateTime(timezone=True), default=func.now(),
+                      nullable=False)
     memo = Column(Unicode(length=1024))
     void = Column(Boolean, default=False)
-    batch_id = Column(Integer, ForeignKey('batches.id'), nullable=False)
+    batch_id = Column(Integer, ForeignKey('batches.id'), nullable=False,
+                      index=True)
     posts = relationship('Posting', backref='journal', \
                 order_by=desc(Posting.amount))
 
@@ -131,6 +212,10 @@ class Batch(Base, JsonMixin):
 
 class Account(Base, JsonMixin):
     __tablename__ = 'accounts'
+    # the unique index on name can't serve LIKE 'PREFIX:%' unless the
+    # database uses the C locale, this one can.
+    __table_args__ = (Index('ix_accounts_name_prefix', 'name',
+                        postgresql_ops={'name': 'varchar_pattern_ops'}),)
     id = Column(Integer, primary_key=True)
     # Name is treated as a path with : separators
     # This affords some ease of use to the user at the expense of not
@@ -139,17 +224,98 @@ class Account(Base, JsonMixin):
     desc = Column(Unicode(length=1024), nullable=False, default='')
     closed = Column(Boolean, default=False)
     posts = relationship('Posting', backref='account')
+    totals = relationship('AccountBalance', uselist=False, backref='account')
 
     @hybrid_property
     def short_name(self):
         return self.name.split(':')[-1]
 
+    @property
+    def balance(self):
+        return self.totals.balance if self.totals else 0
+
     @validates('name')
     def convert_upper(self, key, value):
         return value.upper()
 
 ###############################################################################
 
+class AccountBalance(Base, JsonMixin):
+    """Running totals for an account. These are maintained by dbapi as
+    journal entries are created and voided so a balance never requires
+    summing every post. Posts belonging to void journal entries are not
+    counted.
+    """
+    __tablename__ = 'account_balances'
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key=True)
+    balance = Column(Numeric, nullable=False, default=0)
+    # totals of the negative and positive posts, both as positive numbers.
+    # None for rows older than these columns until migrate rebuilds them.
+    debits = Column(Numeric, default=0)
+    credits = Column(Numeric, default=0)
+    post_count = Column(Integer, nullable=False, default=0)
+    # datetime of the most recent journal entry that isn't void
+    last_datetime = Column(DateTime(timezone=True))
+
+
+@event.listens_for(Account, 'after_insert')
+def create_balance(mapper, connection, target):
+    """Every account gets a balance row in the same transaction it is
+    created in, so updating balances never has to race to insert one.
+    """
+    connection.execute(AccountBalance.__table__.insert(),
+                       account_id=target.id, balance=0, post_count=0)
+
+###############################################################################
+
+class ImportJob(Base, JsonMixin):
+    """A background import of an uploaded file, see dbapi.new_import_job.
+    The counters are committed after every chunk so they can be polled.
+    """
+    __tablename__ = 'import_jobs'
+    id = Column(Integer, primary_key=True)
+    filename = Column(Unicode(length=255))
+    file_format = Column(Unicode(length=64))
+    # queued, running, done or failed
+    status = Column(Unicode(length=16), nullable=False, default='queued')
+    parsed = Column(Integer, nullable=False, default=0)
+    inserted = Column(Integer, nullable=False, default=0)
+    duplicates = Column(Integer, nullable=False, default=0)
+    # why the job failed
+    error = Column(Unicode(length=1024))
+    # seconds spent running so far
+    elapsed = Column(Float, nullable=False, default=0)
+    created = Column(DateTime(timezone=True), nullable=False,
+                     default=func.now())
+    finished = Column(DateTime(timezone=True))
+
+###############################################################################
+
+class Change(Base, JsonMixin):
+    """The change feed, an append-only log of inserts, updates and deletes
+    of the tables in dbapi.CHANGE_TABLES. seq increases in commit order.
+    """
+    __tablename__ = 'changes'
+    seq = Column(BigInteger, primary_key=True)
+    table = Column(Unicode(length=64), nullable=False)
+    # None when a bulk change couldn't list the rows it changed
+    row_id = Column(Integer)
+    op = Column(Unicode(length=16), nullable=False)
+    datetime = Column(DateTime(timezone=True), nullable=False,
+                      default=func.now())
+
+###############################################################################
+
+class TableVersion(Base):
+    """Change counters for conditional requests. A table's version is bumped
+    by every transaction that changes the table, see dbapi.touch.
+    """
+    __tablename__ = 'table_versions'
+    table = Column(Unicode(length=64), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+###############################################################################
+
 #class Asset_Type(Base): #TODO
 #    __tablename__ = 'asset_types'
 
@@ -160,7 +326,7 @@ class Account(Base, JsonMixin):
 
 ###############################################################################
 
-class User(Base):
+class User(Base, JsonMixin):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     username = Column(Unicode(length=64), unique=True, nullable=False)
@@ -172,16 +338,9 @@ class User(Base):
     locked = Column(Boolean, default=True)
     roles = relationship('Role', secondary='role_user')
 
-
-    def json_obj(self):
-        """Custom implementation of json_obj that leaves out the password
-        field. This is for a couple of reasons a) the password column is bytes
-        and isn't serializable directly and b) I don't want to leak the
-        password hash accidently via json.
-        """
-        dic = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        del dic['password']
-        return dic
+    # the password hash is bytes and isn't serializable directly, it also
+    # shouldn't be leaked accidently via json
+    json_exclude = ('password',)
 
 ###############################################################################
 
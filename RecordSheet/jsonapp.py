@@ -20,20 +20,28 @@
 
 """This contains the bottle application that handles the json api."""
 
+import collections
+import datetime
+import decimal
 import functools
 import html
+import io
+import itertools
+import operator
 import os
 import traceback
+import types
 
 import bottle
-from bottle import abort, Bottle, HTTPError, redirect, request, response
+from bottle import (abort, Bottle, HTTPError, HTTPResponse, redirect, request,
+                    response)
 
 from sqlalchemy import asc, desc, func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql import label
+from sqlalchemy.sql import label, select
 from RecordSheet import dbapi, dbmodel, plugins, util
-from RecordSheet.dbmodel import (Account, Batch, Journal, Posting,
-                                    ImportedTransaction, User, Role)
+from RecordSheet.dbmodel import (Account, AccountBalance, Batch, Journal,
+                                    Posting, ImportedTransaction, User, Role)
 from RecordSheet.config import OPTIONS
 
 
@@ -49,6 +57,48 @@ sorte = {'accounts':Account,
          'posts':Posting,
          'roles':Role}
 
+# kinds the generic handlers can't write, posts have to go through dbapi to
+# keep the account balances correct
+READ_ONLY = {'posts'}
+
+###############################################################################
+
+def _conditional(*tables):
+    """Send a weak ETag made from the change counters of `tables`, and end
+    the request with 304 Not Modified if the client already has that
+    version. Call this before querying, so revalidating costs one small
+    query.
+
+    :param tables: The names of the tables the response is built from.
+    """
+    etag = 'W/"{}"'.format(dbapi.table_version(*tables))
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    # If-None-Match uses the weak comparison, so W/ prefixes don't matter
+    tags = [tag.strip() for tag in
+                request.headers.get('If-None-Match', '').split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    if '*' in tags or etag[2:] in tags:
+        raise HTTPResponse(status=304, **headers)
+
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+###############################################################################
+
+# ahead of the generic routes, which would take /import_jobs/<id> otherwise
+@app.get('/import_jobs/<id:int>')
+def import_job(id):
+    """Get the progress of a background import, see dbapi.new_import_job.
+    Poll this with If-None-Match, the job is only read once its counters
+    have changed.
+    """
+    _conditional(dbmodel.ImportJob.__tablename__)
+    job = dbapi.get_import_job(id)
+    if not job:
+        abort(404, 'Not Found')
+
+    return job
+
 ###############################################################################
 
 @app.route('/<kind>')
@@ -60,41 +110,243 @@ def generic_collection(kind):
      - sort: SQL column name, can be sufixed with ".asc" or ".desc" to \
      control order.
      - limit: LIMIT to apply to the results.
-     - offset: OFFSET to apply to the results. Must be accompanied by a limit.
-
-    Example: https://example.com/XYZ?sort=name.desc&limit=100&offset=100
+     - after: cursor token from the "next" field of a previous response, \
+     returns the page following it. Must be used with the same sort.
+     - before: cursor token from the "prev" field of a previous response, \
+     returns the page preceding it.
+     - offset: OFFSET to apply to the results. Must be accompanied by a \
+     limit. Deprecated, prefer after and before.
+     - stream: "json" or "ndjson" to stream the results, holding only \
+     STREAM_CHUNK rows in memory at a time. An Accept header of \
+     application/x-ndjson also streams NDJSON, one object per line. \
+     Streams can't be used with before or offset, and NDJSON has no cursors.
+     - fields: comma separated column names, only these columns are \
+     selected and returned.
+     - <column>: a filter, only return rows where the column equals the \
+     value. Suffix the column with ".ne", ".gt", ".gte", ".lt" or ".lte" to \
+     compare another way, or ".prefix" to match the start of text columns. \
+     Values are parsed as the column's type, dates and datetimes as ISO \
+     8601 and booleans as true or false. Parameters starting with "_" are \
+     ignored.
+
+    Responses have an ETag, send it back in If-None-Match to get a 304
+    response if the collection hasn't changed.
+
+    Example: https://example.com/XYZ?sort=name.desc&limit=100&after=XYZ
+    Example: https://example.com/posts?account_id=2&amount.lt=0&fields=id,memo
     """
     ses = dbapi.Session()
     cls = sorte.get(kind)
     if cls is None:
         abort(404, 'Not Found')
 
-    qry = ses.query(cls)
+    _conditional(cls.__tablename__)
 
+    try:
+        fields = _fields(cls)
+        clauses = _filters(cls)
+    except ValueError:
+        abort(400, 'Bad Request')
+
+    order = []
     sortcols = request.GET.getall('sort')
     for col in sortcols:
         colname = col
-        sortfunc = lambda x: x
+        descending = False
         if col.endswith('.desc'):
             colname = col[:-5] # remove trailing ".desc"
-            sortfunc = desc
+            descending = True
         elif col.endswith('.asc'):
             colname = col[:-4]
-            sortfunc = asc
 
         if colname in cls.__table__.columns:
-            qry = qry.order_by(sortfunc(colname))
+            order.append((cls.__table__.columns[colname], descending))
+
+    # the primary key makes the order unique, which keyset paging needs
+    if cls.__table__.c.id not in [col for col, descending in order]:
+        order.append((cls.__table__.c.id, False))
 
+    # read only, so skip loading ORM instances and serialize the rows. The
+    # cursors need the order columns even if they weren't asked for.
+    columns = [cls.__table__.c[name] for name in fields]
+    columns += [col for col, descending in order if col.name not in fields]
+    qry = select(columns)
+    for clause in clauses:
+        qry = qry.where(clause)
+
+    limit = None
     if 'limit' in request.GET:
-        limit = request.GET.get('limit', default=0, type=int)
-        qry = qry.limit(abs(limit))
+        limit = abs(request.GET.get('limit', default=0, type=int))
 
+    offset = 0
     if 'offset' in request.GET and 'limit' in request.GET:
-        offset = request.GET.get('offset', default=0, type=int)
-        qry = qry.offset(abs(offset))
+        offset = abs(request.GET.get('offset', default=0, type=int))
+
+    stream = request.GET.get('stream')
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        stream = 'ndjson'
+
+    if stream:
+        if 'before' in request.GET or offset:
+            abort(400, 'Bad Request')
+
+        try:
+            qry = dbapi.keyset(qry, order, request.GET.get('after'))
+        except ValueError:
+            abort(400, 'Bad Request')
+
+        if limit is not None:
+            # an extra row to find out if there is a next page
+            qry = qry.limit(limit + 1)
+
+        rows = ses.execute(qry.execution_options(stream_results=True))
+        if stream == 'ndjson':
+            response.content_type = 'application/x-ndjson'
+            return _stream_ndjson(cls, fields, rows, limit)
+
+        response.content_type = 'application/json'
+        return _stream_json(cls, fields, kind, rows, order, limit)
+
+    try:
+        page = dbapi.paginate(qry, order, limit,
+                              after=request.GET.get('after'),
+                              before=request.GET.get('before'),
+                              offset=offset)
+    except ValueError:
+        abort(400, 'Bad Request')
+
+    return {kind:[cls.json_row(row, fields) for row in page],
+            'prev':page.prev, 'next':page.next}
+
+
+# generic_collection query parameters that aren't filters
+COLLECTION_PARAMS = {'after', 'before', 'fields', 'limit', 'offset', 'sort',
+                     'stream'}
+
+def _prefix(col, text):
+    return col.like(util.escape_like(text) + '%', escape='\\')
+
+FILTER_OPS = {'eq':operator.eq,
+              'ne':operator.ne,
+              'gt':operator.gt,
+              'gte':operator.ge,
+              'lt':operator.lt,
+              'lte':operator.le,
+              'prefix':_prefix}
+
+def _parse_bool(text):
+    if text.lower() in ('true', '1'):
+        return True
+    elif text.lower() in ('false', '0'):
+        return False
+    raise ValueError("Invalid boolean {!r}".format(text))
+
+
+def _parse_decimal(text):
+    try:
+        return decimal.Decimal(text)
+    except decimal.InvalidOperation as exc:
+        raise ValueError("Invalid decimal {!r}".format(text)) from exc
+
+
+FILTER_PARSERS = {bool:_parse_bool,
+                  int:int,
+                  str:str,
+                  decimal.Decimal:_parse_decimal,
+                  datetime.datetime:util.parse_datetime,
+                  datetime.date:lambda text: util.parse_datetime(text).date()}
 
-    return {kind:qry.all()}
+def _fields(cls):
+    """Get the column names from the fields query parameter, or every
+    column if there isn't one.
 
+    :raises: ValueError if a name isn't a column of cls.
+    """
+    names = cls.json_serializer()[0]
+    fields = [name for param in request.GET.getall('fields')
+                for name in param.split(',') if name]
+    # repeats would be selected and serialized twice, keep the first
+    fields = list(collections.OrderedDict.fromkeys(fields))
+    if not set(fields) <= set(names):
+        raise ValueError("Invalid fields")
+
+    return fields or list(names)
+
+
+def _filters(cls):
+    """Build WHERE clauses from the filter query parameters, see
+    generic_collection.
+
+    :raises: ValueError if a parameter isn't a valid filter.
+    """
+    names = cls.json_serializer()[0]
+    clauses = []
+    for param, text in request.GET.allitems():
+        if param in COLLECTION_PARAMS or param.startswith('_'):
+            continue
+
+        colname, _, opname = param.partition('.')
+        op = FILTER_OPS.get(opname or 'eq')
+        if colname not in names or op is None:
+            raise ValueError("Invalid filter {!r}".format(param))
+
+        col = cls.__table__.c[colname]
+        try:
+            python_type = col.type.python_type
+        except NotImplementedError:
+            python_type = None
+
+        parse = FILTER_PARSERS.get(python_type)
+        if parse is None or (op is _prefix and python_type is not str):
+            raise ValueError("Can't filter {!r}".format(param))
+
+        clauses.append(op(col, parse(text)))
+
+    return clauses
+
+
+STREAM_CHUNK = 500 # rows fetched and encoded at a time when streaming
+
+def _stream_json(cls, fields, kind, rows, order, limit):
+    """Encode rows as they are fetched, in the same shape as a
+    generic_collection response.
+    """
+    yield '{' + util.jsonDumps(kind) + ':['
+    first = last = None
+    count = 0
+    more = False
+    for chunk in util.chunked(rows, STREAM_CHUNK):
+        if limit is not None and count + len(chunk) > limit:
+            more = True
+            chunk = chunk[:limit - count]
+
+        if chunk:
+            yield (',' if count else '') + \
+                    ','.join(util.jsonDumps(cls.json_row(row, fields))
+                                for row in chunk)
+            if first is None:
+                first = chunk[0]
+            last = chunk[-1]
+            count += len(chunk)
+
+        if more:
+            break
+
+    prev = None
+    if first is not None and 'after' in request.GET:
+        prev = dbapi.cursor(first, order)
+
+    next = dbapi.cursor(last, order) if more else None
+    yield '],"prev":{},"next":{}}}'.format(util.jsonDumps(prev),
+                                          util.jsonDumps(next))
+
+
+def _stream_ndjson(cls, fields, rows, limit):
+    """Encode rows as they are fetched, one JSON object per line."""
+    rows = itertools.islice(rows, limit)
+    for chunk in util.chunked(rows, STREAM_CHUNK):
+        yield ''.join(util.jsonDumps(cls.json_row(row, fields)) + '\n'
+                        for row in chunk)
 
 
 @app.route('/<kind>/<id:int>')
@@ -104,6 +356,7 @@ def generic_item(kind, id):
     if cls is None:
         abort(404, 'Not Found')
 
+    _conditional(cls.__tablename__)
     obj = ses.query(cls).get(id)
     if not obj:
         abort(404, 'Not Found')
@@ -112,11 +365,235 @@ def generic_item(kind, id):
 
 ###############################################################################
 
+@app.get('/accounts/balances')
+def account_balances():
+    """Get the balance and activity of every account, computed from the
+    posts in one query. The allowed query parameters are:
+
+     - as_of: ISO 8601 date or datetime, only count journal entries up to \
+     and including it. A date includes the whole day.
+     - prefix: Only include this account and the accounts under it.
+     - include_closed: "true" to include closed accounts.
+
+    See dbapi.account_balances for the fields of each balance.
+    """
+    # the current balances are read from account_balances
+    _conditional(Account.__tablename__, AccountBalance.__tablename__,
+                 Journal.__tablename__, Posting.__tablename__)
+
+    as_of = request.GET.get('as_of')
+    include_closed = request.GET.get('include_closed', 'false')
+    try:
+        if as_of:
+            as_of = util.parse_datetime(as_of, end_of_day=True)
+        include_closed = _parse_bool(include_closed)
+    except ValueError:
+        abort(400, 'Bad Request')
+
+    balances = dbapi.account_balances(as_of or None,
+                                      prefix=request.GET.get('prefix'),
+                                      include_closed=include_closed)
+
+    return {'balances':[row._asdict() for row in balances]}
+
+@app.get('/accounts/<id:int>/ledger.<fmt:re:csv|ndjson>')
+def account_ledger(id, fmt):
+    """Export the posts of an account as CSV or NDJSON, with a running
+    balance. The optional from and to query parameters are ISO 8601 dates
+    or datetimes limiting the journal entries exported, inclusive.
+    """
+    if dbapi.get_account(id) is None:
+        abort(404, 'Not Found')
+
+    try:
+        start, end = export_range()
+    except ValueError:
+        abort(400, 'Bad Request')
+
+    rows = dbapi.export_posts(account_id=id, start=start, end=end)
+    return export_body(rows, fmt, 'ledger-{}'.format(id))
+
+
+def export_range():
+    """Parse the from and to query parameters of an export.
+
+    :returns: A (start, end) tuple of datetimes or None.
+    :raises: ValueError if either is invalid.
+    """
+    start = request.GET.get('from')
+    end = request.GET.get('to')
+    return (util.parse_datetime(start) if start else None,
+            util.parse_datetime(end, end_of_day=True) if end else None)
+
+
+def export_body(rows, fmt, filename):
+    """Stream rows from dbapi.export_posts as a "csv" or "ndjson" download
+    named filename.
+    """
+    response.set_header('Content-Disposition',
+                        'attachment; filename="{}.{}"'.format(filename, fmt))
+    if fmt == 'ndjson':
+        response.content_type = 'application/x-ndjson'
+        return util.ndjson_stream(rows)
+
+    response.content_type = 'text/csv; charset=utf-8'
+    return util.csv_stream(dbapi.EXPORT_COLUMNS, rows)
+
+###############################################################################
+
+@app.get('/_stats')
+def stats():
+    """Process counters, for watching resource use of a running server."""
+    return {'sessions':dbapi.session_stats()}
+
+###############################################################################
+
+BATCH_LIMIT = 100 # sub-requests allowed in one batch
+
+@app.post('/_batch')
+def batch():
+    """Run several requests against this app in one request and one
+    database transaction. The request body is:
+
+        {"requests": [{"method": "PUT", "url": "/accounts", "body": {...}},
+                      {"method": "GET", "url": "/accounts?name=XYZ"}],
+         "atomic": false}
+
+    Sub-requests run in order, each in its own savepoint, and are checked
+    and answered like separate requests. Only GET, PUT and POST are allowed
+    and NDJSON streams can't be batched. The response is
+    {"responses": [{"status": 200, "body": {...}}, ...]}.
+
+    A failed sub-request is rolled back on its own, unless atomic is true.
+    Then the first failure rolls back every sub-request, no more are run,
+    and the response status is 400.
+    """
+    data = request.json
+    subrequests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(subrequests, list) or len(subrequests) > BATCH_LIMIT:
+        abort(400, 'Bad Request')
+
+    atomic = bool(data.get('atomic'))
+    ses = dbapi.Session()
+    environ = request.environ
+    responses = []
+    failed = False
+    try:
+        for subrequest in subrequests:
+            # handlers commit and roll back the savepoint, not the batch
+            savepoint = ses.begin_nested()
+            status, body = _batch_call(environ, subrequest)
+            if savepoint.is_active:
+                if status < 400:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+
+            responses.append((status, body))
+            if atomic and status >= 400:
+                failed = True
+                break
+
+        if failed:
+            ses.rollback()
+        else:
+            ses.commit()
+
+    except Exception:
+        ses.rollback()
+        raise
+
+    finally:
+        request.bind(environ)
+        response.bind()
+
+    if failed:
+        response.status = 400
+    response.content_type = 'application/json'
+    return _batch_body(responses)
+
+
+def _batch_call(environ, subrequest):
+    """Route and run one sub-request of a batch, with request and response
+    bound to it.
+
+    :param environ: The WSGI environment of the batch request.
+    :returns: A (status, body) tuple, body is the encoded JSON response.
+    """
+    if not isinstance(subrequest, dict):
+        return 400, util.jsonDumps({'errorMsg':'Bad Request'})
+
+    method = str(subrequest.get('method', 'GET')).upper()
+    if method not in ('GET', 'PUT', 'POST'):
+        return 405, util.jsonDumps({'errorMsg':'Method Not Allowed'})
+
+    # urls can be relative to this app or include its mount point
+    url = str(subrequest.get('url', ''))
+    prefix = environ.get('SCRIPT_NAME', '').rstrip('/')
+    if prefix and url.startswith(prefix + '/'):
+        url = url[len(prefix):]
+    path, _, query = url.partition('?')
+
+    body = b''
+    if subrequest.get('body') is not None:
+        body = util.jsonDumps(subrequest['body']).encode('utf8')
+
+    # leave out bottle's cached parsing of the batch request
+    subenviron = {key: value for key, value in environ.items()
+                    if not key.startswith(('bottle.', 'route.'))}
+    subenviron.pop('HTTP_IF_NONE_MATCH', None)
+    subenviron.update({'REQUEST_METHOD':method,
+                       'PATH_INFO':path,
+                       'QUERY_STRING':query,
+                       'CONTENT_TYPE':'application/json',
+                       'CONTENT_LENGTH':str(len(body)),
+                       'HTTP_ACCEPT':'application/json',
+                       'wsgi.input':io.BytesIO(body)})
+    request.bind(subenviron)
+    response.bind()
+    try:
+        route, args = app.router.match(subenviron)
+        if route.callback is batch:
+            return 400, util.jsonDumps({'errorMsg':'Bad Request'})
+
+        subenviron['route.handle'] = subenviron['bottle.route'] = route
+        subenviron['route.url_args'] = args
+        result = route.call(**args)
+
+    except HTTPError as exc:
+        # routing errors don't go through JSONPlugin
+        return exc.status_code, util.jsonDumps({'errorMsg':exc.body})
+
+    except HTTPResponse as exc:
+        return exc.status_code, 'null'
+
+    if isinstance(result, types.GeneratorType):
+        if response.content_type != 'application/json':
+            result.close()
+            return 400, util.jsonDumps({'errorMsg':"Can't batch streams"})
+        result = ''.join(result)
+
+    return response.status_code, result
+
+
+def _batch_body(responses):
+    yield '{"responses":['
+    yield ','.join('{{"status":{},"body":{}}}'.format(status, body)
+                    for status, body in responses)
+    yield ']}'
+
+###############################################################################
+
 @app.put('/<kind>')
 def generic_collection_put(kind):
     try:
         ses = dbapi.Session()
         cls = sorte.get(kind)
+        if cls is None:
+            abort(404, 'Not Found')
+        if kind in READ_ONLY:
+            abort(400, 'Bad Request')
+
         obj = cls()
         for key, val in request.json.items():
             if key in cls.__table__.columns:
@@ -139,10 +616,19 @@ def generic_item_post(kind, id):
     try:
         ses = dbapi.Session()
         cls = sorte.get(kind)
+        if cls is None:
+            abort(404, 'Not Found')
+        if kind in READ_ONLY:
+            abort(400, 'Bad Request')
+
         obj = ses.query(cls).get(id)
         if not obj:
             abort(404, 'Not Found')
 
+        # voids have to go through dbapi to keep the balances correct
+        if cls is Journal and 'void' in request.json:
+            abort(400, 'Bad Request')
+
         for key, val in request.json.items():
             if key in cls.__table__.columns:
                 setattr(obj, key, val)
@@ -174,23 +660,102 @@ def journal_put():
     except dbapi.DBException as exc:
         abort(400, 'Bad Request')
 
+
+
+@app.put('/journal/bulk')
+def journal_bulk_put():
+    """Create many journal entries at once. The request body is
+    {"entries": [...]} where each entry is the same as the body for PUT
+    /journal. Either every entry is created or none are, a 400 response
+    has an errors object of entry index, error message pairs.
+    """
+    try:
+        ws = request.environ.get('beaker.session')
+        batch = ws.setdefault('batch', Batch(user_id=ws['user_id']))
+        body = request.json
+        entries = body.get('entries') or [] if isinstance(body, dict) else None
+        if not isinstance(entries, list):
+            abort(400, 'Bad Request')
+
+        ids = dbapi.new_transactions(batch, entries)
+
+        return {'journal':ids}
+
+    except dbapi.EntryError as exc:
+        abort(400, {'errorMsg':'Bad Request', 'errors':exc.errors})
+
+    except dbapi.DBException as exc:
+        abort(400, 'Bad Request')
+
+
+@app.post('/journal/<id:int>/void')
+def journal_void(id):
+    try:
+        return dbapi.void_transaction(id)
+
+    except dbapi.DBException as exc:
+        abort(400, 'Bad Request')
+
 ###############################################################################
 
 @app.get('/imported_transactions')
 def imported_transactions_get():
-    ses = dbapi.Session()
-    qry = ses.query(dbapi.ImportedTransaction) \
-            .filter(dbapi.ImportedTransaction.posted != True) \
-            .order_by(desc(dbapi.ImportedTransaction.datetime)) \
-
+    """Get a page of imported transactions that haven't been posted, oldest
+    first. The limit, after and before query parameters are the same as for
+    generic_collection.
+    """
+    _conditional(ImportedTransaction.__tablename__)
+    limit = None
     if 'limit' in request.GET:
-        limit = request.GET.get('limit', default=0, type=int)
-        qry = qry.limit(abs(limit))
+        limit = abs(request.GET.get('limit', default=0, type=int))
 
-    if 'offset' in request.GET and 'limit' in request.GET:
-        offset = request.GET.get('offset', default=0, type=int)
-        qry = qry.offset(abs(offset))
+    try:
+        page = dbapi.get_imported_transactions(limit,
+                                after=request.GET.get('after'),
+                                before=request.GET.get('before'))
+    except ValueError:
+        abort(400, 'Bad Request')
+
+    return {'imported_transactions':page, 'prev':page.prev, 'next':page.next}
+
+###############################################################################
+
+@app.get('/changes')
+def changes():
+    """The change feed of new and updated journal entries, imported
+    transactions and accounts. The allowed query parameters are:
+
+     - since: Return the changes after this seq. Without it no changes are \
+     returned, only the last seq to start following the feed from.
+     - wait: Seconds to wait for a change if there aren't any yet, for long \
+     polling. At most dbapi.CHANGES_WAIT.
+     - limit: The most changes to return, default dbapi.CHANGES_LIMIT.
+
+    The response is {"changes": [...], "last_seq": N}, pass last_seq as
+    since in the next request.
+    """
+    try:
+        since = request.GET.get('since')
+        since = int(since) if since is not None else None
+        wait = float(request.GET.get('wait', 0))
+        limit = int(request.GET.get('limit', dbapi.CHANGES_LIMIT))
+        if not wait >= 0: # or nan
+            raise ValueError("Invalid wait")
+        if limit <= 0:
+            raise ValueError("Invalid limit")
+    except ValueError:
+        abort(400, 'Bad Request')
+
+    if since is None:
+        return {'changes':[], 'last_seq':dbapi.last_change()}
+
+    try:
+        # waiting isn't allowed in a _batch
+        rows = dbapi.get_changes(since, limit=limit, wait=wait)
+    except dbapi.DBException:
+        abort(400, 'Bad Request')
 
-    return {'imported_transactions':qry.all()}
+    return {'changes':[dbmodel.Change.json_row(row) for row in rows],
+            'last_seq':rows[-1].seq if rows else since}
 
 ###############################################################################
@@ -25,26 +25,27 @@ import decimal
 import hashlib
 import html
 import io
+import os
 
-from RecordSheet.ofx import ofx
+from RecordSheet import ofx
 
 
 def import_ofx(fileobj):
-    data = ofx(fileobj)
-    for acct in data.accounts:
-        transactions = acct.statement.transactions
-        acct_num = acct.acount_number.lstrip('0')
-        acct_num = ('X' * (len(acct_num) - 4)) + acct_num[-4:]
-        pre_hash = acct.routing_number + acct.acount_number
-        for tr in transactions:
-            tid = hashlib.sha1((pre_hash+tr.fitid).encode('utf8'))
-            yield {"account_hint": acct_num,
-                   "datetime":tr.posted,
-                   "amount":tr.amount,
-                   "memo":html.unescape(tr.memo),
-                   "ref":tr.refnum,
-                   "fitid":tr.fitid,
-                   "tid":tid.hexdigest()}
+    acct = None
+    for tr in ofx.iterparse(fileobj):
+        if tr.account is not acct:
+            acct = tr.account
+            acct_num = acct.acount_number.lstrip('0')
+            acct_num = ('X' * (len(acct_num) - 4)) + acct_num[-4:]
+            pre_hash = acct.routing_number + acct.acount_number
+        tid = hashlib.sha1((pre_hash+tr.fitid).encode('utf8'))
+        yield {"account_hint": acct_num,
+               "datetime":tr.posted,
+               "amount":tr.amount,
+               "memo":html.unescape(tr.memo or tr.payee or ''),
+               "ref":tr.refnum or '',
+               "fitid":tr.fitid,
+               "tid":tid.hexdigest()}
 
 
 def import_amazon_csv(fileobj):
@@ -66,3 +67,14 @@ def import_amazon_csv(fileobj):
 formats = {'ofx':import_ofx,
            'amazon csv': import_amazon_csv}
 
+# file extensions of each format, for picking a parser by file name
+extensions = {'.csv': 'amazon csv',
+              '.ofx': 'ofx',
+              '.qfx': 'ofx'}
+
+
+def guess_format(filename):
+    """Get the formats key for `filename` from its extension, None if it
+    isn't a known one.
+    """
+    return extensions.get(os.path.splitext(filename)[1].lower())
@@ -23,72 +23,275 @@ __copyright__ = "Copyright 2016, Eric Beanland"
 __license__ = "GPLv3"
 __version__ = "0.1"
 
+import codecs
 import datetime
 import decimal
-import xml.dom.minidom
+import re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import unescape
 
 
-def getText(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-    return ''.join(rc)
+CHUNK_SIZE = 64 * 1024 # bytes read from the file at a time
+AGGREGATES = {'BANKACCTFROM', 'BANKTRANLIST', 'STMTRS', 'STMTTRN'}
+# leaves of nested aggregates that are read as a field of the parent,
+# (aggregate, leaf): field
+NESTED_FIELDS = {('PAYEE', 'NAME'): 'PAYEE'}
 
+# YYYYMMDD[HHMM[SS[.XXX]]][[gmt offset[:tz name]]]
+OFX_DATETIME = re.compile(r'(\d{4})(\d\d)(\d\d)'
+                          r'(?:(\d\d)(\d\d)(?:(\d\d)(?:\.\d+)?)?)?'
+                          r'(?:\[[^\]]*\])?$')
 
-def getFirstText(tag, tagname):
-    nodes = tag.getElementsByTagName(tagname)
-    if not nodes:
-        return None
+# a tag and the text up to the next tag, OFX 1 leaves have no closing tag
+SGML_TOKEN = re.compile(r'<(/?)([^<>\s]+)>([^<]*)')
 
-    return getText(nodes[0].childNodes)
+
+def parse_datetime(datetime_str):
+    """Parse an OFX date or datetime. The time zone, if any, is dropped and
+    the time is returned as written.
+
+    :raises ValueError: if `datetime_str` isn't an OFX datetime.
+    """
+    # the regex, and strptime even more so, show up when parsing large
+    # files, so take the common case apart by hand
+    if len(datetime_str) == 14 and datetime_str.isdigit():
+        return datetime.datetime(int(datetime_str[:4]),
+                                 int(datetime_str[4:6]),
+                                 int(datetime_str[6:8]),
+                                 int(datetime_str[8:10]),
+                                 int(datetime_str[10:12]),
+                                 int(datetime_str[12:14]))
+
+    match = OFX_DATETIME.match(datetime_str.strip())
+    if not match:
+        raise ValueError('invalid OFX datetime: {!r}'.format(datetime_str))
+    return datetime.datetime(*[int(g or 0) for g in match.groups()])
 
 
 def parse_date(date_str):
-    return datetime.datetime.strptime(date_str, "%Y%m%d").date()
+    return parse_datetime(date_str).date()
 
 
-def parse_datetime(datetime_str):
-    return datetime.datetime.strptime(datetime_str, "%Y%m%d%H%M%S")
+def fields(tag):
+    """Map the tag names of the leaf children of `tag` to their stripped
+    text. Nested aggregates are skipped, apart from their NESTED_FIELDS.
+
+    The children are walked once, looking each field up in the map is then
+    cheap no matter how many fields are read.
+    """
+    values = {}
+    for child in tag:
+        if len(child):
+            _fold(child.tag, {leaf.tag: (leaf.text or '').strip()
+                              for leaf in child}, values)
+        else:
+            values[child.tag] = (child.text or '').strip()
+    return values
+
+
+def _fold(aggregate, leaves, parent):
+    """Copy the NESTED_FIELDS of a closed `aggregate` into `parent`."""
+    for (name, leaf), field in NESTED_FIELDS.items():
+        if name == aggregate and leaf in leaves:
+            parent[field] = leaves[leaf]
+
+
+def read_header(fileobj):
+    """Read the start of an OFX file, up to its first tag.
+
+    :returns: a (header, data) tuple. header is a dict of the header fields \
+    of an OFX 1 (SGML) file, or None for OFX 2 (XML). data is the bytes read \
+    so far that the body parser must start with.
+    :raises ValueError: if the file doesn't start with a tag or an OFX 1 \
+    header.
+    """
+    data = b''
+    while b'<' not in data:
+        chunk = fileobj.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+
+    head, sep, rest = data.partition(b'<')
+    head = head.lstrip(codecs.BOM_UTF8).strip()
+    if not head:
+        return None, data
+
+    header = {}
+    for line in head.decode('ascii', 'replace').splitlines():
+        key, sep_, value = line.partition(':')
+        header[key.strip().upper()] = value.strip()
+    if 'OFXHEADER' not in header:
+        raise ValueError('not an OFX file')
+    return header, sep + rest
+
+
+def _xml_aggregates(fileobj, data):
+    """Yield a (tag, fields) tuple as each element in AGGREGATES closes."""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    path = []
+    while True:
+        if data:
+            parser.feed(data)
+        else:
+            parser.close()
+        for event, elem in parser.read_events():
+            if event == 'start':
+                path.append(elem)
+                continue
+
+            path.pop()
+            if elem.tag in AGGREGATES:
+                yield elem.tag, fields(elem)
+                # drop statements and their transactions once they're done
+                if elem.tag in ('STMTTRN', 'STMTRS') and path:
+                    path[-1].remove(elem)
+        if not data:
+            break
+        data = fileobj.read(CHUNK_SIZE)
+
+
+def _sgml_aggregates(fileobj, header, data):
+    """Yield a (tag, fields) tuple as each element in AGGREGATES closes, for
+    OFX 1 files.
+
+    A tag followed by text is a leaf, a tag followed directly by another tag
+    starts an aggregate. Aggregates have closing tags, leaves may not. An
+    empty leaf looks like an aggregate until one of its parents closes, it
+    is then folded back into the parent. Only the open aggregates are kept,
+    so memory use doesn't depend on the file size.
+    """
+    if header.get('ENCODING', '').upper() in ('UTF-8', 'UNICODE'):
+        encoding = 'utf-8'
+    else:
+        encoding = 'cp1252'
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+
+    stack = [(None, {})]
+    buf = ''
+    while True:
+        buf += decoder.decode(data, final=not data)
+        # the text after the last tag may go on in the next chunk
+        end = buf.rfind('<') if data else len(buf)
+        for match in SGML_TOKEN.finditer(buf, 0, end):
+            close, tag, text = match.groups()
+            if not close:
+                text = text.strip()
+                if text:
+                    if '&' in text:
+                        text = unescape(text)
+                    stack[-1][1][tag] = text
+                else:
+                    stack.append((tag, {}))
+                continue
+
+            for i in range(len(stack) - 1, 0, -1):
+                if stack[i][0] == tag:
+                    break
+            else:
+                continue # the closing tag of a leaf
+
+            while len(stack) > i:
+                name, values = stack.pop()
+                parent = stack[-1][1]
+                if name == tag and name in AGGREGATES:
+                    yield name, values
+                elif not values:
+                    parent.setdefault(name, '')
+                elif name != tag:
+                    # never closed, so it was an empty leaf
+                    parent.update(values)
+                else:
+                    _fold(name, values, parent)
+
+        if not data:
+            break
+        buf = buf[end:]
+        data = fileobj.read(CHUNK_SIZE)
+
+
+def iterparse(fileobj, accounts=None):
+    """Incrementally parse an OFX file, version 1 (SGML) or 2 (XML).
+
+    A transaction is yielded as soon as its STMTTRN aggregate closes, and is
+    then dropped by the parser, so memory use depends on the size of one
+    transaction rather than the size of the file.
+
+    :param fileobj: file-like object opened in binary mode.
+    :param accounts: optional list, each account is appended to it as its \
+    BANKACCTFROM aggregate closes.
+    :returns: generator of transaction objects, `transaction.account` is the \
+    account they belong to.
+    """
+    header, data = read_header(fileobj)
+    if header is None:
+        aggregates = _xml_aggregates(fileobj, data)
+    else:
+        aggregates = _sgml_aggregates(fileobj, header, data)
+
+    acct = None
+    for tag, values in aggregates:
+        if tag == 'STMTTRN':
+            # only bank statements are supported, skip anything else
+            if acct is not None:
+                yield transaction(values, acct)
+        elif tag == 'BANKACCTFROM':
+            acct = account(values)
+            if accounts is not None:
+                accounts.append(acct)
+        elif tag == 'BANKTRANLIST' and acct is not None:
+            acct.statement.update(values)
+        elif tag == 'STMTRS':
+            acct = None
 
 
 class ofx:
+    """All the accounts and transactions of an OFX file, in memory. Use
+    iterparse to process large files.
+    """
     def __init__(self, fileobj):
         self.file = fileobj
-        self.dom = xml.dom.minidom.parse(fileobj)
-        self.accounts = [account(e) for e in self.dom.getElementsByTagName("STMTRS")]
+        self.accounts = []
+        for tr in iterparse(fileobj, self.accounts):
+            tr.account.statement.transactions.append(tr)
 
 
 class account:
-    def __init__(self, tag):
-        self.tag = tag
-        self.routing_number = getFirstText(tag, "BANKID")
-        self.acount_number = getFirstText(tag, "ACCTID")
-        self.type = getFirstText(tag, "ACCTTYPE")
-        self.statement = statement(tag.getElementsByTagName("BANKTRANLIST")[0])
+    def __init__(self, fields):
+        self.routing_number = fields.get("BANKID")
+        self.acount_number = fields.get("ACCTID")
+        self.type = fields.get("ACCTTYPE")
+        self.statement = statement()
 
 
 class statement:
-    def __init__(self, tag):
-        self.start_date = getFirstText(tag, "DTSTART")
-        self.end_date = getFirstText(tag, "DTEND")
-        self.transactions = [transaction(e) for e in tag.getElementsByTagName("STMTTRN")]
+    def __init__(self):
+        self.start_date = None
+        self.end_date = None
+        self.transactions = []
+
+    def update(self, fields):
+        self.start_date = fields.get("DTSTART")
+        self.end_date = fields.get("DTEND")
 
 
 class transaction:
 
-    def __init__(self, tag):
-        self.type = getFirstText(tag, "TRNTYPE")
-        self.posted = parse_datetime(getFirstText(tag, "DTPOSTED"))
-        self.date_available = parse_date(getFirstText(tag, "DTAVAIL"))
-        self.amount = decimal.Decimal(getFirstText(tag, "TRNAMT"))
-        self.fitid = getFirstText(tag, "FITID")
-        self.refnum = getFirstText(tag, "REFNUM")
-        self.name = getFirstText(tag, "NAME")
-        self._payee = getFirstText(tag, "PAYEE")
-        self.memo = getFirstText(tag, "MEMO")
+    def __init__(self, fields, account=None):
+        get = fields.get
+        self.account = account
+        self.type = get("TRNTYPE")
+        self.posted = parse_datetime(get("DTPOSTED"))
+        date_available = get("DTAVAIL")
+        self.date_available = (parse_date(date_available) if date_available
+                               else None)
+        self.amount = decimal.Decimal(get("TRNAMT"))
+        self.fitid = get("FITID")
+        self.refnum = get("REFNUM")
+        self.name = get("NAME")
+        self._payee = get("PAYEE")
+        self.memo = get("MEMO")
 
     @property
     def payee(self):
         return self._payee or self.name
-
@@ -19,11 +19,15 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import functools
+import itertools
 import traceback
+import types
+import zlib
 
-from bottle import abort, response, request, template, HTTPError
+from bottle import (abort, response, request, template, HTTPError,
+                    HTTPResponse)
 
-from RecordSheet import util
+from RecordSheet import dbapi, util
 from RecordSheet.config import OPTIONS
 
 ###############################################################################
@@ -102,11 +106,20 @@ class JSONPlugin:
             try:
                 result = callback(*args, **kwargs)
                 status = 200
+                # streamed responses are encoded by the handler as they go
+                if isinstance(result, types.GeneratorType):
+                    return result
 
             except HTTPError as exc:
                 print(exc)
                 status = exc.status
-                result = {'errorMsg':exc.args[1]}
+                # handlers can abort with a dict to send more than a message
+                body = exc.args[1]
+                result = body if isinstance(body, dict) else {'errorMsg':body}
+
+            except HTTPResponse:
+                # not an error, eg. a 304 Not Modified
+                raise
 
             except Exception as exc:
                 if OPTIONS['debug']:
@@ -121,3 +134,190 @@ class JSONPlugin:
         return wrapper
 
 ###############################################################################
+
+class DBSessionMiddleware:
+    """WSGI middleware that removes the request's database session once the
+    response has been sent, including any streamed body. Without it
+    sessions, and every object in their identity maps, outlive requests.
+    """
+    def __init__(self, app, remove=dbapi.remove_session):
+        self.app = app
+        self.remove = remove
+
+
+    def __call__(self, environ, start_response):
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            self.remove()
+            raise
+
+        return _ClosingIterator(body, self.remove)
+
+
+# brotli is optional, responses are only gzipped without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = 1024 # smaller bodies aren't worth compressing
+COMPRESS_TYPES = {'application/javascript', 'application/json',
+                  'application/x-ndjson', 'image/svg+xml'} # and text/*
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # higher qualities are too slow for dynamic responses
+
+class CompressionMiddleware:
+    """WSGI middleware that compresses responses with brotli or gzip when
+    the client accepts it. Only text, JSON and javascript responses of at
+    least min_size bytes are compressed, and partial ones or ones that
+    already have a Content-Encoding are left alone. ETags of compressed
+    responses are made weak. The body is compressed and sent a chunk at a
+    time, so streamed responses stay streamed. Apps can't use the write
+    callable returned by start_response.
+    """
+    def __init__(self, app, min_size=COMPRESS_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+
+    def __call__(self, environ, start_response):
+        encoding = accepted_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        started = []
+        def deferred_start_response(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+            return _no_write
+
+        body = self.app(environ, deferred_start_response)
+        chunks = self._respond(body, started, start_response, encoding)
+        return _ClosingIterator(chunks, lambda: _close(body))
+
+
+    def _respond(self, body, started, start_response, encoding):
+        # hold back the start of the body until there's enough to be worth
+        # compressing, or it has ended
+        chunks = iter(body)
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            if size < self.min_size:
+                size = None
+
+        status, headers, exc_info = started
+        if size is None or not _compressible(status, headers):
+            start_response(status, headers, exc_info)
+            yield from head
+            yield from chunks
+            return
+
+        compress, finish = _compressor(encoding)
+        vary = [v for k, v in headers if k.lower() == 'vary']
+        # the compressed bytes differ from the original's, a strong ETag
+        # would promise they're identical
+        headers = [(k, 'W/' + v if k.lower() == 'etag' and
+                                   not v.startswith('W/') else v)
+                    for k, v in headers
+                    if k.lower() not in ('content-length', 'vary')]
+        headers.append(('Content-Encoding', encoding))
+        headers.append(('Vary', ', '.join(vary + ['Accept-Encoding'])))
+        start_response(status, headers, exc_info)
+
+        for chunk in itertools.chain(head, chunks):
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+
+
+def accepts(accept_encoding, coding):
+    """Check if an Accept-Encoding header allows coding, eg. "gzip"."""
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+
+    return accepted.get(coding, accepted.get('*', 0)) > 0
+
+
+def accepted_encoding(accept_encoding):
+    """Pick "br" or "gzip" from an Accept-Encoding header, or None if the
+    client accepts neither.
+    """
+    if brotli is not None and accepts(accept_encoding, 'br'):
+        return 'br'
+    elif accepts(accept_encoding, 'gzip'):
+        return 'gzip'
+    return None
+
+
+def _compressible(status, headers):
+    # a compressed range of the original bytes would be nonsense
+    if status[:3] in ('204', '206', '304') or status[:1] == '1':
+        return False
+
+    headers = {k.lower(): v for k, v in headers}
+    if 'content-encoding' in headers or 'content-range' in headers or \
+            'no-transform' in headers.get('cache-control', ''):
+        return False
+
+    mimetype = headers.get('content-type', '').split(';')[0].strip().lower()
+    return mimetype.startswith('text/') or mimetype in COMPRESS_TYPES
+
+
+def _compressor(encoding):
+    """Return (compress, finish) functions for encoding. Each compressed
+    chunk is flushed so it can be sent straight away.
+    """
+    if encoding == 'br':
+        obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        return (lambda data: obj.process(data) + obj.flush()), obj.finish
+
+    # wbits + 16 writes a gzip header and trailer
+    obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+    return (lambda data: obj.compress(data) + obj.flush(zlib.Z_SYNC_FLUSH),
+            obj.flush)
+
+
+def _no_write(data):
+    raise NotImplementedError("Compressed apps can't use write()")
+
+
+def _close(body):
+    if hasattr(body, 'close'):
+        body.close()
+
+
+class _ClosingIterator:
+    """Iterate body, then call callback when the server closes it."""
+    def __init__(self, body, callback):
+        self.body = body
+        self.callback = callback
+
+
+    def __iter__(self):
+        return iter(self.body)
+
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.callback()
+
+###############################################################################
@@ -28,8 +28,8 @@ from bottle import (Bottle, delete, get, post, put, redirect, request,
 from sqlalchemy import asc, desc, func
 from sqlalchemy.sql import label
 from RecordSheet import dbapi, dbmodel, util
-from RecordSheet.dbmodel import (Account, Batch, Journal, Posting,
-                                    ImportedTransaction)
+from RecordSheet.dbmodel import (Account, AccountBalance, Batch, Journal,
+                                    Posting, ImportedTransaction)
 
 app = bottle.Bottle()
 
@@ -45,9 +45,9 @@ def index():
 @view('reports/trial_balance')
 def trial_balance():
     dbs = dbapi.Session()
-    balances = dbs.query(Account.name, func.sum(Posting.amount)) \
-                .join(Account.posts) \
-                .group_by(Account.name) \
+    balances = dbs.query(Account.name, AccountBalance.balance) \
+                .join(Account.totals) \
+                .filter(AccountBalance.post_count > 0) \
                 .order_by(Account.name).all()
 
     return {'balances':balances}
@@ -105,7 +105,8 @@ def imbalanced():
                 Posting.journal_id) \
                 .group_by(Posting.journal_id).subquery()
 
-    result = ses.query(Journal).join(stmt).filter(stmt.c.j_sum!=0).all()
+    result = ses.query(Journal).join(stmt).filter(stmt.c.j_sum!=0) \
+                .options(*dbapi.JOURNAL_POSTS).all()
 
     return {'journals': result}
 
@@ -19,11 +19,19 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import binascii
+import collections
+import concurrent.futures
+import csv
 import datetime
 import decimal
 import functools
+import io
+import itertools
 import json
 import os
+import re
+import time
 
 import bottle
 
@@ -40,30 +48,91 @@ class fakeFloat(float):
         return self.str
 
 
-class RsJsonEncoder(json.JSONEncoder):
-    """Json encoder for various classes. Objects with a json_obj method
-    should return a json serializable object when it is called.
+def _json_default(obj):
+    """Serialize the objects the json backend doesn't know about. Objects
+    with a json_obj method should return a json serializable object when it
+    is called.
     """
+    if hasattr(obj, 'json_obj'):
+        return obj.json_obj()
+
+    #serialize datetime objects
+    elif hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+
+    #serialize decimal.Decimal
+    elif isinstance(obj, decimal.Decimal):
+        return fakeFloat(obj)
+
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+class RsJsonEncoder(json.JSONEncoder):
+    """Json encoder for various classes, see _json_default."""
     def default(self, obj):
-        if hasattr(obj, 'json_obj'):
-            return obj.json_obj()
+        return _json_default(obj)
+
 
-        #serialize datetime objects
-        elif hasattr(obj, 'isoformat'):
-            return obj.isoformat()
+# column converters for JsonMixin, values that haven't been flushed yet may
+# still be whatever was assigned, those are passed through like before
 
-        #serialize decimal.Decimal
-        elif isinstance(obj, decimal.Decimal):
-            return fakeFloat(obj)
+def isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
 
-        return json.JSONEncoder.default(self, obj)
 
-jsonDumps = functools.partial(json.dumps, cls=RsJsonEncoder,
-                separators=(',', ':')) # save a few bytes
+def decimal_float(value):
+    return fakeFloat(value) if isinstance(value, decimal.Decimal) else value
+
+# simplejson's C encoder writes Decimals as is, the stdlib encoder needs
+# them wrapped in a fakeFloat first
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+_stdlib_dumps = functools.partial(json.dumps, cls=RsJsonEncoder,
+                    separators=(',', ':')) # save a few bytes
+
+if simplejson is not None:
+    # namedtuples are arrays, like the stdlib encoder writes them
+    _simplejson_dumps = functools.partial(simplejson.dumps,
+                    default=_json_default, use_decimal=True,
+                    namedtuple_as_object=False, separators=(',', ':'))
+    jsonDumps = _simplejson_dumps
+    DECIMAL_CONVERTER = None
+else:
+    jsonDumps = _stdlib_dumps
+    DECIMAL_CONVERTER = decimal_float
+
+DATETIME_CONVERTER = isoformat
+
 jsonLoads = functools.partial(json.loads, parse_float=decimal.Decimal)
 
 ###############################################################################
 
+def encode_cursor(values):
+    """Encode a list of column values into an opaque pagination cursor."""
+    token = base64.urlsafe_b64encode(jsonDumps(values).encode('utf8'))
+    return str(token, encoding='utf8')
+
+
+def decode_cursor(token):
+    """Decode a cursor made by encode_cursor.
+
+    :raises: ValueError if the token is invalid.
+    """
+    try:
+        values = jsonLoads(str(base64.urlsafe_b64decode(token), 'utf8'))
+    except (binascii.Error, TypeError, ValueError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+
+    return values
+
+###############################################################################
+
 def year_range(year):
     """Return a (datetime, datetime) tuple representing the start and end of
     year. The datetime objects will have Zulu time set as their timezone.
@@ -75,6 +144,138 @@ def year_range(year):
             datetime.datetime(year, 12, 31, hour=23, minute=59, second=59,
                                 microsecond=999999, tzinfo=tz))
 
+_ISO_DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)'
+                           r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?'
+                           r'(Z|[+-]\d\d(?::?\d\d)?)?)?$')
+
+def parse_datetime(text, end_of_day=False):
+    """Parse an ISO 8601 date or datetime, such as the ones jsonDumps
+    writes. A datetime with a UTC offset or Z is timezone aware, one
+    without is naive.
+
+    :param end_of_day: If text is only a date, return the last moment of \
+    that day instead of midnight. For inclusive date ranges.
+    :raises: ValueError if text isn't a valid date or datetime.
+    """
+    match = _ISO_DATETIME.match(text)
+    if not match:
+        raise ValueError("Invalid datetime {!r}".format(text))
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tz = None
+    if offset == 'Z':
+        tz = datetime.timezone.utc
+    elif offset:
+        sign = -1 if offset[0] == '-' else 1
+        digits = offset[1:].replace(':', '')
+        delta = datetime.timedelta(hours=int(digits[:2]),
+                                   minutes=int(digits[2:] or 0))
+        tz = datetime.timezone(sign * delta)
+
+    value = datetime.datetime(int(year), int(month), int(day), int(hour or 0),
+                              int(minute or 0), int(second or 0),
+                              int((fraction or '0').ljust(6, '0')), tzinfo=tz)
+    if end_of_day and hour is None:
+        value += datetime.timedelta(days=1, microseconds=-1)
+    return value
+
+###############################################################################
+
+def escape_like(text):
+    """Escape the LIKE wildcards in text, for use with escape='\\'."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+###############################################################################
+
+def csv_stream(header, rows, chunk_size=500):
+    """Encode rows as CSV, yielding a string for the header and then for
+    each chunk of rows, so only one chunk is held in memory at a time.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    yield buf.getvalue()
+    for chunk in chunked(rows, chunk_size):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(chunk)
+        yield buf.getvalue()
+
+
+def ndjson_stream(rows, chunk_size=500):
+    """Encode named tuples as NDJSON, yielding a string for each chunk."""
+    for chunk in chunked(rows, chunk_size):
+        yield ''.join(jsonDumps(row._asdict()) + '\n' for row in chunk)
+
+###############################################################################
+
+def chunked(iterable, size):
+    """Yield lists of up to `size` items from iterable. Only one chunk is
+    held in memory at a time.
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+###############################################################################
+
+def native_executor(max_workers):
+    """Create a concurrent.futures executor that runs on real OS threads,
+    even when gevent has monkey patched threading. Waiting on its futures
+    only blocks the calling greenlet.
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor
+            return ThreadPoolExecutor(max_workers)
+
+    except ImportError:
+        pass
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers)
+
+###############################################################################
+
+class RateLimiter:
+    """Token bucket rate limiter. Each key can make `burst` attempts at once
+    and regains an attempt every `period` seconds.
+    """
+    max_keys = 10000 # forget the least recently used keys past this
+
+    def __init__(self, burst, period, clock=time.monotonic):
+        self.burst = burst
+        self.period = period
+        self.clock = clock
+        # least recently used first
+        self.buckets = collections.OrderedDict()
+
+
+    def _tokens(self, key, now):
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - last) / self.period)
+
+
+    def allow(self, key):
+        """Use an attempt for key.
+
+        :returns: True if key had an attempt left, otherwise False.
+        """
+        now = self.clock()
+        tokens = self._tokens(key, now)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        self.buckets.move_to_end(key)
+
+        while len(self.buckets) > self.max_keys:
+            # O(1) eviction of the key idle the longest, its bucket has had
+            # the most time to refill
+            self.buckets.popitem(last=False)
+
+        return allowed
+
 ###############################################################################
 
 def csrf_token():
@@ -18,7 +18,11 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mimetypes
 import os
+import re
+import shutil
+import tempfile
 
 import bottle
 from bottle import abort, redirect, request, response, route, view
@@ -59,7 +63,7 @@ def account_chart():
 @rsapp.route('/accounts/<id:int>', name='account_view')
 @view('account')
 def account_view(id):
-    acct = dbapi.get_account(id)
+    acct = dbapi.get_account(id, eager=True)
     if acct is None:
         abort(404, "Account {} Doesn't Exist".format(id))
 
@@ -77,7 +81,7 @@ def new_transaction():
 @rsapp.route('/batch/<id:int>', name='batch_view')
 @view('batch')
 def batch(id):
-    batch = dbapi.get_batch(id)
+    batch = dbapi.get_batch(id, eager=True)
     if batch is None:
         abort(404, "Batch {} Doesn't Exist".format(id))
 
@@ -88,13 +92,32 @@ def batch(id):
 @rsapp.route('/journal', name='journal_view')
 @view('journal')
 def journal():
-    return {"journals":dbapi.get_journals()}
+    return {"journals":dbapi.get_journals(eager=True)}
+
+
+@rsapp.route('/journal/export', name='journal_export')
+def journal_export():
+    """Export every post as CSV, or NDJSON with format=ndjson, with running
+    account balances. Takes the from and to query parameters of
+    jsonapp.account_ledger.
+    """
+    fmt = request.query.get('format', 'csv')
+    try:
+        start, end = jsonapp.export_range()
+    except ValueError:
+        abort(400, "Invalid date range")
+
+    if fmt not in ('csv', 'ndjson'):
+        abort(400, "Invalid format")
+
+    rows = dbapi.export_posts(start=start, end=end)
+    return jsonapp.export_body(rows, fmt, 'journal')
 
 
 @rsapp.route('/journal/<id:int>', name='journal_entry_view')
 @view('journal')
 def journal_entry(id):
-    journal = dbapi.get_journal(id)
+    journal = dbapi.get_journal(id, eager=True)
     if journal is None:
         abort(404, "Journal Entry {} Doesn't Exist".format(id))
 
@@ -105,7 +128,10 @@ def journal_entry(id):
 @rsapp.route('/import', name='import_tr')
 @view('import')
 def import_tr():
-    return {'mport_formats':mport.formats}
+    job = None
+    if request.query.get('job', '').isdigit():
+        job = dbapi.get_import_job(int(request.query.job))
+    return {'mport_formats':mport.formats, 'job':job}
 
 
 @rsapp.post('/import', name='import_tr_post')
@@ -119,16 +145,32 @@ def import_tr_post():
         account = dbapi.get_account_by_name(account_name)
         account_id = account.id
 
-    transactions = mport.formats[file_format](upload.file)
+    # the upload is closed when the request ends, which may be before the
+    # job starts, so the job gets a copy that it closes when it's done
+    spool = tempfile.NamedTemporaryFile(prefix='recordsheet-import-')
+    try:
+        shutil.copyfileobj(upload.file, spool)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+
+    transactions = mport.formats[file_format](spool)
 
     def trgen(transactions):
         for tr in transactions:
             tr['account_id'] = account_id
             yield tr
 
-    dbapi.insert_imported_transactions(trgen(transactions))
+    # browsers may send the whole path of the file
+    filename = os.path.basename((upload.raw_filename or '').replace('\\', '/'))
+
+    # parsing and inserting happen on the import pool, the page polls the
+    # job for progress
+    job = dbapi.new_import_job(trgen(transactions), filename, file_format,
+                               fileobj=spool)
 
-    redirect(rsapp.get_url('import_tr'))
+    redirect(rsapp.get_url('import_tr') + '?job={}'.format(job.id))
 
 ###############################################################################
 
@@ -136,10 +178,15 @@ def import_tr_post():
 @view('imported_transactions')
 def incomplete_trs():
     pagesize = 10
-    page = int(request.query.get('page', 0))
-    offset = page * pagesize
     #TODO load all the data from xhr
-    return {"posts": dbapi.get_imported_transactions(limit=pagesize,offset=offset)}
+    try:
+        posts = dbapi.get_imported_transactions(limit=pagesize,
+                                        after=request.query.get('after'),
+                                        before=request.query.get('before'))
+    except ValueError:
+        abort(400, "Invalid page")
+
+    return {"posts": posts}
 
 ###############################################################################
 
@@ -178,11 +225,14 @@ def user_self_edit():
     elif new_pw != confirm_pw:
         abort(400, "New password doesn't match confirmation.")
 
-    user = dbapi.get_user(ws['user_id'])
-    success = user.authenticate(pw)
-    if success:
-        dbapi.set_password(ws['user_id'], new_pw)
-        redirect('/')
+    try:
+        success = dbapi.authenticate(ws['user_id'], pw)
+        if success:
+            dbapi.set_password(ws['user_id'], new_pw)
+            redirect('/')
+
+    except dbapi.BusyError:
+        abort(503, "The server is busy, please try again.")
 
     abort(401, "Password or username is incorrect")
 
@@ -195,6 +245,12 @@ def admin_users():
 
 ###############################################################################
 
+# login attempts per remote address, a burst of LOGIN_BURST then one every
+# LOGIN_PERIOD seconds
+LOGIN_BURST = 10
+LOGIN_PERIOD = 6
+login_limiter = util.RateLimiter(LOGIN_BURST, LOGIN_PERIOD)
+
 @rsapp.route('/login', name='login')
 @view('login')
 def login():
@@ -208,6 +264,10 @@ def login_post():
     username = request.POST.get('username', None)
     password = request.POST.get('password', None)
     if username and password:
+        # each attempt costs a password hash, don't let anyone hog them
+        if not login_limiter.allow(request.remote_addr):
+            abort(429, "Too many login attempts, please wait.")
+
         user, success = dbapi.login(username, password)
         if success == 'USERPASS':
             msg = "Invalid username or password"
@@ -215,6 +275,9 @@ def login_post():
         elif success == 'LOCKED':
             msg = "The account is locked"
 
+        elif success == 'BUSY':
+            msg = "The server is busy, please try again"
+
         elif success == 'SUCCESS':
             ws['authenticated'] = True
             ws['user_id'] = user.id
@@ -237,9 +300,36 @@ def logout():
 
 ###############################################################################
 
+# eg. main.3f2a9c1e.js, the content hash changes with the content so these
+# can be cached for good
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{8,}\.[^./]+$')
+FAR_FUTURE = 'public, max-age=31536000, immutable'
+
 @rsapp.route('/static/<filename:path>', name='static', roles=False)
 def send_static(filename):
-    return bottle.static_file(filename, root=STATIC_ROOT)
+    """Serve a static file, or its precompressed .gz sibling if there is one
+    that's up to date and the client accepts gzip.
+    """
+    path = os.path.abspath(os.path.join(STATIC_ROOT, filename))
+    gzpath = path + '.gz'
+    accept = request.headers.get('Accept-Encoding', '')
+    gzipped = (plugins.accepts(accept, 'gzip') and
+               path.startswith(STATIC_ROOT + os.sep) and
+               os.path.isfile(gzpath) and os.path.isfile(path) and
+               os.path.getmtime(gzpath) >= os.path.getmtime(path))
+
+    if gzipped:
+        mimetype = mimetypes.guess_type(filename)[0] or 'text/plain'
+        resp = bottle.static_file(filename + '.gz', root=STATIC_ROOT,
+                                  mimetype=mimetype)
+        resp.set_header('Content-Encoding', 'gzip')
+    else:
+        resp = bottle.static_file(filename, root=STATIC_ROOT)
+
+    resp.set_header('Vary', 'Accept-Encoding')
+    if FINGERPRINTED.search(filename):
+        resp.set_header('Cache-Control', FAR_FUTURE)
+    return resp
 
 ###############################################################################
 
@@ -274,6 +364,7 @@ def app(**kwargs):
 
     sessionapp = SessionMiddleware(rsapp, session_opts)
     dbapi.init()
-    return sessionapp
+    compressed = plugins.CompressionMiddleware(sessionapp)
+    return plugins.DBSessionMiddleware(compressed)
 
 ###############################################################################
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Eric Beanland <eric.beanland@gmail.com>
+
+# This file is part of RecordSheet
+#
+# RecordSheet is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RecordSheet is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time encoding Posting rows to json, comparing the old per value
+RsJsonEncoder.default path with the precompiled JsonMixin serializers.
+
+Run from the top of the source tree:
+    python bench/json_encode.py [--rows N] [--repeat N]
+"""
+
+import argparse
+import decimal
+import functools
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from RecordSheet import util
+from RecordSheet.dbmodel import Posting
+
+###############################################################################
+
+def make_posts(count):
+    return [Posting(id=i, account_id=i % 50, journal_id=i // 2,
+                    amount=decimal.Decimal(i % 1000) / 100, memo='memo',
+                    ref='ref', fitid=None) for i in range(count)]
+
+
+def old_json_obj(obj):
+    # what JsonMixin.json_obj did before the serializers were precompiled
+    return {c.name: getattr(obj, c.name) for c in obj.__table__.columns}
+
+
+class OldEncoder(util.RsJsonEncoder):
+    def default(self, obj):
+        if hasattr(obj, 'json_obj'):
+            return old_json_obj(obj)
+        return super().default(obj)
+
+
+def timed(label, func, posts, repeat):
+    # the best of repeat runs, the others were slowed by something else
+    elapsed = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        output = func(posts)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    print('{:<40} {:8.3f}s {:10.0f} rows/s'.format(label, elapsed,
+                                                  len(posts) / elapsed))
+    return output
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', '-n', type=int, default=100000,
+                        help='Posting rows to encode')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='runs of each encoder, the best is printed')
+    args = parser.parse_args(argv[1:])
+    if args.rows <= 0:
+        parser.error('--rows must be positive')
+    if args.repeat <= 0:
+        parser.error('--repeat must be positive')
+
+    posts = make_posts(args.rows)
+    old_dumps = functools.partial(json.dumps, cls=OldEncoder,
+                                  separators=(',', ':'))
+
+    print('encoding {} Posting rows, best of {}, backend: {}'.format(
+            args.rows, args.repeat,
+            'simplejson' if util.simplejson else 'json'))
+    old = timed('RsJsonEncoder.default', old_dumps, posts, args.repeat)
+    new = timed('precompiled serializers', util.jsonDumps, posts, args.repeat)
+    assert util.jsonLoads(old) == util.jsonLoads(new)
+    if util.simplejson:
+        timed('precompiled serializers, json backend', util._stdlib_dumps,
+              posts, args.repeat)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
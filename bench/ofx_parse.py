@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Eric Beanland <eric.beanland@gmail.com>
+
+# This file is part of RecordSheet
+#
+# RecordSheet is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RecordSheet is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Time parsing generated OFX 2 (XML) and OFX 1 (SGML) files with
+ofx.iterparse.
+
+The bare ElementTree.iterparse time over the XML file is printed too, it is
+the floor for anything built on it. Run from the top of the source tree:
+    python bench/ofx_parse.py [--transactions N]
+"""
+
+import argparse
+import datetime
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from RecordSheet import ofx
+
+###############################################################################
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<?OFX OFXHEADER="200" VERSION="211" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>
+<OFX>
+<BANKMSGSRSV1><STMTTRNRS><TRNUID>1</TRNUID><STMTRS><CURDEF>USD</CURDEF>
+<BANKACCTFROM><BANKID>123456789</BANKID><ACCTID>000012345678</ACCTID>
+<ACCTTYPE>CHECKING</ACCTTYPE></BANKACCTFROM>
+<BANKTRANLIST><DTSTART>20100101</DTSTART><DTEND>20160101</DTEND>
+'''
+
+TRANSACTION = '''<STMTTRN>
+<TRNTYPE>DEBIT</TRNTYPE>
+<DTPOSTED>{posted:%Y%m%d%H%M%S}</DTPOSTED>
+<DTAVAIL>{posted:%Y%m%d}</DTAVAIL>
+<TRNAMT>-{cents}.{cents:02}</TRNAMT>
+<FITID>{fitid}</FITID>
+<REFNUM>{fitid}</REFNUM>
+<NAME>Payee {payee}</NAME>
+<MEMO>Purchase at store {payee} ref {fitid}</MEMO>
+</STMTTRN>
+'''
+
+FOOTER = '''</BANKTRANLIST>
+<LEDGERBAL><BALAMT>0.00</BALAMT><DTASOF>20160101</DTASOF></LEDGERBAL>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1>
+</OFX>
+'''
+
+SGML_HEADER = '''OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+<OFX>
+'''
+
+# OFX 1 leaves have no closing tag
+LEAF_CLOSE = re.compile(r'(<(\w+)>[^<]*)</\2>')
+
+def write_ofx(fileobj, count, sgml=False):
+    start = datetime.datetime(2010, 1, 1)
+    header, transaction, footer = HEADER, TRANSACTION, FOOTER
+    if sgml:
+        header = SGML_HEADER + header.split('<OFX>\n', 1)[1]
+        header, transaction, footer = [LEAF_CLOSE.sub(r'\1', text)
+                                       for text in (header, transaction, footer)]
+    fileobj.write(header.encode('utf8'))
+    for i in range(count):
+        posted = start + datetime.timedelta(minutes=30 * i)
+        fileobj.write(transaction.format(posted=posted, cents=i % 100,
+                                         fitid=i, payee=i % 97).encode('utf8'))
+    fileobj.write(footer.encode('utf8'))
+
+
+def bare_iterparse(fileobj):
+    count = 0
+    for event, elem in ET.iterparse(fileobj):
+        if elem.tag == 'STMTTRN':
+            count += 1
+            elem.clear()
+    return count
+
+
+def ofx_iterparse(fileobj):
+    count = 0
+    for tr in ofx.iterparse(fileobj):
+        count += 1
+    return count
+
+
+def timed(label, func, path, count):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fileobj:
+        start = time.perf_counter()
+        parsed = func(fileobj)
+        elapsed = time.perf_counter() - start
+    assert parsed == count
+    print('{:<24} {:8.3f}s {:10.0f} tr/s {:8.1f} MB/s'.format(label, elapsed,
+            count / elapsed, size / elapsed / 2**20))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--transactions', '-n', type=int, default=100000,
+                        help='transactions in each generated file')
+    args = parser.parse_args(argv[1:])
+    count = args.transactions
+    if count <= 0:
+        parser.error('--transactions must be positive')
+
+    with tempfile.NamedTemporaryFile(suffix='.ofx') as xml_file, \
+         tempfile.NamedTemporaryFile(suffix='.ofx') as sgml_file:
+        write_ofx(xml_file, count)
+        write_ofx(sgml_file, count, sgml=True)
+        xml_file.flush()
+        sgml_file.flush()
+        print('parsing {} transactions, {:.1f} MB XML, {:.1f} MB SGML'.format(
+                count, os.path.getsize(xml_file.name) / 2**20,
+                os.path.getsize(sgml_file.name) / 2**20))
+        timed('ofx.iterparse XML', ofx_iterparse, xml_file.name, count)
+        timed('ofx.iterparse SGML', ofx_iterparse, sgml_file.name, count)
+        # before the bare pass, which keeps the cleared elements around
+        # ru_maxrss is in kilobytes on linux
+        print('peak rss {:.1f} MB'.format(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        timed('ElementTree.iterparse', bare_iterparse, xml_file.name, count)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -30,7 +30,8 @@ setup(
                       'gevent==1.1.1',
                       'greenlet==0.4.9',
                       'psycopg2==2.6.1',
-                      'SQLAlchemy==1.0.12'],
+                      'SQLAlchemy==1.3.24'],
+    extras_require={'fastjson': ['simplejson'], 'brotli': ['brotli']},
     test_suite='nose.collector',
     tests_require=['nose', 'webtest']
 )
@@ -20,6 +20,8 @@
 
 """Setup database for testing and rollback after."""
 
+import concurrent.futures
+
 from sqlalchemy import event
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm.session import Session
@@ -64,6 +66,9 @@ def setup_module():
     ses.commit()
     # mock a sessionmaker so all querys are in this transaction
     dbapi._session = lambda: ses
+    dbapi.invalidate_accounts()
+    # the posts above were added directly
+    dbapi.rebuild_balances()
     ses.begin_nested()
 
     @event.listens_for(ses, "after_transaction_end")
@@ -76,3 +81,34 @@ def teardown_module():
     transaction.rollback()
     connection.close()
     engine.dispose()
+
+###############################################################################
+
+class InlineExecutor:
+    """Stand in for dbapi's worker pools that runs calls as they're
+    submitted, the test session can't be shared with another thread.
+    """
+    def submit(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+        future.set_result(func(*args, **kwargs))
+        return future
+
+
+class DeferredExecutor:
+    """Stand in for dbapi's worker pools that holds on to the submitted calls
+    until run is called, like a busy pool would.
+    """
+    def __init__(self):
+        self.calls = []
+
+
+    def submit(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.calls.append((future, func, args, kwargs))
+        return future
+
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for future, func, args, kwargs in calls:
+            future.set_result(func(*args, **kwargs))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import queue
+import zipfile
+
+from RecordSheet import cmdline, dbapi
+from test.test_ofx import ex_ofx
+
+###############################################################################
+
+def test_import_sources(tmp_path, capsys):
+    for name in ['a.ofx', 'b.QFX', 'orders.csv', 'readme.txt']:
+        (tmp_path / name).write_bytes(b'')
+    with zipfile.ZipFile(str(tmp_path / 'archive.zip'), 'w') as archive:
+        archive.writestr('statements/', b'')
+        archive.writestr('statements/c.ofx', ex_ofx)
+        archive.writestr('notes.md', b'')
+
+    path = str(tmp_path) + '/'
+    sources = list(cmdline._import_sources([path + '*', path + 'gone.ofx']))
+    assert sources == [(path + 'a.ofx', None, 'ofx'),
+                       (path + 'archive.zip', 'statements/c.ofx', 'ofx'),
+                       (path + 'b.QFX', None, 'ofx'),
+                       (path + 'orders.csv', None, 'amazon csv'),
+                       (path + 'gone.ofx', None, 'ofx')]
+    err = capsys.readouterr().err
+    assert 'notes.md: unknown format' in err
+    assert 'readme.txt: unknown format' in err
+
+    sources = list(cmdline._import_sources([path + 'readme.txt'], 'ofx'))
+    assert sources == [(path + 'readme.txt', None, 'ofx')]
+
+
+def test_parse_source(tmp_path, monkeypatch):
+    batches = queue.Queue()
+    monkeypatch.setattr(cmdline, '_batches', batches)
+    monkeypatch.setattr(dbapi, 'IMPORT_CHUNK', 1)
+    path = str(tmp_path / 'archive.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('a.ofx', ex_ofx)
+        archive.writestr('bad.ofx', ex_ofx[:-200])
+
+    count, seconds, error = cmdline._parse_source(7, (path, 'a.ofx', 'ofx'))
+    assert (count, error) == (2, None)
+    # sent a chunk at a time, not all at the end
+    sent = [batches.get_nowait() for i in range(2)]
+    assert [(index, len(rows)) for index, rows in sent] == [(7, 1), (7, 1)]
+    assert sent[1][1][0]['ref'] == '77'
+    assert batches.empty()
+
+    count, seconds, error = cmdline._parse_source(8, (path, 'bad.ofx', 'ofx'))
+    assert count == batches.qsize()
+    assert error
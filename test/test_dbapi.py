@@ -1,8 +1,515 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from RecordSheet import dbapi
+import threading
+import time
 
-def test_pw_funcs():
-    pwhash = dbapi.new_pw_hash("test password")
-    assert dbapi.compare_pw("test password", pwhash)
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from RecordSheet import dbapi, dbmodel
+
+from test import dbhelper
+
+###############################################################################
+
+def setup_module():
+    dbhelper.setup_module()
+
+
+def teardown_module():
+    dbhelper.teardown_module()
+
+###############################################################################
+
+def test_login_rehash():
+    user = dbapi.get_user_by_username('testuser')
+    user.password = dbapi.new_pw_hash('passtestword', rounds=1000)
+    dbapi.Session().commit()
+
+    user, success = dbapi.login('testuser', 'passtestword')
+    assert success == 'SUCCESS'
+    assert not dbapi.needs_rehash(user.password)
+    assert dbapi.compare_pw('passtestword', user.password)
+
+###############################################################################
+
+def new_test_transaction(amount):
+    batch = dbapi.new_batch(1)
+    posts = [{'amount':amount, 'account_id':'TEST01'},
+             {'amount':-amount, 'account_id':'TEST02'}]
+    return dbapi.new_transaction(batch, posts, memo='balance test')
+
+
+def test_new_transaction_balance():
+    before = dbapi.get_account(1).totals.balance
+    new_test_transaction(25)
+    acct = dbapi.get_account(1)
+    assert acct.balance == before + 25
+    assert acct.totals.last_datetime is not None
+    assert dbapi.verify_balances() == []
+
+
+def test_void_transaction():
+    journal = new_test_transaction(40)
+    before = dbapi.get_account(2).totals
+    balance, count = before.balance, before.post_count
+    dbapi.void_transaction(journal.id)
+    after = dbapi.get_account(2).totals
+    assert after.balance == balance + 40
+    assert after.post_count == count - 1
+    assert dbapi.verify_balances() == []
+
+    latest = dbapi.new_transaction(dbapi.new_batch(1),
+                [{'account_id':'TEST01', 'amount':1},
+                 {'account_id':'TEST02', 'amount':-1}],
+                memo='latest', datetime='2099-01-01 00:00:00-00')
+    assert dbapi.get_account(2).totals.last_datetime.year == 2099
+    dbapi.void_transaction(latest.id)
+    assert dbapi.get_account(2).totals.last_datetime.year < 2099
+
+
+def test_void_transaction_twice():
+    journal = new_test_transaction(10)
+    dbapi.void_transaction(journal.id)
+    try:
+        dbapi.void_transaction(journal.id)
+    except dbapi.DBException:
+        pass
+    else:
+        assert False, 'voided twice'
+
+
+def test_rebuild_balances():
+    ses = dbapi.Session()
+    ses.query(dbmodel.AccountBalance).update({'balance': 12345})
+    assert len(dbapi.verify_balances()) > 0
+    dbapi.rebuild_balances()
+    assert dbapi.verify_balances() == []
+
+
+def test_account_balances():
+    dbapi.new_account('TEST17:SUB', 'subtree')
+    dbapi.new_account('TEST17_OTHER', 'not in the subtree')
+    names = [b.name for b in dbapi.account_balances(prefix='TEST17')]
+    assert names == ['TEST17:SUB']
+
+    account = dbapi.get_account_by_name('TEST17:SUB')
+    account.closed = True
+    assert not dbapi.account_balances(prefix='TEST17')
+    closed = dbapi.account_balances(prefix='TEST17', include_closed=True)
+    assert [b.account_id for b in closed] == [account.id]
+
+    # the stored balances match summing every post
+    new_test_transaction(7)
+    void = new_test_transaction(3)
+    dbapi.void_transaction(void.id)
+    assert (dbapi.account_balances() ==
+            dbapi.account_balances(as_of='9999-01-01 00:00:00-00'))
+
+###############################################################################
+
+def test_account_directory():
+    names, closed = dbapi.account_directory()
+    assert names['TEST01'] == 1
+    assert dbapi.account_directory() is dbapi.account_directory()
+
+    dbapi.new_account('TEST03', 'test account 03')
+    names, closed = dbapi.account_directory()
+    assert 'TEST03' in names
+
+    # uncommitted accounts are seen by their own transaction, not cached
+    ses = dbapi.Session()
+    ses.add(dbmodel.Account(name='TEST04', desc='rolled back'))
+    assert 'TEST04' in dbapi.account_directory()[0]
+    ses.rollback()
+    assert 'TEST04' not in dbapi.account_directory()[0]
+
+    # another process closes an account, only the version tells this one
+    cached = dbapi.account_directory()
+    accounts = dbmodel.Account.__table__
+    versions = dbmodel.TableVersion.__table__
+    ses.execute(accounts.update().where(accounts.c.name == 'TEST03')
+                .values(closed=True))
+    ses.execute(versions.update().where(versions.c.table == 'accounts')
+                .values(version=versions.c.version + 1))
+    ses.commit()
+    assert dbapi._accounts[1] is cached
+    names, closed = dbapi.account_directory()
+    assert names['TEST03'] in closed
+    dbapi.get_account_by_name('TEST03').closed = False
+    ses.commit()
+    assert names['TEST03'] not in dbapi.account_directory()[1]
+
+###############################################################################
+
+def test_new_transactions():
+    before = dbapi.get_account(1).totals
+    balance, count = before.balance, before.post_count
+    entries = [{'memo':'bulk {}'.format(i),
+                'posts':[{'amount':i, 'account_id':'TEST01'},
+                         {'amount':-i, 'account_id':'TEST02'}]}
+                for i in range(1, 11)]
+
+    ids = dbapi.new_transactions(dbapi.new_batch(1), entries)
+    assert len(ids) == 10
+    assert [dbapi.get_journal(id).memo for id in ids] == \
+                [entry['memo'] for entry in entries]
+    assert len(dbapi.get_journal(ids[-1]).posts) == 2
+
+    after = dbapi.get_account(1).totals
+    assert after.balance == balance + 55
+    assert after.post_count == count + 10
+    assert dbapi.verify_balances() == []
+
+
+def test_new_transactions_invalid():
+    entries = [{'memo':'good',
+                'posts':[{'amount':1, 'account_id':'TEST01'},
+                         {'amount':-1, 'account_id':'TEST02'}]},
+               {'memo':'unbalanced',
+                'posts':[{'amount':1, 'account_id':'TEST01'},
+                         {'amount':-2, 'account_id':'TEST02'}]},
+               {'memo':'', 'posts':[]}]
+    try:
+        dbapi.new_transactions(dbapi.new_batch(1), entries)
+    except dbapi.EntryError as exc:
+        assert set(exc.errors) == {1, 2}
+    else:
+        assert False, 'invalid entries were accepted'
+
+
+def test_new_transactions_malformed():
+    entries = [{'memo':'good',
+                'posts':[{'amount':1, 'account_id':'TEST01'},
+                         {'amount':-1, 'account_id':'TEST02'}]},
+               None, 'entry', {'memo':'no posts'}, {'memo':'', 'posts':[]}]
+    try:
+        dbapi.new_transactions(dbapi.new_batch(1), entries)
+    except dbapi.EntryError as exc:
+        # checked in one pass, the invalid entry is reported too
+        assert set(exc.errors) == {1, 2, 3, 4}
+    else:
+        assert False, 'malformed entries were accepted'
+
+
+def test_new_transactions_datetime():
+    entries = [{'memo':'dated', 'datetime':'2016-06-05 14:09:00-05',
+                'posts':[{'amount':1, 'account_id':'TEST01'},
+                         {'amount':-1, 'account_id':'TEST02'}]},
+               {'memo':'now',
+                'posts':[{'amount':1, 'account_id':'TEST01'},
+                         {'amount':-1, 'account_id':'TEST02'}]}]
+    dated, now = dbapi.new_transactions(dbapi.new_batch(1), entries)
+    assert dbapi.get_journal(dated).datetime.year == 2016
+    assert dbapi.get_journal(now).datetime is not None
+    assert dbapi.get_journal(now).void == False
+
+###############################################################################
+
+def imported_rows(tids):
+    for tid in tids:
+        yield {'account_hint':'', 'datetime':'2016-06-05 14:09:00-05',
+               'amount':1, 'memo':'imported', 'ref':'', 'fitid':tid,
+               'tid':tid}
+
+
+def test_insert_imported_transactions():
+    tids = ['tid{}'.format(i) for i in range(5)]
+    result = dbapi.insert_imported_transactions(imported_rows(tids),
+                                                chunk_size=2)
+    assert result == (5, 0)
+
+    # repeats in the same import and rows that were already imported
+    tids = ['tid4', 'tid5', 'tid5', 'tid6']
+    result = dbapi.insert_imported_transactions(imported_rows(tids),
+                                                chunk_size=2)
+    assert result == (2, 2)
+
+    # rows without a tid are never duplicates
+    result = dbapi.insert_imported_transactions(imported_rows([None, None]))
+    assert result == (2, 0)
+
+
+def test_import_job(monkeypatch):
+    monkeypatch.setattr(dbapi, '_import_pool', dbhelper.InlineExecutor())
+    tids = ['tid-job0', 'tid-job1', 'tid-job1']
+    job = dbapi.new_import_job(imported_rows(tids), 'job.ofx', 'ofx')
+    job = dbapi.get_import_job(job.id)
+    assert (job.status, job.parsed, job.inserted, job.duplicates) == \
+            ('done', 3, 2, 1)
+    assert job.filename == 'job.ofx'
+    assert job.error is None
+    assert job.finished is not None
+
+
+def test_import_job_failed():
+    def rows():
+        yield from imported_rows(['tid-fail0', 'tid-fail1'])
+        raise ValueError('bad row')
+
+    job = dbmodel.ImportJob()
+    ses = dbapi.Session()
+    ses.add(job)
+    ses.commit()
+    dbapi.run_import_job(job.id, rows(), chunk_size=1)
+    job = dbapi.get_import_job(job.id)
+    assert (job.status, job.parsed, job.inserted) == ('failed', 2, 2)
+    assert job.error == 'bad row'
+
+
+def test_table_version():
+    version = dbapi.table_version('imported_transactions', 'accounts')
+    dbapi.insert_imported_transactions(imported_rows(['tid-version']))
+    assert dbapi.table_version('imported_transactions', 'accounts') != version
+
+    version = dbapi.table_version('accounts')
+    dbapi.new_account('TEST_VERSION', 'version')
+    assert dbapi.table_version('accounts') != version
+
+    # the counters are in the database, shared by every process
+    ses = dbapi._session()
+    versions = dbmodel.TableVersion.__table__
+    version = dbapi.table_version('accounts')
+    ses.execute(versions.update().where(versions.c.table == 'accounts')
+                .values(version=versions.c.version + 1))
+    assert dbapi.table_version('accounts') != version
+
+    # a rolled back bump doesn't stop the next one
+    version = dbapi.table_version('journal')
+    ses.begin_nested()
+    dbapi.touch(ses, 'journal')
+    ses.rollback()
+    ses.commit()
+    assert dbapi.table_version('journal') == version
+    # bumped when the transaction commits
+    dbapi.touch(ses, 'journal')
+    assert dbapi.table_version('journal') == version
+    ses.commit()
+    assert dbapi.table_version('journal') != version
+
+
+def test_change_feed():
+    since = dbapi.last_change()
+    account = dbapi.new_account('TEST_CHANGES', 'change feed')
+    dbapi.insert_imported_transactions(imported_rows(['tid-changes']))
+    changes = [(c.table, c.op) for c in dbapi.get_changes(since)]
+    assert changes == [('accounts', 'insert'),
+                       ('imported_transactions', 'insert')]
+
+    last = dbapi.last_change()
+    assert dbapi.get_changes(last) == []
+    account.closed = True
+    dbapi._session().commit()
+    change, = dbapi.get_changes(last)
+    assert (change.table, change.row_id, change.op) == \
+            ('accounts', account.id, 'update')
+
+    # written at commit, without a rolled back savepoint's changes
+    last = dbapi.last_change()
+    ses = dbapi._session()
+    account.desc = 'kept'
+    ses.flush()
+    ses.begin_nested()
+    account.closed = False
+    ses.flush()
+    ses.rollback()
+    assert dbapi.get_changes(last) == []
+    ses.commit()
+    change, = dbapi.get_changes(last)
+    assert (change.row_id, change.op) == (account.id, 'update')
+
+
+def test_change_feed_wait(monkeypatch):
+    # the test session is always in a savepoint, which waiting refuses
+    since = dbapi.last_change()
+    try:
+        dbapi.get_changes(since, wait=0.1)
+    except dbapi.DBException:
+        pass
+    else:
+        assert False, 'waited inside a transaction'
+
+    # joins the test transaction without a savepoint
+    ses = Session(bind=dbhelper.connection)
+    monkeypatch.setattr(dbapi, '_session', lambda: ses)
+    start = time.monotonic()
+    assert dbapi.get_changes(since, wait=0.1) == []
+    assert time.monotonic() - start >= 0.1
+
+    # made while waiting. The session isn't thread safe, but get_changes
+    # doesn't use it until notified. The test transaction never commits,
+    # so the NOTIFY is sent from another connection.
+    def add_change():
+        # the waiter doesn't hold a pool connection, only the test's
+        checkedout.append(dbhelper.engine.pool.checkedout())
+        dbapi._session().execute(dbmodel.Change.__table__.insert(),
+                                 {'table':'accounts', 'op':'test'})
+        dbhelper.engine.execute(select([func.pg_notify(dbapi.CHANGES_CHANNEL,
+                                                       '')])
+                                .execution_options(autocommit=True))
+
+    checkedout = []
+    timer = threading.Timer(0.1, add_change)
+    timer.start()
+    changes = dbapi.get_changes(since, wait=5)
+    timer.join()
+    assert [c.op for c in changes] == ['test']
+    assert checkedout == [1]
+    assert time.monotonic() - start < 5
+    ses.close()
+
+###############################################################################
+
+def test_get_journals_paging():
+    everything = dbapi.get_journals()
+    assert everything.next is None and everything.prev is None
+
+    seen = []
+    page = dbapi.get_journals(limit=3)
+    while True:
+        seen.extend(j.id for j in page)
+        if page.next is None:
+            break
+        page = dbapi.get_journals(limit=3, after=page.next)
+
+    assert seen == [j.id for j in everything]
+
+    # and back again
+    prev = dbapi.get_journals(limit=3, before=page.prev)
+    assert [j.id for j in prev] == seen[-len(page)-3:-len(page)]
+
+
+def test_paginate_nulls():
+    ses = dbapi._session()
+    batch = dbapi.new_batch(1)
+    ses.add(batch)
+    ses.flush()
+    ses.add_all([dbmodel.Journal(memo=memo, batch_id=batch.id)
+                 for memo in [None, 'b', None, 'a', 'b', None]])
+    ses.flush()
+
+    qry = ses.query(dbmodel.Journal)
+    for descending in [False, True]:
+        order = [(dbmodel.Journal.__table__.c.memo, descending),
+                 (dbmodel.Journal.__table__.c.id, False)]
+        everything = dbapi.paginate(qry, order)
+        seen = []
+        page = dbapi.paginate(qry, order, limit=2)
+        while True:
+            seen.extend(j.id for j in page)
+            if page.next is None:
+                break
+            page = dbapi.paginate(qry, order, limit=2, after=page.next)
+        assert seen == [j.id for j in everything]
+
+        back = []
+        while page.prev is not None:
+            page = dbapi.paginate(qry, order, limit=2, before=page.prev)
+            back[:0] = [j.id for j in page]
+        assert back == seen[:len(back)]
+        assert len(back) >= len(seen) - 2
+
+
+def test_seek_journals():
+    # the journal order is NOT NULL, so it seeks with one row value
+    # comparison that can range scan ix_journal_datetime_id
+    Journal = dbmodel.Journal
+    order = [(Journal.datetime, True), (Journal.id, True)]
+    clause = dbapi._seek(order, ['2016-06-05 14:09:00-05', 5])
+    assert str(clause) == \
+        '(journal.datetime, journal.id) < (:param_1, :param_2)'
+
+
+def test_get_imported_transactions_paging():
+    page = dbapi.get_imported_transactions(limit=2)
+    assert len(page) == 2
+    assert page.prev is None
+    second = dbapi.get_imported_transactions(limit=2, after=page.next)
+    assert second[0].id not in [tr.id for tr in page]
+    assert [tr.id for tr in dbapi.get_imported_transactions(limit=2,
+                before=second.prev)] == [tr.id for tr in page]
+
+###############################################################################
+
+def test_migrate():
+    ses = dbapi.Session()
+    ses.execute('DROP INDEX ix_posts_account_id')
+    ses.execute('ALTER TABLE accounts DROP COLUMN closed')
+    ses.execute('ALTER TABLE account_balances DROP COLUMN debits')
+    ses.execute('ALTER TABLE journal ALTER COLUMN datetime DROP NOT NULL')
+    batch = dbapi.new_batch(1)
+    ses.add(batch)
+    ses.flush()
+    journal = dbmodel.Journal.__table__
+    ses.execute(journal.insert().values(memo='no date', datetime=None,
+                                        batch_id=batch.id))
+    ses.commit()
+
+    changes = dbapi.migrate(dry_run=True)
+    assert 'created index ix_posts_account_id' in changes
+    assert 'added column accounts.closed' in changes
+    assert 'added column account_balances.debits' in changes
+    assert 'rebuilt account balances' in changes
+
+    changes = dbapi.migrate()
+    assert 'created index ix_posts_account_id' in changes
+    assert 'made column journal.datetime not null' in changes
+    assert ses.query(dbmodel.Journal) \
+                .filter(dbmodel.Journal.datetime == None).count() == 0
+    assert dbapi.migrate() == []
+    assert dbapi.verify_balances() == []
+
+###############################################################################
+
+def import_posts(tid):
+    dbapi.insert_imported_transactions(imported_rows([tid]))
+    imp = dbapi.Session().query(dbmodel.ImportedTransaction) \
+                .filter_by(tid=tid).one()
+    return [{'id':imp.id, 'amount':1, 'account_id':'TEST01', 'fitid':tid,
+             'memo':None, 'ref':''},
+            {'amount':-1, 'account_id':'TEST02'}], imp
+
+
+def test_imported_transactions_unposted_index():
+    ses = dbapi.Session()
+    qry = ses.query(dbmodel.ImportedTransaction.id) \
+                .filter(dbmodel.ImportedTransaction.posted.isnot(True)) \
+                .order_by(dbmodel.ImportedTransaction.datetime,
+                          dbmodel.ImportedTransaction.id)
+    ses.execute('SET LOCAL enable_seqscan = off')
+    ses.execute('SET LOCAL enable_sort = off')
+    plan = ses.execute('EXPLAIN ' + str(qry.statement.compile(
+                            dialect=ses.bind.dialect,
+                            compile_kwargs={'literal_binds': True})))
+    assert 'ix_imported_transactions_unposted' in \
+                ' '.join(row[0] for row in plan)
+    ses.rollback()
+
+
+def test_new_transaction_import():
+    posts, imp = import_posts('post-import')
+    journal = dbapi.new_transaction(dbapi.new_batch(1), posts, memo='import')
+    assert imp.posted
+    assert journal.posts[0].memo == 'imported'
+
+    try:
+        dbapi.new_transaction(dbapi.new_batch(1), posts, memo='again')
+    except dbapi.DBException:
+        pass
+    else:
+        assert False, 'posted an import twice'
+
+
+def test_new_transactions_import_twice():
+    posts, imp = import_posts('bulk-import')
+    entries = [{'memo':'first', 'posts':posts},
+               {'memo':'second', 'posts':posts}]
+    try:
+        dbapi.new_transactions(dbapi.new_batch(1), entries)
+    except dbapi.EntryError as exc:
+        assert list(exc.errors) == [1]
+    else:
+        assert False, 'posted an import twice'
+
+    assert not imp.posted
@@ -18,6 +18,8 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+
 from nose.tools import with_setup
 from webtest import TestApp
 
@@ -26,7 +28,7 @@ from sqlalchemy.engine import create_engine
 from sqlalchemy.orm.session import Session
 
 from RecordSheet.dbapi import Base
-from RecordSheet import jsonapp, dbapi, dbmodel, plugins
+from RecordSheet import jsonapp, dbapi, dbmodel, plugins, util
 app = TestApp(jsonapp.app, extra_environ={'beaker.session':{'user_id':1}})
 
 from test import dbhelper
@@ -51,6 +53,115 @@ def test_generic_collection():
     assert response.content_type == 'application/json'
 
 
+def test_generic_collection_cursor():
+    response = app.get('/accounts?sort=name.desc&limit=1')
+    first = response.json['accounts'][0]
+    assert response.json['prev'] is None
+
+    url = '/accounts?sort=name.desc&limit=1&after=' + response.json['next']
+    response = app.get(url)
+    assert response.json['accounts'][0]['name'] < first['name']
+
+    url = '/accounts?sort=name.desc&limit=1&before=' + response.json['prev']
+    response = app.get(url)
+    assert response.json['accounts'][0] == first
+
+
+def test_generic_collection_bad_cursor():
+    app.get('/accounts?limit=1&after=garbage', status=400)
+
+
+def test_generic_collection_stream():
+    for url in ['/posts?sort=id.desc', '/posts?sort=id.desc&limit=2',
+                '/accounts?limit=1&after=' + app.get('/accounts?limit=1')
+                                                .json['next']]:
+        expected = app.get(url).json
+        response = app.get(url + '&stream=json')
+        assert response.content_type == 'application/json'
+        assert response.json == expected
+
+
+def test_generic_collection_stream_ndjson():
+    expected = app.get('/posts').json['posts']
+    headers = {'Accept':'application/x-ndjson'}
+    response = app.get('/posts', headers=headers)
+    assert response.content_type == 'application/x-ndjson'
+    lines = response.text.splitlines()
+    assert [json.loads(line) for line in lines] == expected
+
+    response = app.get('/posts?stream=ndjson&limit=1')
+    assert len(response.text.splitlines()) == 1
+
+
+def test_generic_collection_stream_before():
+    app.get('/posts?stream=json&before=abc', status=400)
+
+
+def test_generic_collection_matches_json_obj():
+    ses = dbapi._session()
+    for kind, cls in jsonapp.sorte.items():
+        response = app.get('/{}?limit=3'.format(kind))
+        expected = [obj.json_obj() for obj in
+                    ses.query(cls).order_by(cls.id).limit(3)]
+        assert response.body.decode('utf8').startswith(
+                '{{"{}":{}'.format(kind, util.jsonDumps(expected)[:-1]))
+
+
+def test_generic_collection_fields():
+    response = app.get('/accounts?fields=name,desc&sort=name&limit=1')
+    first = response.json['accounts'][0]
+    assert set(first) == {'name', 'desc'}
+
+    url = '/accounts?fields=name&sort=name&limit=1&after='
+    response = app.get(url + response.json['next'])
+    assert set(response.json['accounts'][0]) == {'name'}
+    assert response.json['accounts'][0]['name'] > first['name']
+
+    response = app.get('/accounts?fields=name,id,name&fields=id&limit=1')
+    assert response.body.decode('utf8').startswith('{"accounts":[{"name":')
+    assert list(response.json['accounts'][0]) == ['name', 'id']
+
+
+def test_generic_collection_filters():
+    posts = app.get('/posts?account_id=1&_=123').json['posts']
+    assert posts and all(p['account_id'] == 1 for p in posts)
+
+    posts = app.get('/posts?amount.lt=0&amount.ne=-5').json['posts']
+    assert posts and all(p['amount'] < 0 for p in posts)
+
+    accounts = app.get('/accounts?name.prefix=TEST0').json['accounts']
+    assert accounts and all(a['name'].startswith('TEST0') for a in accounts)
+    # _ is matched literally, not as a LIKE wildcard
+    accounts = app.get('/accounts?name.prefix=TEST_').json['accounts']
+    assert all(a['name'].startswith('TEST_') for a in accounts)
+
+    url = '/journal?datetime.gte=2016-06-05T19:09:00Z&void=false'
+    assert app.get(url).json['journal']
+    assert not app.get('/journal?datetime.gt=2100-01-01').json['journal']
+
+
+def test_generic_collection_invalid_filters():
+    for url in ['/accounts?nope=1', '/accounts?id=abc', '/accounts?id.prefix=1',
+                '/accounts?name.like=x', '/accounts?fields=nope',
+                '/posts?amount=lots', '/journal?datetime.gte=yesterday',
+                '/journal?void=maybe']:
+        app.get(url, status=400)
+
+
+def test_generic_collection_etag():
+    url = '/accounts?sort=name.asc'
+    etag = app.get(url).headers['ETag']
+    assert etag.startswith('W/')
+
+    response = app.get(url, headers={'If-None-Match':etag}, status=304)
+    assert response.headers['ETag'] == etag
+    assert not response.body
+
+    app.put_json('/accounts', {'name':'TEST_ETAG', 'desc':'etag'})
+    response = app.get(url, headers={'If-None-Match':etag}, status=200)
+    assert response.headers['ETag'] != etag
+
+
 def test_generic_collection_404():
     response = app.get('/doesnotexist', status=404)
     assert response.status_int == 404
@@ -75,6 +186,116 @@ def test_generic_item_invalid_id():
     assert response.status_int == 404
     assert response.content_type == 'application/json'
 
+def test_import_job():
+    ses = dbapi.Session()
+    job = dbmodel.ImportJob(filename='job.ofx', status='running', parsed=10)
+    ses.add(job)
+    ses.commit()
+    response = app.get('/import_jobs/{}'.format(job.id))
+    assert response.json['status'] == 'running'
+    assert response.json['parsed'] == 10
+    etag = response.headers['ETag']
+    app.get('/import_jobs/{}'.format(job.id),
+            headers={'If-None-Match':etag}, status=304)
+
+    job.parsed = 20
+    ses.commit()
+    response = app.get('/import_jobs/{}'.format(job.id),
+                       headers={'If-None-Match':etag})
+    assert response.json['parsed'] == 20
+    app.get('/import_jobs/0', status=404)
+
+###############################################################################
+
+def test_account_balances():
+    url = '/accounts/balances?prefix=test01&as_of='
+    balances = app.get(url + '2016-06-05').json['balances']
+    assert len(balances) == 1
+    assert balances[0]['name'] == 'TEST01'
+    assert balances[0]['balance'] == balances[0]['credits'] == 100
+    assert balances[0]['debits'] == 0
+    assert balances[0]['post_count'] == 1
+    assert balances[0]['last_datetime'].startswith('2016-06-05')
+
+    balance = app.get(url + '2016-06-04T23:59:59-05:00').json['balances'][0]
+    assert balance['balance'] == balance['post_count'] == 0
+    assert balance['last_datetime'] is None
+
+    app.get('/accounts/balances?as_of=someday', status=400)
+    app.get('/accounts/balances?include_closed=maybe', status=400)
+
+    # a rebuild only writes account_balances
+    etag = app.get('/accounts/balances').headers['ETag']
+    dbapi.rebuild_balances()
+    response = app.get('/accounts/balances', headers={'If-None-Match':etag})
+    assert response.status_int == 200
+    assert response.headers['ETag'] != etag
+
+def test_account_ledger():
+    dbapi.new_transaction(dbapi.new_batch(1), memo='ledger',
+            datetime='2016-06-06 12:00:00-05',
+            posts=[{'account_id':'TEST01', 'amount':'-30.5'},
+                   {'account_id':'TEST02', 'amount':'30.5'}])
+
+    response = app.get('/accounts/1/ledger.ndjson?to=2016-06-06')
+    assert response.content_type == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['amount'] for row in rows] == [100, -30.5]
+    assert [row['balance'] for row in rows] == [100, 69.5]
+
+    # the balance includes the posts before from
+    response = app.get('/accounts/1/ledger.csv?from=2016-06-06&to=2016-06-06')
+    lines = response.text.splitlines()
+    assert len(lines) == 2 and lines[1].endswith(',-30.5,69.5')
+
+    app.get('/accounts/0/ledger.csv', status=404)
+    app.get('/accounts/1/ledger.csv?from=someday', status=400)
+
+###############################################################################
+
+def test_stats():
+    response = app.get('/_stats')
+    assert response.status_int == 200
+    assert 'live_sessions' in response.json['sessions']
+
+###############################################################################
+
+def test_batch():
+    requests = [{'method':'PUT', 'url':'/accounts',
+                 'body':{'name':'TEST_BATCH', 'desc':'batch'}},
+                {'method':'GET', 'url':'/json/accounts?name=TEST_BATCH'},
+                {'method':'PUT', 'url':'/accounts', 'body':{'nope':1}},
+                {'method':'GET', 'url':'/doesnotexist/1'},
+                {'method':'DELETE', 'url':'/accounts/1'}]
+    # mounted at /json like in webapp
+    response = app.post_json('/_batch', {'requests':requests},
+                             extra_environ={'SCRIPT_NAME':'/json'})
+    responses = response.json['responses']
+    assert [r['status'] for r in responses] == [200, 200, 400, 404, 405]
+    assert responses[0]['body']['name'] == 'TEST_BATCH'
+    assert responses[1]['body']['accounts'] == [responses[0]['body']]
+    assert responses[2]['body']['errorMsg']
+
+
+def test_batch_atomic():
+    requests = [{'method':'PUT', 'url':'/accounts',
+                 'body':{'name':'TEST_ATOMIC', 'desc':'atomic'}},
+                {'method':'PUT', 'url':'/accounts', 'body':{'nope':1}},
+                {'method':'GET', 'url':'/accounts'}]
+    response = app.post_json('/_batch', {'requests':requests, 'atomic':True},
+                             status=400)
+    assert [r['status'] for r in response.json['responses']] == [200, 400]
+    assert not app.get('/accounts?name=TEST_ATOMIC').json['accounts']
+
+
+def test_batch_invalid():
+    app.post_json('/_batch', {'requests':'nope'}, status=400)
+    app.post_json('/_batch', {'requests':[{}] * 101}, status=400)
+    requests = [{'method':'POST', 'url':'/_batch', 'body':{'requests':[]}},
+                {'method':'GET', 'url':'/posts?stream=ndjson'}]
+    response = app.post_json('/_batch', {'requests':requests})
+    assert [r['status'] for r in response.json['responses']] == [400, 400]
+
 ###############################################################################
 
 data = {'name':'TEST145', 'desc':'test_145'}
@@ -136,6 +357,66 @@ def test_journal_put():
     assert response.content_type == 'application/json'
     assert 'id' in response.json
 
+
+def test_journal_bulk_put():
+    posts = [{'amount':100, 'account_id':'TEST01'},
+             {'amount':-100, 'account_id':'TEST02'}]
+    entries = [{'memo':'bulk entry', 'posts':posts} for i in range(3)]
+
+    response = app.put_json('/journal/bulk', {'entries':entries})
+    assert response.status_int == 200
+    assert len(response.json['journal']) == 3
+
+
+def test_journal_bulk_put_invalid():
+    entries = [{'memo':'', 'posts':[]}]
+    response = app.put_json('/journal/bulk', {'entries':entries}, status=400)
+    assert response.content_type == 'application/json'
+    assert '0' in response.json['errors']
+
+    entries = [{'memo':'', 'posts':[]}, None]
+    response = app.put_json('/journal/bulk', {'entries':entries}, status=400)
+    assert sorted(response.json['errors']) == ['0', '1']
+    app.put_json('/journal/bulk', {'entries':'entries'}, status=400)
+    app.put_json('/journal/bulk', [], status=400)
+
+
+def test_journal_put_closed_account():
+    acct = app.put_json('/accounts', {'name':'TESTCLOSED'}).json
+    app.post_json('/accounts/{}'.format(acct['id']), {'closed':True})
+
+    posts = [{'amount':5, 'account_id':'TEST01'},
+             {'amount':-5, 'account_id':'TESTCLOSED'}]
+    data = {'memo':'test closed', 'posts':posts}
+    app.put_json('/journal', data, status=400)
+
+
+def test_journal_void():
+    posts = [{'amount':5, 'account_id':'TEST01'},
+             {'amount':-5, 'account_id':'TEST02'}]
+    data = {'memo':'test void', 'posts':posts}
+    journal_id = app.put_json('/journal', data).json['id']
+
+    response = app.post_json('/journal/{}/void'.format(journal_id), {})
+    assert response.status_int == 200
+    assert response.json['void'] == True
+
+    app.post_json('/journal/{}/void'.format(journal_id), {}, status=400)
+
+
+def test_journal_void_generic_post():
+    app.post_json('/journal/1', {'void':True}, status=400)
+
+
+def test_posts_generic_write():
+    post = app.get('/posts/1').json
+    app.post_json('/posts/1', {'amount':5}, status=400)
+    app.put_json('/posts', {'journal_id':post['journal_id'],
+                            'account_id':post['account_id'], 'amount':5},
+                 status=400)
+    assert app.get('/posts/1').json['amount'] == post['amount']
+    app.put_json('/doesnotexist', {}, status=404)
+
 ###############################################################################
 
 def test_imported_transactions_get():
@@ -144,3 +425,24 @@ def test_imported_transactions_get():
     assert 'imported_transactions' in response.json
 
 ###############################################################################
+
+def test_changes():
+    last_seq = app.get('/changes').json['last_seq']
+    app.put_json('/accounts', {'name':'TEST_FEED', 'desc':'feed'})
+    response = app.get('/changes?since={}'.format(last_seq))
+    changes = response.json['changes']
+    assert [(c['table'], c['op']) for c in changes] == [('accounts', 'insert')]
+    assert response.json['last_seq'] == changes[-1]['seq']
+
+    response = app.get('/changes?since={}'.format(changes[-1]['seq']))
+    assert response.json == {'changes':[], 'last_seq':changes[-1]['seq']}
+
+    app.get('/changes?since=abc', status=400)
+    app.get('/changes?since=1&wait=nan', status=400)
+    app.get('/changes?since=1&limit=0', status=400)
+    app.get('/changes?since=1&limit=-5', status=400)
+
+    # a batch's transaction would be held open while waiting
+    body = {'requests':[{'url':'/changes?since=1&wait=1'}]}
+    response = app.post_json('/_batch', body)
+    assert response.json['responses'][0]['status'] == 400
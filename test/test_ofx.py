@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from datetime import date, datetime
+from decimal import Decimal
+import hashlib
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from RecordSheet import mport, ofx
+
+
+ex_ofx = b'''<?xml version="1.0" encoding="UTF-8"?>
+<?OFX OFXHEADER="200" VERSION="211" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>
+<OFX>
+ <BANKMSGSRSV1>
+  <STMTTRNRS>
+   <TRNUID>1</TRNUID>
+   <STMTRS>
+    <CURDEF>USD</CURDEF>
+    <BANKACCTFROM>
+     <BANKID>123456789</BANKID>
+     <ACCTID>000012345678</ACCTID>
+     <ACCTTYPE>CHECKING</ACCTTYPE>
+    </BANKACCTFROM>
+    <BANKTRANLIST>
+     <DTSTART>20160501</DTSTART>
+     <DTEND>20160531</DTEND>
+     <STMTTRN>
+      <TRNTYPE>DEBIT</TRNTYPE>
+      <DTPOSTED>20160503120000</DTPOSTED>
+      <DTAVAIL>20160504</DTAVAIL>
+      <TRNAMT>-12.50</TRNAMT>
+      <FITID>A1</FITID>
+      <NAME>Coffee &amp; Co</NAME>
+      <MEMO>Coffee &amp;amp; Co</MEMO>
+     </STMTTRN>
+     <STMTTRN>
+      <TRNTYPE>CREDIT</TRNTYPE>
+      <DTPOSTED>20160515000000</DTPOSTED>
+      <DTAVAIL>20160515</DTAVAIL>
+      <TRNAMT>1000.00</TRNAMT>
+      <FITID>A2</FITID>
+      <REFNUM>77</REFNUM>
+      <NAME>Payroll</NAME>
+      <MEMO>Payroll</MEMO>
+     </STMTTRN>
+    </BANKTRANLIST>
+   </STMTRS>
+  </STMTTRNRS>
+ </BANKMSGSRSV1>
+</OFX>
+'''
+
+
+def test_iterparse():
+    accounts = []
+    trs = list(ofx.iterparse(io.BytesIO(ex_ofx), accounts))
+    assert len(accounts) == 1
+    acct = accounts[0]
+    assert acct.routing_number == '123456789'
+    assert acct.acount_number == '000012345678'
+    assert acct.type == 'CHECKING'
+    assert acct.statement.start_date == '20160501'
+    assert acct.statement.end_date == '20160531'
+    # transactions are only collected by the ofx class
+    assert acct.statement.transactions == []
+
+    assert [tr.fitid for tr in trs] == ['A1', 'A2']
+    assert all(tr.account is acct for tr in trs)
+    tr = trs[0]
+    assert tr.type == 'DEBIT'
+    assert tr.posted == datetime(2016,5,3,12,0,0)
+    assert tr.date_available == date(2016,5,4)
+    assert tr.amount == Decimal('-12.50')
+    assert tr.refnum is None
+    assert tr.payee == 'Coffee & Co'
+    assert trs[1].refnum == '77'
+
+
+def test_iterparse_is_lazy():
+    trs = ofx.iterparse(io.BytesIO(ex_ofx))
+    first = next(trs)
+    assert first.fitid == 'A1'
+    assert first.account.statement.end_date is None
+
+
+def test_ofx():
+    data = ofx.ofx(io.BytesIO(ex_ofx))
+    assert len(data.accounts) == 1
+    transactions = data.accounts[0].statement.transactions
+    assert [tr.amount for tr in transactions] == [Decimal('-12.50'),
+                                                  Decimal('1000.00')]
+
+
+def test_import_ofx():
+    rows = list(mport.import_ofx(io.BytesIO(ex_ofx)))
+    assert len(rows) == 2
+    assert rows[0]['account_hint'] == 'XXXX5678'
+    assert rows[0]['memo'] == 'Coffee & Co'
+    assert rows[0]['datetime'] == datetime(2016,5,3,12,0,0)
+    tid = hashlib.sha1(b'123456789000012345678A2').hexdigest()
+    assert rows[1]['tid'] == tid
+    assert rows[1]['ref'] == '77'
+
+
+def test_fields():
+    tag = ET.fromstring('<STMTTRN><FITID>A1</FITID><REFNUM/></STMTTRN>')
+    assert ofx.fields(tag) == {'FITID':'A1', 'REFNUM':''}
+    tag = ET.fromstring('<STMTTRN><FITID> A1\n</FITID><PAYEE>\n '
+                        '<NAME> Shop </NAME><CITY>X</CITY></PAYEE>'
+                        '<MEMO>  </MEMO></STMTTRN>')
+    assert ofx.fields(tag) == {'FITID':'A1', 'PAYEE':'Shop', 'MEMO':''}
+
+
+def test_parse_datetime():
+    assert ofx.parse_datetime('20160503120005') == datetime(2016,5,3,12,0,5)
+    assert ofx.parse_date('20160503') == date(2016,5,3)
+    assert (ofx.parse_datetime('20160503120005.123[-5:EST]')
+            == datetime(2016,5,3,12,0,5))
+    assert ofx.parse_datetime('201605031200') == datetime(2016,5,3,12,0)
+    with pytest.raises(ValueError):
+        ofx.parse_datetime('20161303120005')
+    with pytest.raises(ValueError):
+        ofx.parse_date('2016050')
+
+
+ex_sgml = b'''OFXHEADER:100
+DATA:OFXSGML
+VERSION:102
+SECURITY:NONE
+ENCODING:USASCII
+CHARSET:1252
+COMPRESSION:NONE
+OLDFILEUID:NONE
+NEWFILEUID:NONE
+
+<OFX>
+<SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO</STATUS>
+<DTSERVER>20160601083000.000[-5:EST]<LANGUAGE>ENG</SONRS></SIGNONMSGSRSV1>
+<BANKMSGSRSV1>
+<STMTTRNRS>
+<TRNUID>1
+<STMTRS>
+<CURDEF>USD
+<BANKACCTFROM>
+<BANKID>123456789
+<ACCTID>000012345678
+<ACCTTYPE>CHECKING
+</BANKACCTFROM>
+<BANKTRANLIST>
+<DTSTART>20160501
+<DTEND>20160531
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20160503120000.000[-5:EST]
+<DTAVAIL>20160504
+<TRNAMT>-12.50
+<FITID>A1
+<NAME>Caf\xe9 &amp; Co
+<MEMO>Coffee &amp;amp; Co
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>CREDIT
+<DTPOSTED>20160515
+<TRNAMT>1000.00
+<FITID>A2</FITID>
+<REFNUM>77
+<SIC>
+<NAME>Payroll</NAME>
+<MEMO>Payroll
+</STMTTRN>
+</BANKTRANLIST>
+<LEDGERBAL><BALAMT>987.50<DTASOF>20160531</LEDGERBAL>
+</STMTRS>
+</STMTTRNRS>
+<CCSTMTTRNRS><CCSTMTRS><CCACCTFROM><ACCTID>4111</CCACCTFROM>
+<BANKTRANLIST><STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20160503<TRNAMT>-1
+<FITID>C1</STMTTRN></BANKTRANLIST></CCSTMTRS></CCSTMTTRNRS>
+</BANKMSGSRSV1>
+</OFX>
+'''
+
+
+def test_read_header():
+    header, data = ofx.read_header(io.BytesIO(ex_sgml))
+    assert header['VERSION'] == '102'
+    assert header['CHARSET'] == '1252'
+    assert data.startswith(b'<OFX>')
+    header, data = ofx.read_header(io.BytesIO(b'\xef\xbb\xbf' + ex_ofx))
+    assert header is None
+    assert data.startswith(b'\xef\xbb\xbf<?xml')
+    with pytest.raises(ValueError):
+        ofx.read_header(io.BytesIO(b'Order Date,Order ID\n'))
+
+
+def test_iterparse_sgml(monkeypatch):
+    # small reads so tags and values are split across chunks
+    monkeypatch.setattr(ofx, 'CHUNK_SIZE', 7)
+    accounts = []
+    trs = list(ofx.iterparse(io.BytesIO(ex_sgml), accounts))
+    assert len(accounts) == 1
+    acct = accounts[0]
+    assert acct.routing_number == '123456789'
+    assert acct.acount_number == '000012345678'
+    assert acct.statement.start_date == '20160501'
+    assert acct.statement.end_date == '20160531'
+
+    assert [tr.fitid for tr in trs] == ['A1', 'A2']
+    tr = trs[0]
+    assert tr.posted == datetime(2016,5,3,12,0,0)
+    assert tr.date_available == date(2016,5,4)
+    assert tr.amount == Decimal('-12.50')
+    assert tr.name == 'Caf\xe9 & Co'
+    assert tr.memo == 'Coffee &amp; Co'
+    tr = trs[1]
+    assert tr.posted == datetime(2016,5,15)
+    assert tr.date_available is None
+    assert tr.refnum == '77'
+    assert tr.name == 'Payroll'
+    assert tr.memo == 'Payroll'
+
+
+def test_import_ofx_sgml():
+    assert (list(mport.import_ofx(io.BytesIO(ex_sgml)))
+            == list(mport.import_ofx(io.BytesIO(ex_ofx))))
+
+
+def test_guess_format():
+    assert mport.guess_format('statement.OFX') == 'ofx'
+    assert mport.guess_format('dir/statement.qfx') == 'ofx'
+    assert mport.guess_format('orders.csv') == 'amazon csv'
+    assert mport.guess_format('readme.txt') is None
+
+
+def payee_ofx(sgml):
+    """A transaction with a PAYEE aggregate instead of a NAME."""
+    if sgml:
+        data = ex_sgml.replace(b'<NAME>Payroll</NAME>',
+                               b'<PAYEE><NAME>ACME Corp<CITY>Springfield\n'
+                               b'</PAYEE>')
+    else:
+        data = ex_ofx.replace(b'<NAME>Payroll</NAME>',
+                              b'<PAYEE>\n <NAME>ACME Corp</NAME>\n'
+                              b' <CITY>Springfield</CITY>\n</PAYEE>')
+    return data.replace(b'<MEMO>Payroll', b'<MEMO> ')
+
+
+@pytest.mark.parametrize('sgml', [False, True])
+def test_iterparse_payee(sgml):
+    accounts = []
+    trs = list(ofx.iterparse(io.BytesIO(payee_ofx(sgml)), accounts))
+    assert len(accounts) == 1
+    tr = trs[1]
+    assert tr.fitid == 'A2'
+    assert tr.name is None
+    assert tr.payee == 'ACME Corp'
+    assert tr.memo == ''
+
+    rows = list(mport.import_ofx(io.BytesIO(payee_ofx(sgml))))
+    assert rows[1]['memo'] == 'ACME Corp'
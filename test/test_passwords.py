@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+from RecordSheet import dbapi
+
+###############################################################################
+
+def test_pw_funcs():
+    pwhash = dbapi.new_pw_hash("test password")
+    assert dbapi.compare_pw("test password", pwhash)
+    assert not dbapi.compare_pw("wrong password", pwhash)
+    assert not dbapi.needs_rehash(pwhash)
+
+
+def test_pw_legacy_hash():
+    salt = os.urandom(512)
+    legacy = salt + hashlib.pbkdf2_hmac('sha512', b'legacy', salt, 100000)
+    assert dbapi.compare_pw('legacy', legacy)
+    assert dbapi.needs_rehash(legacy)
+
+
+def test_pw_rounds():
+    pwhash = dbapi.new_pw_hash("test password", rounds=1000)
+    assert dbapi.compare_pw("test password", pwhash)
+    assert dbapi.needs_rehash(pwhash)
+
+
+def test_run_hash_busy():
+    executor, slots = dbapi._get_hash_pool()
+    for i in range(dbapi.HASH_QUEUE):
+        slots.acquire()
+
+    try:
+        dbapi.run_hash(len, 'x')
+    except dbapi.BusyError:
+        pass
+    else:
+        assert False, 'hash queue is unbounded'
+    finally:
+        for i in range(dbapi.HASH_QUEUE):
+            slots.release()
+
+    assert dbapi.run_hash(len, 'x') == 1
@@ -18,6 +18,8 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import zlib
+
 import bottle
 bottle.DEBUG = True
 #from nose.tools import with_setup
@@ -181,3 +183,80 @@ class testJSON:
         assert response.content_type == 'application/json'
 
 ###############################################################################
+
+def test_db_session_middleware():
+    removed = []
+    wsgiapp = plugins.DBSessionMiddleware(mockapp,
+                                          lambda: removed.append(True))
+    testapp = TestApp(wsgiapp, extra_environ={'beaker.session': ses_data})
+    response = testapp.get('/')
+    response.mustcontain('Hello, World!')
+    assert removed == [True]
+
+###############################################################################
+
+def wsgi_app(body, content_type='application/json', headers=(),
+             status='200 OK'):
+    def app(environ, start_response):
+        start_response(status, [('Content-Type', content_type)] +
+                               list(headers))
+        return iter(body)
+    return app
+
+
+def call(wsgiapp, accept):
+    """Call wsgiapp directly, webtest would decode the body."""
+    started = []
+    body = wsgiapp({'REQUEST_METHOD':'GET', 'HTTP_ACCEPT_ENCODING':accept},
+                   lambda status, headers, exc_info=None:
+                       started.append(dict(headers)))
+    data = list(body)
+    if hasattr(body, 'close'):
+        body.close()
+    return started[0], data
+
+
+def test_compression_middleware():
+    chunks = [b'{"rows":[', b'1,' * 1000, b'1]}']
+    wsgiapp = plugins.CompressionMiddleware(wsgi_app(chunks))
+    headers, data = call(wsgiapp, 'gzip, deflate')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Length' not in headers
+    # sent as it's compressed, not all at the end
+    assert len(data) > 1
+    assert zlib.decompress(b''.join(data), zlib.MAX_WBITS + 16) == \
+            b''.join(chunks)
+
+    for etag in ['"abc"', 'W/"abc"']:
+        wsgiapp = plugins.CompressionMiddleware(wsgi_app(chunks,
+                                                headers=[('ETag', etag)]))
+        headers, data = call(wsgiapp, 'gzip')
+        assert headers['ETag'] == 'W/"abc"'
+
+
+def test_compression_middleware_skipped():
+    big = [b'x' * 2000]
+    for wsgiapp, accept in [(wsgi_app([b'{}']), 'gzip'),
+                            (wsgi_app(big, 'image/png'), 'gzip'),
+                            (wsgi_app(big, headers=[('Content-Encoding',
+                                                     'gzip')]), 'gzip'),
+                            (wsgi_app(big, status='206 Partial Content'),
+                             'gzip'),
+                            (wsgi_app(big, headers=[('Content-Range',
+                                                     'bytes */4000')]),
+                             'gzip'),
+                            (wsgi_app(big), 'gzip;q=0, identity'),
+                            (wsgi_app(big), '')]:
+        wsgiapp = plugins.CompressionMiddleware(wsgiapp)
+        headers, data = call(wsgiapp, accept)
+        assert 'Vary' not in headers
+        assert data in ([b'{}'], big)
+
+
+def test_accepted_encoding():
+    assert plugins.accepts('gzip, deflate', 'gzip')
+    assert plugins.accepts('*', 'gzip')
+    assert not plugins.accepts('gzip;q=0', 'gzip')
+    assert not plugins.accepts('identity', 'gzip')
+    assert plugins.accepted_encoding('deflate') is None
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
 from datetime import datetime
 from decimal import Decimal
 
+import pytest
+
 from RecordSheet import util
+from RecordSheet.dbmodel import Posting, User
 
 
 ex_date = datetime(2016,5,21,10,53,45)
@@ -42,6 +46,21 @@ def test_jsonLoads_Decimal():
     assert ex_dec == util.jsonLoads(ex_dec_json)
 
 
+def test_model_json_obj():
+    post = Posting(id=1, account_id=2, journal_id=3, amount=ex_dec,
+                   memo='memo', ref=None, fitid=None)
+    obj = util.jsonLoads(util.jsonDumps(post))
+    assert obj == {'id':1, 'account_id':2, 'journal_id':3, 'amount':ex_dec,
+                   'memo':'memo', 'ref':None, 'fitid':None}
+
+
+def test_model_json_exclude():
+    user = User(id=1, username='user', password=b'hash', last_login=ex_date)
+    obj = user.json_obj()
+    assert 'password' not in obj
+    assert util.jsonDumps(obj['last_login']) == ex_date_json
+
+
 def test_year_range():
     start, end = util.year_range(2016)
     print(repr(start), repr(end))
@@ -54,3 +73,75 @@ def test_year_range():
     assert start.tzinfo
     assert end.tzinfo
 
+
+
+def test_parse_datetime():
+    assert util.parse_datetime(ex_date.isoformat()) == ex_date
+    assert util.parse_datetime('2016-05-21') == datetime(2016,5,21)
+    aware = util.parse_datetime('2016-05-21T10:53:45.5-05:00')
+    assert aware.utcoffset().total_seconds() == -5 * 3600
+    assert aware.microsecond == 500000
+    for text in ['yesterday', '2016-13-01', '2016-05-21T10']:
+        try:
+            util.parse_datetime(text)
+        except ValueError:
+            pass
+        else:
+            assert False, 'invalid datetime parsed'
+
+
+def test_chunked():
+    chunks = list(util.chunked(range(7), 3))
+    assert chunks == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(util.chunked([], 3)) == []
+
+
+def test_cursor():
+    values = [ex_date.isoformat(), 7]
+    token = util.encode_cursor(values)
+    assert util.decode_cursor(token) == values
+
+
+def test_cursor_invalid():
+    for token in ['not a cursor', util.encode_cursor({'a':1})]:
+        try:
+            util.decode_cursor(token)
+        except ValueError:
+            pass
+        else:
+            assert False, 'invalid cursor decoded'
+
+
+def test_rate_limiter():
+    now = [0]
+    limiter = util.RateLimiter(2, 10, clock=lambda: now[0])
+    assert limiter.allow('a')
+    assert limiter.allow('a')
+    assert not limiter.allow('a')
+    assert limiter.allow('b')
+    now[0] = 10
+    assert limiter.allow('a')
+    assert not limiter.allow('a')
+
+
+def test_rate_limiter_max_keys():
+    limiter = util.RateLimiter(1, 10, clock=lambda: 0)
+    limiter.max_keys = 3
+    for key in 'abcd':
+        assert limiter.allow(key)
+    assert list(limiter.buckets) == ['b', 'c', 'd']
+    assert not limiter.allow('b')
+    assert limiter.allow('e')
+    assert list(limiter.buckets) == ['d', 'b', 'e']
+
+
+def test_json_backends():
+    simplejson = pytest.importorskip('simplejson')
+    Row = collections.namedtuple('Row', ['id', 'amount'])
+    payload = {'rows':[Row(1, ex_dec), Row(2, Decimal('-0.5'))],
+               'when':ex_date, 'obj':JsonClass(), 'none':None,
+               'nested':{'list':[1, 'two', 3.5, True], 'tuple':(1, 2)}}
+    stdlib = util._stdlib_dumps(payload)
+    fast = util._simplejson_dumps(payload)
+    assert util.jsonLoads(fast) == util.jsonLoads(stdlib)
+    assert util.jsonLoads(fast)['rows'][0] == [1, ex_dec]
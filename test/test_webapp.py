@@ -18,6 +18,12 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
+import mimetypes
+import os
+import shutil
+import tempfile
+
 import bottle
 bottle.DEBUG = True
 from nose.tools import with_setup
@@ -30,7 +36,27 @@ app = TestApp(webapp.rsapp, extra_environ={'beaker.session':{'user_id':1,
                                                      'csrf-token':CSRF_TOKEN,
                                                      'authenticated':True}})
 
+from sqlalchemy import event
+from test import dbhelper
 from test.dbhelper import setup_module, teardown_module
+from test.test_ofx import ex_ofx
+
+###############################################################################
+
+class count_queries:
+    """Context manager that counts the statements sent to the test db."""
+    def __enter__(self):
+        self.count = 0
+        event.listen(dbhelper.connection, 'before_cursor_execute', self.incr)
+        return self
+
+
+    def __exit__(self, *args):
+        event.remove(dbhelper.connection, 'before_cursor_execute', self.incr)
+
+
+    def incr(self, *args):
+        self.count += 1
 
 ###############################################################################
 
@@ -86,12 +112,42 @@ def test_journal():
     assert response.content_type == 'text/html'
 
 
+
+def test_journal_query_count():
+    posts = [{'amount':1, 'account_id':'TEST01'},
+             {'amount':-1, 'account_id':'TEST02'}]
+    entries = [{'memo':'entry {}'.format(i), 'posts':posts} for i in range(20)]
+    dbapi.new_transactions(dbapi.new_batch(1), entries)
+    dbapi.Session().expire_all()
+
+    with count_queries() as counter:
+        response = app.get('/journal')
+
+    response.mustcontain('TEST01', 'TEST02')
+    assert counter.count <= 3
+
+
 def test_journal_entry():
     response = app.get('/journal/1')
     assert response.status_int == 200
     assert response.content_type == 'text/html'
 
 
+def test_journal_export():
+    response = app.get('/journal/export?from=2016-06-05&to=2016-06-05')
+    assert response.content_type == 'text/csv'
+    assert 'attachment' in response.headers['Content-Disposition']
+    lines = response.text.splitlines()
+    assert lines[0] == ','.join(dbapi.EXPORT_COLUMNS)
+    assert len(lines) == 3
+
+    response = app.get('/journal/export?format=ndjson&to=2016-06-04')
+    assert response.text == ''
+
+    app.get('/journal/export?from=someday', status=400)
+    app.get('/journal/export?format=xml', status=400)
+
+
 def test_journal_entry_invalid_id():
     response = app.get('/journal/100000', status='*')
     assert response.status_int == 404
@@ -104,6 +160,56 @@ def test_import_tr():
     assert response.status_int == 200
     assert response.content_type == 'text/html'
 
+
+def test_import_tr_post(monkeypatch):
+    monkeypatch.setattr(dbapi, '_import_pool', dbhelper.InlineExecutor())
+    postdata = {'file_format':'ofx', 'account_name':'TEST01',
+                'csrf-token':CSRF_TOKEN}
+    response = app.post('/import', postdata,
+                        upload_files=[('upload', 'test.ofx', ex_ofx)])
+    assert response.status_int == 302
+    job_id = int(response.location.rsplit('=', 1)[1])
+    job = dbapi.get_import_job(job_id)
+    assert (job.status, job.parsed, job.inserted) == ('done', 2, 2)
+    assert job.filename == 'test.ofx'
+
+    response = response.follow()
+    assert response.status_int == 200
+    assert 'test.ofx' in response
+
+
+def test_import_tr_post_after_request(monkeypatch):
+    # the job starts once the request is over and its upload closed
+    pool = dbhelper.DeferredExecutor()
+    monkeypatch.setattr(dbapi, '_import_pool', pool)
+    postdata = {'file_format':'ofx', 'csrf-token':CSRF_TOKEN}
+    filename = 'C:\\Downloads\\' + 'x' * 300 + '.ofx'
+    response = app.post('/import', postdata,
+                        upload_files=[('upload', filename,
+                                       ex_ofx.replace(b'>A', b'>B'))])
+    job_id = int(response.location.rsplit('=', 1)[1])
+    assert dbapi.get_import_job(job_id).status == 'queued'
+
+    bottle.request.files['upload'].file.close()
+    (future, func, args, kwargs), = pool.calls
+    spool = kwargs['fileobj']
+    pool.run()
+    assert spool.closed
+    job = dbapi.get_import_job(job_id)
+    assert (job.status, job.parsed, job.inserted) == ('done', 2, 2)
+    assert job.filename == ('x' * 300)[:255]
+
+
+def test_imported_tr():
+    response = app.get('/imported_transactions')
+    assert response.status_int == 200
+    assert response.content_type == 'text/html'
+
+
+def test_imported_tr_invalid_cursor():
+    response = app.get('/imported_transactions?after=garbage', status='*')
+    assert response.status_int == 400
+
 ###############################################################################
 
 def test_user_view():
@@ -192,6 +298,19 @@ def test_login_locked_user():
     assert response.content_type == 'text/html'
 
 
+def test_login_rate_limit():
+    postdata = {'username': 'nxuser',
+                'password':'notpassword',
+                'csrf-token':CSRF_TOKEN}
+    environ = {'REMOTE_ADDR': '192.0.2.1'}
+    for i in range(webapp.LOGIN_BURST):
+        app.post('/login', postdata, extra_environ=environ)
+
+    response = app.post('/login', postdata, extra_environ=environ,
+                        status='*')
+    assert response.status_int == 429
+
+
 def test_logout():
     response = app.get('/logout')
     assert response.status_int == 200
@@ -205,3 +324,30 @@ def test_static():
     assert response.status_int == 200
     assert response.content_type == 'text/css'
 
+
+def test_static_precompressed():
+    root = tempfile.mkdtemp()
+    filename = 'app.0123abcd.js'
+    with open(os.path.join(root, filename), 'w') as f:
+        f.write('var x = 1;')
+    with gzip.open(os.path.join(root, filename + '.gz'), 'wb') as f:
+        f.write(b'var x = 2;')
+
+    static_root, webapp.STATIC_ROOT = webapp.STATIC_ROOT, root
+    try:
+        response = app.get('/static/' + filename)
+        assert response.body == b'var x = 1;'
+        assert response.headers['Cache-Control'] == webapp.FAR_FUTURE
+
+        response = app.get('/static/' + filename,
+                           headers={'Accept-Encoding':'gzip'})
+        assert response.content_type == mimetypes.guess_type(filename)[0]
+        # webtest decodes the gzip
+        assert response.body == b'var x = 2;'
+
+    finally:
+        webapp.STATIC_ROOT = static_root
+        shutil.rmtree(root)
+
+    response = app.get('/static/print.css')
+    assert 'Cache-Control' not in response.headers